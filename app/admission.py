@@ -0,0 +1,258 @@
+"""
+Per-user admission control, in front of every handler (a TypeHandler in
+group -1, so it runs the same in single and multi-worker mode).
+
+Each user has a token bucket for ordinary updates (ADMISSION_RATE per second,
+bursts of ADMISSION_BURST) and a separate, much smaller one for the expensive
+commands (/export, /export_to_excel, /report_pdf). An update that finds its
+bucket empty is not handled:
+- a plain-text entry is held (up to ADMISSION_QUEUE_MAX per user) and all held
+  entries are logged together, one transaction and one reply, as soon as the
+  bucket has a token again, or before the user's next admitted update;
+- anything else gets one cooldown reply per cooldown and is dropped.
+So a user pasting dozens of entries costs a handful of transactions, and
+never more than their own share of DB connections and Telegram sends.
+
+A held entry is written to `held_entries` before its update counts as
+handled, and deleted once its batch is logged (entries claim their update,
+see app.idempotency, so one logged twice is skipped). Entries left there by a
+restart or crash are picked up at startup, or in multi-worker mode by the
+worker that takes the user's shard. A worker logs what it holds before it
+gives up a shard and when it stops.
+
+Admins see the counters with /admission.
+"""
+import os, json, time, asyncio, logging
+from collections import Counter
+
+from sqlalchemy import select, delete
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+
+from .db import SessionLocal, HeldEntry, dialect_insert
+
+_LOG = logging.getLogger(__name__)
+
+RATE = float(os.getenv("ADMISSION_RATE", "1"))  # tokens per second; 0 turns admission control off
+BURST = int(os.getenv("ADMISSION_BURST", "10"))
+HEAVY_RATE = float(os.getenv("ADMISSION_HEAVY_PER_MINUTE", "2")) / 60
+HEAVY_BURST = int(os.getenv("ADMISSION_HEAVY_BURST", "3"))
+QUEUE_MAX = int(os.getenv("ADMISSION_QUEUE_MAX", "20"))  # held entries per user; more get the cooldown reply
+RETRY_SECONDS = float(os.getenv("ADMISSION_RETRY_SECONDS", "10"))  # after a held batch failed to log
+
+HEAVY_COMMANDS = {"export", "export_to_excel", "report_pdf"}
+_LIMITS = {"default": (RATE, BURST), "heavy": (HEAVY_RATE, HEAVY_BURST)}
+
+_BUCKETS: dict[tuple[int, str], list] = {}  # (user, class) -> [tokens, as of (monotonic)]
+_NOTIFIED: dict[tuple[int, str], float] = {}  # (user, class) -> no further cooldown replies until
+COUNTS: Counter = Counter()  # (admitted|throttled|held|merged|dropped, class) -> updates
+THROTTLED_USERS: Counter = Counter()  # user -> throttled updates
+
+# ------------------------------------------------------------------------------
+# Token buckets
+# ------------------------------------------------------------------------------
+def _tokens(key: tuple[int, str], now: float) -> float:
+    rate, burst = _LIMITS[key[1]]
+    b = _BUCKETS.get(key)
+    return burst if b is None else min(burst, b[0] + (now - b[1]) * rate)
+
+def take(user_id: int, cls: str = "default", now: float | None = None) -> bool:
+    """Spend one of the user's tokens; False if there is none."""
+    now = time.monotonic() if now is None else now
+    key = (user_id, cls)
+    tokens = _tokens(key, now)
+    if tokens < 1:
+        return False
+    if len(_BUCKETS) > 1000:
+        # a full bucket is the same as no bucket
+        for k in [k for k in _BUCKETS if _tokens(k, now) >= _LIMITS[k[1]][1]]:
+            del _BUCKETS[k]
+    _BUCKETS[key] = [tokens - 1, now]
+    return True
+
+def wait_seconds(user_id: int, cls: str = "default", now: float | None = None) -> float:
+    """Seconds until the user has a token again."""
+    now = time.monotonic() if now is None else now
+    return max(0.0, (1 - _tokens((user_id, cls), now)) / _LIMITS[cls][0])
+
+def classify(update) -> str:
+    msg = getattr(update, "message", None)
+    text = (msg.text or "") if msg is not None else ""
+    if text.startswith("/"):
+        name = text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(text) > 1 else ""
+        if name in HEAVY_COMMANDS:
+            return "heavy"
+    return "default"
+
+def _entry_text(update) -> str | None:
+    """The text of a new plain-text message (an entry to log), else None."""
+    msg = getattr(update, "message", None)
+    if msg is None or not msg.text or msg.text.startswith("/"):
+        return None
+    return msg.text.strip() or None
+
+def reset():
+    COUNTS.clear()
+    THROTTLED_USERS.clear()
+
+# ------------------------------------------------------------------------------
+# held_entries
+# ------------------------------------------------------------------------------
+async def _keep(update, user_id: int):
+    async with SessionLocal() as s:
+        ins = dialect_insert(s.bind)(HeldEntry).values(
+            user_tg_id=user_id, update_id=update.update_id, payload=json.dumps(update.to_dict()),
+        )
+        await s.execute(ins.on_conflict_do_nothing(index_elements=["update_id"]))
+        await s.commit()
+
+async def _release(user_id: int, items: list):
+    async with SessionLocal() as s:
+        await s.execute(delete(HeldEntry).where(
+            HeldEntry.user_tg_id == user_id, HeldEntry.update_id.in_([u.update_id for u, _ in items]),
+        ))
+        await s.commit()
+
+# ------------------------------------------------------------------------------
+# Gate
+# ------------------------------------------------------------------------------
+class Gate:
+    """
+    The group -1 handler. `log_batch(context, items)` logs held entries, a list
+    of (update, text) in arrival order, as one batch.
+
+    `users` arguments below are predicates on the user id (e.g. "in these shards").
+    """
+
+    def __init__(self, log_batch):
+        self._log_batch = log_batch
+        self._held: dict[int, list] = {}  # user -> [(update, text)]
+        self._flushing: dict[int, asyncio.Event] = {}  # user -> set when their batch is logged
+
+    async def __call__(self, update, context):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            return
+        cls = classify(update)
+        if take(user.id, cls):
+            COUNTS["admitted", cls] += 1
+            if user.id in self._held or user.id in self._flushing:
+                # held entries go first, keeping the user's order
+                try:
+                    await self._flush(user.id, context)
+                except Exception:
+                    _LOG.exception("Logging held entries for user %s failed", user.id)
+                    # they are still waiting, so this update can't go ahead of them
+                    await self._hold_or_drop(update, user.id, cls, context)
+            return
+        COUNTS["throttled", cls] += 1
+        if len(THROTTLED_USERS) > 1000:
+            THROTTLED_USERS.clear()
+        THROTTLED_USERS[user.id] += 1
+        await self._hold_or_drop(update, user.id, cls, context)
+
+    async def _hold_or_drop(self, update, user_id: int, cls: str, context):
+        text = _entry_text(update) if cls == "default" else None
+        if text is not None and len(self._held.get(user_id, ())) < QUEUE_MAX:
+            await _keep(update, user_id)
+            self._hold(context.application, user_id, update, text)
+            COUNTS["held", cls] += 1
+        else:
+            COUNTS["dropped", cls] += 1
+            await self._cooldown(update, user_id, cls)
+        raise ApplicationHandlerStop
+
+    def _schedule(self, application, user_id: int, when: float):
+        application.job_queue.run_once(
+            self._flush_job, when=when, data=user_id, name=f"admission:{user_id}", user_id=user_id,
+        )
+
+    def _hold(self, application, user_id: int, update, text: str):
+        held = self._held.setdefault(user_id, [])
+        if not held:
+            self._schedule(application, user_id, wait_seconds(user_id))
+        if all(u.update_id != update.update_id for u, _ in held):  # redelivered after a restart
+            held.append((update, text))
+
+    async def restore(self, application, users=None) -> int:
+        """Hold again the entries left in `held_entries` by a restart, or by the
+        worker that had the user's shard before."""
+        async with SessionLocal() as s:
+            rows = (await s.execute(select(HeldEntry).order_by(HeldEntry.id))).scalars().all()
+        n = 0
+        for r in rows:
+            if users is not None and not users(r.user_tg_id):
+                continue
+            update = Update.de_json(json.loads(r.payload), application.bot)
+            self._hold(application, r.user_tg_id, update, _entry_text(update) or "")
+            n += 1
+        return n
+
+    async def flush_all(self, application, users=None):
+        """Log held entries now, before their users' shards are handed over or the process stops."""
+        for user_id in {*self._held, *self._flushing}:
+            if users is not None and not users(user_id):
+                continue
+            try:
+                await self._flush(user_id, application.context_types.context(application, user_id=user_id))
+            except Exception:
+                _LOG.exception("Logging held entries for user %s failed", user_id)
+
+    def forget(self, users):
+        """Drop held entries from memory without logging them: their shard went to
+        another worker, which picks them up from `held_entries`."""
+        for user_id in [u for u in self._held if users(u)]:
+            del self._held[user_id]
+
+    async def _flush(self, user_id: int, context):
+        items = self._held.pop(user_id, None)
+        if not items:
+            done = self._flushing.get(user_id)
+            if done is not None:
+                await done.wait()
+                if user_id in self._held:  # that batch failed and is waiting again
+                    await self._flush(user_id, context)
+            return
+        self._flushing[user_id] = done = asyncio.Event()
+        try:
+            await self._log_batch(context, items)
+            COUNTS["merged", "default"] += len(items)
+            await _release(user_id, items)
+        except Exception:
+            # back in front of anything held since, and retried; entries already
+            # logged (if only _release failed) are skipped by their claims
+            retry = not self._held.get(user_id)
+            self._held[user_id] = items + self._held.get(user_id, [])
+            if retry:
+                self._schedule(context.application, user_id, RETRY_SECONDS)
+            raise
+        finally:
+            del self._flushing[user_id]
+            done.set()
+
+    async def _flush_job(self, context):
+        user_id = context.job.data
+        if user_id in self._held:
+            take(user_id)  # the batch is one transaction: one token
+        try:
+            await self._flush(user_id, context)
+        except Exception:
+            _LOG.exception("Logging held entries for user %s failed", user_id)
+
+    async def _cooldown(self, update, user_id: int, cls: str):
+        now = time.monotonic()
+        wait = wait_seconds(user_id, cls, now)
+        if update.callback_query is not None:
+            # a callback must be answered either way, or the button keeps spinning
+            await update.callback_query.answer(f"Too many requests, try again in {wait:.0f}s.")
+            return
+        if _NOTIFIED.get((user_id, cls), 0) > now or update.effective_chat is None:
+            return
+        if len(_NOTIFIED) > 1000:
+            _NOTIFIED.clear()
+        _NOTIFIED[user_id, cls] = now + wait
+        if cls == "heavy":
+            text = f"⏳ Exports and reports are rate-limited. Try again in {wait:.0f}s."
+        else:
+            text = f"⏳ Too many messages at once. Try again in {max(wait, 1):.0f}s."
+        await update.effective_chat.send_message(text)
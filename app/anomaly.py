@@ -0,0 +1,171 @@
+"""
+Unusual-expense flags at log time, from statistics kept up to date instead of
+recomputed.
+
+Per (user, category, parent), `txn_stats` holds the count, mean and sum of
+squared deviations of Expense amounts (Welford), and `txn_stat_buckets` a
+log-scale histogram per month from which recent quantiles are read. app.ledger
+folds every insert, edit and delete into both in the same transaction: a
+batch's rows are combined with Chan's parallel formula (deletes as negative
+counts) and merged into the stored row by an upsert. Checking a new amount is
+one unique-key lookup; the histogram is only read when the z-score already
+says "unusual", to confirm the amount is also above the recent quantile.
+"""
+import os, math
+from datetime import date
+
+from sqlalchemy import select, delete, func, case
+
+from .db import TxnStat, TxnStatBucket, dialect_insert
+from .partitions import txn_source
+
+Z_THRESHOLD = float(os.getenv("ANOMALY_Z", "3"))
+MIN_SAMPLES = int(os.getenv("ANOMALY_MIN_SAMPLES", "8"))  # no flags until an envelope has this many expenses
+RECENT_MONTHS = int(os.getenv("ANOMALY_RECENT_MONTHS", "3"))
+QUANTILE = float(os.getenv("ANOMALY_QUANTILE", "0.95"))
+GAMMA = 1.05  # histogram bucket ratio: quantiles are within ~2.5%
+_LOG_GAMMA = math.log(GAMMA)
+
+def bucket_of(cents: int) -> int:
+    return int(math.floor(math.log(max(int(cents), 1)) / _LOG_GAMMA))
+
+def _bucket_value(b: int) -> float:
+    return GAMMA ** (b + 0.5)
+
+def _merge(a: tuple, b: tuple) -> tuple:
+    """Chan et al.: combine two (n, mean, m2) summaries; a negative n removes values."""
+    n = a[0] + b[0]
+    if n == 0:
+        return (0, 0.0, 0.0)
+    d = b[1] - a[1]
+    return (n, a[1] + d * b[0] / n, a[2] + b[2] + d * d * a[0] * b[0] / n)
+
+# ------------------------------------------------------------------------------
+# Kept in step by app.ledger
+# ------------------------------------------------------------------------------
+def deltas(rows, sign: int, stats: dict, buckets: dict):
+    """Fold rows (added: +1, removed: -1) into per-key (n, mean, m2) and bucket counts."""
+    for r in rows:
+        if r["type"] != "Expense":
+            continue
+        key = (r["user_tg_id"], r["category"], r["parent"] or "")
+        # removals and additions stay apart: an edit would otherwise net out to n = 0
+        # and lose the change in amount
+        skey = (sign,) + key
+        stats[skey] = _merge(stats.get(skey, (0, 0.0, 0.0)), (sign, float(r["amount_cents"]), 0.0))
+        bkey = key + (r["month"], bucket_of(r["amount_cents"]))
+        buckets[bkey] = buckets.get(bkey, 0) + sign
+
+async def apply(session, stats: dict, buckets: dict):
+    for sign in (-1, +1):
+        part = {k[1:]: v for k, v in stats.items() if k[0] == sign}
+        if part:
+            await _merge_stats(session, part)
+    buckets = {k: v for k, v in buckets.items() if v}
+    if buckets:
+        ins = dialect_insert(session.bind)(TxnStatBucket).values([
+            dict(user_tg_id=u, category=c, parent=p, month=m, bucket=b, count=v) for (u, c, p, m, b), v in buckets.items()
+        ])
+        await session.execute(ins.on_conflict_do_update(
+            index_elements=["user_tg_id", "category", "parent", "month", "bucket"],
+            set_={"count": TxnStatBucket.count + ins.excluded.count},
+        ))
+
+async def _merge_stats(session, stats: dict):
+    ins = dialect_insert(session.bind)(TxnStat).values([
+        dict(user_tg_id=u, category=c, parent=p, n=n, mean=mean, m2=m2) for (u, c, p), (n, mean, m2) in stats.items()
+    ])
+    n_new = TxnStat.n + ins.excluded.n
+    d = ins.excluded.mean - TxnStat.mean
+    await session.execute(ins.on_conflict_do_update(
+        index_elements=["user_tg_id", "category", "parent"],
+        set_={
+            "n": n_new,
+            "mean": case((n_new == 0, 0.0), else_=TxnStat.mean + d * ins.excluded.n / n_new),
+            "m2": case((n_new == 0, 0.0), else_=TxnStat.m2 + ins.excluded.m2 + d * d * TxnStat.n * ins.excluded.n / n_new),
+        },
+    ))
+
+# ------------------------------------------------------------------------------
+# Check
+# ------------------------------------------------------------------------------
+def _recent_start(today: date) -> str:
+    k = today.year * 12 + today.month - RECENT_MONTHS
+    return f"{k // 12:04d}-{k % 12 + 1:02d}"
+
+async def check(session, user_id: int, category: str, parent: str | None, cents: int, today: date) -> dict | None:
+    """None, or {"z", "mean", "quantile"} if `cents` is unusually high for this envelope."""
+    st = (await session.execute(
+        select(TxnStat.n, TxnStat.mean, TxnStat.m2).where(
+            TxnStat.user_tg_id == user_id, TxnStat.category == category, TxnStat.parent == (parent or "")
+        )
+    )).first()
+    if st is None or st.n < MIN_SAMPLES:
+        return None
+    std = math.sqrt(max(st.m2, 0.0) / (st.n - 1))
+    if std <= 0 or (cents - st.mean) / std < Z_THRESHOLD:
+        return None
+    # a long history can make the norm stale: the amount must also top the recent quantile
+    hist = (await session.execute(
+        select(TxnStatBucket.bucket, func.sum(TxnStatBucket.count)).where(
+            TxnStatBucket.user_tg_id == user_id, TxnStatBucket.category == category,
+            TxnStatBucket.parent == (parent or ""), TxnStatBucket.month >= _recent_start(today),
+        ).group_by(TxnStatBucket.bucket).order_by(TxnStatBucket.bucket)
+    )).all()
+    total = sum(c for _b, c in hist if c > 0)
+    q = None
+    if total >= MIN_SAMPLES:
+        seen = 0
+        for b, c in hist:
+            seen += max(c, 0)
+            if seen >= QUANTILE * total:
+                q = _bucket_value(b)
+                break
+        if q is not None and cents <= q:
+            return None
+    return {"z": (cents - st.mean) / std, "mean": st.mean, "quantile": q}
+
+# ------------------------------------------------------------------------------
+# Backfill
+# ------------------------------------------------------------------------------
+async def backfill(session, only_if_empty: bool = False) -> int:
+    """Rebuild both tables from txns in one vectorized pass. Returns envelopes covered."""
+    if only_if_empty and (await session.execute(select(TxnStat.id).limit(1))).first():
+        return 0
+    import numpy as np
+
+    src = txn_source()
+    rows = (await session.execute(
+        select(src.c.user_tg_id, src.c.category, func.coalesce(src.c.parent, ""), src.c.month, src.c.amount_cents)
+        .where(src.c.type == "Expense")
+    )).all()
+    keys, months = {}, {}
+    key_idx = np.fromiter((keys.setdefault((u, c, p), len(keys)) for u, c, p, _m, _a in rows), dtype=np.intp, count=len(rows))
+    month_idx = np.fromiter((months.setdefault(m, len(months)) for *_k, m, _a in rows), dtype=np.intp, count=len(rows))
+    x = np.fromiter((a for *_k, a in rows), dtype=np.float64, count=len(rows))
+
+    # two-pass per group: sums give the means, then squared deviations from them
+    n = np.bincount(key_idx, minlength=len(keys))
+    mean = np.bincount(key_idx, weights=x, minlength=len(keys)) / np.maximum(n, 1)
+    m2 = np.bincount(key_idx, weights=(x - mean[key_idx]) ** 2, minlength=len(keys))
+    # same function as the incremental path, so a value on a bucket edge lands in the same bucket
+    b = np.fromiter((bucket_of(a) for *_k, a in rows), dtype=np.int64, count=len(rows))
+    cells, counts = np.unique(np.stack([key_idx, month_idx, b], axis=1), axis=0, return_counts=True)
+
+    key_list, month_list = list(keys), list(months)
+    await session.execute(delete(TxnStat))
+    await session.execute(delete(TxnStatBucket))
+    stat_rows = [
+        dict(user_tg_id=u, category=c, parent=p, n=int(n[i]), mean=float(mean[i]), m2=float(m2[i]))
+        for i, (u, c, p) in enumerate(key_list)
+    ]
+    bucket_rows = [
+        dict(zip(("user_tg_id", "category", "parent"), key_list[k]), month=month_list[m], bucket=int(bk), count=int(cnt))
+        for (k, m, bk), cnt in zip(cells.tolist(), counts.tolist())
+    ]
+    if stat_rows:
+        await session.execute(TxnStat.__table__.insert(), stat_rows)
+    if bucket_rows:
+        await session.execute(TxnStatBucket.__table__.insert(), bucket_rows)
+    await session.commit()
+    return len(stat_rows)
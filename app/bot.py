@@ -1,4 +1,4 @@
-import os, asyncio, csv, io, textwrap, datetime as dt, logging, json, re
+import os, asyncio, contextlib, csv, io, textwrap, datetime as dt, logging, json, re, signal
 from calendar import monthrange
 from collections import defaultdict
 
@@ -7,22 +7,21 @@ from typing import Optional
 from sqlalchemy import text
 BOT_LOCK_KEY = int(os.getenv("BOT_LOCK_KEY", "728431"))
 
-import sentry_sdk
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+    ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, TypeHandler
 )
 
-from .db import init_db, SessionLocal, User, Txn, Budget
-from .parser import parse_message
+from .db import init_db, engine, SessionLocal, User, Txn
+from .parser import parse_message, AMOUNT_RE
 from .budget import (
-    month_of, budget_left, add_or_update_budget, is_frozen, set_freeze, spent_by,
-    burn_rate_warning, set_weekly_cap, weekly_spent, get_weekly_caps, get_weekly_cap, week_range
+    month_of, budget_left, add_or_update_budget, get_budget, carry_in, frozen_by, load_freezes, list_freezes, set_freeze, spent_by,
+    burn_rate_warning, set_weekly_cap, weekly_spent, weekly_spent_all, get_weekly_caps, get_weekly_cap, week_range
 )
-from .utils import current_month, money, to_excel_bytes
-from . import sheets_sync
-from .reports import build_weekly_pdf
-from .emailer import send_email_with_pdf
+from .utils import current_month, money, to_excel_bytes, to_minor, from_minor, fmt_minor, split_minor
+from . import profiler, partitions, ledger, goals, templates, recurring, history, search, mru, reminders, cluster, idempotency, retention, trends, anomaly, sheets_pull, admission
+from .partitions import txn_source
 
 # ------------------------------------------------------------------------------
 # Config
@@ -35,6 +34,11 @@ WEEKLY_DIGEST_DOW = int(os.getenv("WEEKLY_DIGEST_DOW", "6"))  # 0=Mon ... 6=Sun
 WEEKLY_DIGEST_HOUR = int(os.getenv("WEEKLY_DIGEST_HOUR", "19"))
 SENTRY_DSN = os.getenv("SENTRY_DSN", "")
 REPORT_EMAIL_TO = os.getenv("REPORT_EMAIL_TO", "").strip()
+# Comma-separated Telegram user ids allowed to run admin commands (/slowqueries, /admission)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# Budgets, caps and freezes are per user; the Sheets config tabs and the report
+# email have no user column, so they mirror one user's: OWNER_ID (default: lowest admin id)
+OWNER_ID = int(os.getenv("OWNER_ID", "0")) or min(ADMIN_IDS, default=0)
 
 # Optional: alias map to shorten typing, e.g.
 # ALIAS_MAP='{"g":"Groceries","f.d":"Food;sub=DiningOut","tr":"Transport"}'
@@ -43,9 +47,26 @@ try:
 except Exception:
     ALIAS_MAP = {}
 
+# Optional subsystems are imported on first use (or never, when unconfigured):
+# gspread/google-auth, ReportLab, SendGrid and sentry_sdk dominate cold start.
+# Keep it that way — `python -m bench.bench_startup` enforces the budget.
+SHEETS_ENABLED = bool(os.getenv("GOOGLE_SHEET_ID", "").strip() and os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON", "").strip())
+EMAIL_ENABLED = bool(REPORT_EMAIL_TO and os.getenv("SENDGRID_API_KEY", "").strip())
+SHEETS_FLUSH_SECONDS = int(os.getenv("SHEETS_FLUSH_SECONDS", "5"))
+SHEETS_RECONCILE_MINUTES = int(os.getenv("SHEETS_RECONCILE_MINUTES", "60"))
+FREEZE_RELOAD_SECONDS = int(os.getenv("FREEZE_RELOAD_SECONDS", "60"))  # multi-worker mode only
+
 if SENTRY_DSN:
+    import sentry_sdk
     sentry_sdk.init(dsn=SENTRY_DSN, traces_sample_rate=0.0)
 
+def _sheets():
+    from . import sheets_sync
+    return sheets_sync
+
+def _mirrors_sheet(update: Update) -> bool:
+    return SHEETS_ENABLED and update.effective_user.id == OWNER_ID
+
 LOG = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------------
@@ -99,39 +120,41 @@ def _month_bounds(yyyy_mm: str) -> tuple[date, date]:
 
 async def _totals_text(user_id: int, start: date, end: date) -> str:
     # pull rows once and aggregate in Python
+    src = txn_source(start)
     async with SessionLocal() as s:
         q = await s.execute(
-            Txn.__table__.select().where(
-                Txn.user_tg_id == user_id,
-                Txn.occurred_at >= start,
-                Txn.occurred_at <= end,
+            src.select().where(
+                src.c.user_tg_id == user_id,
+                src.c.occurred_at >= start,
+                src.c.occurred_at <= end,
             )
         )
         rows = [dict(r) for r in q.mappings().all()]
+        rows += await retention.report_rows(s, user_id, start, end)
 
-    expense = sum(r["amount"] for r in rows if r["type"] == "Expense")
-    income  = sum(r["amount"] for r in rows if r["type"] == "Income")
+    expense = sum(r["amount_cents"] for r in rows if r["type"] == "Expense")
+    income  = sum(r["amount_cents"] for r in rows if r["type"] == "Income")
     net     = income - expense
 
     # top spending categories (optional, nice to have)
-    by_cat = defaultdict(float)
+    by_cat = defaultdict(int)
     for r in rows:
         if r["type"] != "Expense":
             continue
         label = r["category"] + (f" › {r['parent']}" if r["parent"] else "")
-        by_cat[label] += r["amount"]
+        by_cat[label] += r["amount_cents"]
     top = sorted(by_cat.items(), key=lambda kv: kv[1], reverse=True)[:5]
 
     lines = [
         f"*Totals*  `{start} → {end}`",
-        f"- Expense: `{expense:,.2f}`",
-        f"- Income:  `{income:,.2f}`",
-        f"- Net:     `{net:,.2f}`",
+        f"- Expense: `{fmt_minor(expense, DEFAULT_CURRENCY)}`",
+        f"- Income:  `{fmt_minor(income, DEFAULT_CURRENCY)}`",
+        f"- Net:     `{fmt_minor(net, DEFAULT_CURRENCY)}`",
     ]
     if top:
         lines.append("\n*Top categories (spent)*")
         for name, amt in top:
-            lines.append(f"- {name}: `{amt:,.2f}`")
+            lines.append(f"- {name}: `{fmt_minor(amt, DEFAULT_CURRENCY)}`")
     return "\n".join(lines)
 
 async def totals_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -178,8 +201,11 @@ async def month_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
-async def reply_md(update: Update, text: str):
-    await update.effective_chat.send_message(text, parse_mode="Markdown")
+async def reply_md(update: Update, text: str, reply_markup=None):
+    await update.effective_chat.send_message(text, parse_mode="Markdown", reply_markup=reply_markup)
+
+def is_admin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
 
 # ------------------------------------------------------------------------------
 # Shorthand normalizer
@@ -216,17 +242,9 @@ async def apply_shorthand(raw_text: str, user_id: int) -> str:
 
     # 2) if still no category tag, reuse last one or pick default
     if "#" not in t2:
-        async with SessionLocal() as s:
-            q = await s.execute(
-                Txn.__table__
-                .select()
-                .where(Txn.user_tg_id == user_id)
-                .order_by(Txn.id.desc())
-                .limit(1)
-            )
-            r = q.mappings().first()
-        if r:
-            cat = r["category"]; sub = r["parent"]
+        last = await mru.last_category(user_id)
+        if last:
+            cat, sub = last
         else:
             if is_income:
                 cat, sub = "OtherIncome", None
@@ -254,7 +272,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Expense:  `12 burrito #Food/DiningOut`\n"
         "• Income:   `+200 tutoring`  (defaults to #OtherIncome)\n"
         "• Split evenly:  `40 groceries #Food #Household`\n"
-        "/override <message> — Log even if a weekly cap would be exceeded\n\n"
+        "/override <message> — Log even if a weekly cap or a freeze would block it\n\n"
 
         "Shorter typing\n"
         "• Subcategory shorthand:  `#Food/DiningOut` (also `#Food:DiningOut`, `#Food>DiningOut`)\n"
@@ -262,27 +280,44 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Omit category to reuse your last one:  `12 burrito`\n\n"
 
         "Budgets & weekly caps\n"
-        "/setbudget <Category> [;sub=Sub] <Amount> — Set a monthly budget\n"
+        "/setbudget <Category> [;sub=Sub] <Amount> [rollover|norollover] — Set a monthly budget; rollover carries its leftover into next month\n"
         "/left — What’s left in each monthly budget\n"
+        "/forecast — Projected month-end spend per budget\n"
+        "/whatif Food -20% — Try budget/spending changes without saving them\n"
         "/setweekly <Category> [;sub=Sub] <Amount> — Set a weekly cap\n"
         "/weeklyleft — Weekly remaining per category\n\n"
 
         "Freezes\n"
         "/freeze add <Category;sub=Sub> — Turn ON a freeze (soft stop)\n"
         "/freeze off <Category;sub=Sub> — Turn OFF a freeze\n"
-        "/freeze list — Sheet is the source of truth\n\n"
+        "/freeze list — Active freezes (edits in the sheet's Freezes tab apply within a minute)\n\n"
+
+        "Goals\n"
+        "/goal add <Name> <Target> [Monthly] — Create or update a savings goal\n"
+        "/goal list — Progress on your goals\n"
+        "/goal contribute <Name> <Amount> — Add money to a goal\n"
+        "/sweep — Move this month’s leftover budget into your goals\n\n"
+
+        "Templates & recurring\n"
+        "/template add <name> <message> — e.g. `/template add lunch 12 #Food;sub=DiningOut`, then `/lunch` (or `/lunch 15`)\n"
+        "/template list | /template del <name>\n"
+        "/recurring add <daily|weekly|monthly|yearly> <message> [on=YYYY-MM-DD] — e.g. `/recurring add monthly 1200 rent #Housing`\n"
+        "/recurring list | /recurring stop <id>\n\n"
 
         "History & edits\n"
-        "/history — Last 10 transactions (with Delete buttons)\n"
+        "/history [#Category] [expense|income] [from=YYYY-MM-DD] [to=YYYY-MM-DD] — Browse (Older/Newer), tick rows to delete in bulk\n"
+        "/search <words> [YYYY-MM-DD..YYYY-MM-DD] [#Category] — Find transactions by note, with totals\n"
         "/undo — Undo your most recent transaction\n"
-        "/edit <id> [amount=..] [note=\"...\"] [#Category] [;sub=Sub] — Edit a past transaction\n\n"
+        "/edit <id> [amount=..] [note=\"...\"] [#Category] [;sub=Sub] [on=YYYY-MM-DD] — Edit a past transaction\n"
+        "/rehydrate YYYY-MM — Bring back a compacted month's transactions for /history, /search and /edit\n\n"
 
         "Sheets & reports\n"
         "/sheets_status — Check Google Sheets integration status\n"
         "/bootstrap_sheet [Title] — Create a new BudgetBot sheet (then set GOOGLE_SHEET_ID)\n"
         "/export [YYYY-MM-DD YYYY-MM-DD] — Export CSV for a date range (defaults to this month)\n"
         "/export_to_excel — Export all your data to Excel\n"
-        "/report_pdf — Generate & send the weekly PDF for the current month\n"
+        "/report_pdf — Generate & send the weekly PDF for the current month (with your trend chart)\n"
+        "/trends [months] [#Category] — Chart of spending & income per month (default 6)\n"
 
 
 
@@ -292,12 +327,27 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # plain text so /commands remain clickable (no Markdown parsing)
     await update.effective_chat.send_message(txt, disable_web_page_preview=True)
 
+_LOCK_CONN = None  # holds the instance lock for the life of the process
+
 async def acquire_single_instance_lock() -> bool:
-    """Use a Postgres advisory lock so only one bot process runs."""
-    async with SessionLocal() as s:
-        res = await s.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": BOT_LOCK_KEY})
-        got = res.scalar()
-        return bool(got)
+    """Use a Postgres advisory lock so only one process polls Telegram (SQLite: always True)."""
+    global _LOCK_CONN
+    if engine.dialect.name != "postgresql":
+        return True
+    conn = await engine.connect()
+    got = (await conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": BOT_LOCK_KEY})).scalar()
+    await conn.commit()
+    if not got:
+        await conn.close()
+        return False
+    _LOCK_CONN = conn
+    return True
+
+async def release_single_instance_lock(app=None):
+    global _LOCK_CONN
+    if _LOCK_CONN is not None:
+        await _LOCK_CONN.close()  # closing the session ends the lock
+        _LOCK_CONN = None
 
 
 # ---------- One-shot Income logger (/income) ----------
@@ -324,7 +374,7 @@ async def income_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # amount
     try:
-        amt = float(context.args[0])
+        amt = to_minor(context.args[0], DEFAULT_CURRENCY)
     except Exception:
         await reply_md(update, "The first argument must be a number, e.g. `/income 200`")
         return
@@ -387,8 +437,8 @@ async def income_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # parse category from remaining tail using your parser
     category, sub = "OtherIncome", None
     try:
-        pseudo = f"+{amt} income {stripped}"
-        parsed = parse_message(pseudo)
+        pseudo = f"+{from_minor(amt, DEFAULT_CURRENCY)} income {stripped}"
+        parsed = parse_message(pseudo, DEFAULT_CURRENCY)
         if parsed["categories"]:
             category, sub = parsed["categories"][0]
     except Exception:
@@ -405,33 +455,23 @@ async def income_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             occurred_at=d,
             month=f"{d.year:04d}-{d.month:02d}",
             type="Income",
-            amount=float(amt),
+            amount_cents=amt,
             currency=os.getenv("CURRENCY", "USD"),
             category=category,
             parent=sub,
             note=final_note or None,
         )
-        s.add(t)
+        if not await idempotency.claim(s, update):
+            return
+        await ledger.add_txns(s, [t])
         await s.commit()
 
-    # append to Sheets
-    try:
-        sheets_sync.append_transactions([{
-            "Date": d.isoformat(),
-            "Month": f"{d.year:04d}-{d.month:02d}",
-            "Type": "Income",
-            "Amount": float(amt),
-            "Currency": os.getenv("CURRENCY", "USD"),
-            "Category": category,
-            "Sub-Category": sub or "",
-            "Note": final_note or "",
-        }])
-    except Exception as e:
-        LOG.exception("Sheets append (income) failed: %s", e)
+    if SHEETS_ENABLED:
+        _sheets().queue_upsert([ledger.row_dict(t)])
 
     label = f"{category}" + (f" › {sub}" if sub else "")
     suffix = f" — _{final_note}_" if final_note else ""
-    await reply_md(update, f"Logged income `{amt:,.2f}` on `{d}` → *{label}*{suffix}")
+    await reply_md(update, f"Logged income `{fmt_minor(amt, DEFAULT_CURRENCY)}` on `{d}` → *{label}*{suffix}")
 
 
 
@@ -448,28 +488,32 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await reply_md(update, text)
 
 async def sheets_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    status = sheets_sync.ping_status()
+    status = _sheets().ping_status()
     await reply_md(update, status)
 
 async def bootstrap_sheet_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     title = " ".join(context.args) if context.args else None
     try:
-        sid = sheets_sync.bootstrap_sheet(title)
+        sid = _sheets().bootstrap_sheet(title)
         await reply_md(update, f"✅ Sheet ready. ID: `{sid}`. Set `GOOGLE_SHEET_ID={sid}` in your env (if not already).")
     except Exception as e:
         await reply_md(update, f"⚠️ Bootstrap failed: {e}")
 
 async def setbudget_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await reply_md(update, "Usage: `/setbudget Food 300` or `/setbudget Food ;sub=DiningOut 120`")
+        await reply_md(update, "Usage: `/setbudget Food 300` or `/setbudget Food ;sub=DiningOut 120` (add `rollover` to carry the leftover into next month)")
         return
-    text = " ".join(context.args)
+    args = list(context.args)
+    rollover = None
+    if args[-1].lower() in ("rollover", "norollover"):
+        rollover = args.pop().lower() == "rollover"
+    text = " ".join(args)
     parts = text.rsplit(" ", 1)
     if len(parts) != 2:
         await reply_md(update, "Please end with the amount, e.g., `Food 300`")
         return
     cat_part, amt_part = parts
-    amt = float(amt_part)
+    amt = to_minor(amt_part, DEFAULT_CURRENCY)
     parent = None
     if ";sub=" in cat_part or ";g=" in cat_part:
         if ";sub=" in cat_part:
@@ -480,42 +524,122 @@ async def setbudget_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         cat = cat_part.strip()
     async with SessionLocal() as s:
         month = current_month()
-        await add_or_update_budget(s, month, cat, parent, amt)
+        rolls = await add_or_update_budget(s, update.effective_user.id, month, cat, parent, amt, rollover=rollover)
+    ledger.bump_version(update.effective_user.id)
     try:
-        sheets_sync.upsert_budget(month, cat, parent, amt, group_guess="")
+        if _mirrors_sheet(update):
+            _sheets().upsert_budget(month, cat, parent, amt, group_guess="")
     except Exception as e:
         LOG.exception("Budget sync failed: %s", e)
-    await reply_md(update, f"Budget set for *{cat}*{(' › '+parent) if parent else ''}: `{amt:,.2f}` in {current_month()}")
+    note = " — leftover rolls over into next month" if rolls else ""
+    await reply_md(update, f"Budget set for *{cat}*{(' › '+parent) if parent else ''}: `{fmt_minor(amt, DEFAULT_CURRENCY)}` in {current_month()}{note}")
 
 async def left_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from . import forecast  # NumPy stays out of cold start
     async with SessionLocal() as s:
         month = current_month()
-        res = await budget_left(s, month)
+        res = await budget_left(s, update.effective_user.id, month)
         if not res:
             await reply_md(update, "No budgets set. Use `/setbudget <Category> [;sub=Sub] <Amount>`")
             return
+        over = forecast.overshoots(await forecast.forecast_month(s, update.effective_user.id, dt.date.today()))
         lines = [f"*Left ({month})*"]
         for (cat, parent), (limit, spent, left) in sorted(res.items(), key=lambda kv: kv[1][2]):
             label = f"{cat}" + (f" › {parent}" if parent else "")
             warn = burn_rate_warning(dt.date.today(), limit, spent) if limit > 0 else ""
-            lines.append(f"- {label}: {limit - spent:,.2f}{warn}")
+            if (cat, parent) in over:
+                warn += f" 📈 on track for {fmt_minor(over[(cat, parent)][2], DEFAULT_CURRENCY)}"
+            lines.append(f"- {label}: {fmt_minor(limit - spent, DEFAULT_CURRENCY)}{warn}")
         await reply_md(update, "\n".join(lines))
 
+async def forecast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from . import forecast
+    today = dt.date.today()
+    async with SessionLocal() as s:
+        res = await forecast.forecast_month(s, update.effective_user.id, today)
+    if not res:
+        await reply_md(update, "No budgets set. Use `/setbudget <Category> [;sub=Sub] <Amount>`")
+        return
+    lines = [f"*Forecast ({current_month()})* — projected month-end spend"]
+    for (cat, parent), (limit, spent, projected) in sorted(res.items(), key=lambda kv: kv[1][0] - kv[1][2]):
+        label = f"{cat}" + (f" › {parent}" if parent else "")
+        flag = " 🔴 over" if limit > 0 and projected > limit else ""
+        lines.append(
+            f"- {label}: `{fmt_minor(projected, DEFAULT_CURRENCY)}` of `{fmt_minor(limit, DEFAULT_CURRENCY)}`"
+            f" (spent {fmt_minor(spent, DEFAULT_CURRENCY)}){flag}"
+        )
+    await reply_md(update, "\n".join(lines))
+
+async def whatif_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /whatif Food -20%, Fun +40, Rent budget=900
+    from . import whatif
+    usage = (
+        "Usage: `/whatif Food -20%` (cut the rest of the month), `/whatif Fun +40` (extra expense),\n"
+        "`/whatif Food budget=350` / `budget+50` / `budget-10%`, `/whatif * -10%` (all envelopes).\n"
+        "Combine with commas: `/whatif Food -20%, Fun +40`"
+    )
+    if not context.args:
+        await reply_md(update, usage)
+        return
+    try:
+        changes = whatif.parse_scenario(" ".join(context.args), DEFAULT_CURRENCY)
+    except ValueError as e:
+        await reply_md(update, f"{e}.\n{usage}")
+        return
+
+    # one snapshot per session, reused until the user's data changes
+    uid, today = update.effective_user.id, dt.date.today()
+    snap = context.user_data.get("whatif_snapshot")
+    if snap is None or snap.key != whatif.snapshot_key(uid, today):
+        async with SessionLocal() as s:
+            snap = await whatif.load_snapshot(s, uid, today)
+        context.user_data["whatif_snapshot"] = snap
+    if not snap.envelopes:
+        await reply_md(update, "No budgets set. Use `/setbudget <Category> [;sub=Sub] <Amount>`")
+        return
+    try:
+        envelopes, limit, spent, projected = whatif.apply(snap, changes)
+    except KeyError as e:
+        cat, parent = e.args[0]
+        await reply_md(update, f"No budget for *{cat}*{(' › '+parent) if parent else ''} this month.")
+        return
+
+    lines = [f"*What if ({snap.month})*: `{' '.join(context.args)}`"]
+    for i, (cat, parent) in enumerate(envelopes):
+        label = f"{cat}" + (f" › {parent}" if parent else "")
+        j = snap.index.get((cat, parent))
+        was = int(snap.limit[j] - snap.spent[j]) if j is not None else 0
+        left = int(limit[i] - spent[i])
+        delta = f" (was {fmt_minor(was, DEFAULT_CURRENCY)})" if left != was else ""
+        flag = " 🔴" if limit[i] > 0 and projected[i] > limit[i] else ""
+        lines.append(
+            f"- {label}: left `{fmt_minor(left, DEFAULT_CURRENCY)}`{delta}, month-end "
+            f"`{fmt_minor(int(projected[i]), DEFAULT_CURRENCY)}` of `{fmt_minor(int(limit[i]), DEFAULT_CURRENCY)}`{flag}"
+        )
+    base_total, new_total = int(snap.projected.sum()), int(projected.sum())
+    lines.append(
+        f"\nProjected month-end: `{fmt_minor(new_total, DEFAULT_CURRENCY)}` "
+        f"({'+' if new_total >= base_total else '−'}{fmt_minor(abs(new_total - base_total), DEFAULT_CURRENCY)}) "
+        f"vs budgets `{fmt_minor(int(limit.sum()), DEFAULT_CURRENCY)}`"
+    )
+    await reply_md(update, "\n".join(lines))
+
 async def weeklyleft_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     today = dt.date.today()
     start, end = week_range(today)
     async with SessionLocal() as s:
-        caps = await get_weekly_caps(s)
+        caps = await get_weekly_caps(s, update.effective_user.id)
         if not caps:
             await reply_md(update, "No weekly caps set. Use `/setweekly <Category> [;sub=Sub] <Amount>`")
             return
+        spent_now = await weekly_spent_all(s, update.effective_user.id, today)
         lines = [f"*Weekly Left* ({start} → {end})"]
         for c in caps:
-            spent = await weekly_spent(s, today, c.category, c.parent)
-            left = c.cap_amount - spent
+            spent = spent_now.get((c.category, c.parent or ""), 0)
+            left = c.cap_cents - spent
             label = f"{c.category}" + (f" › {c.parent}" if c.parent else "")
-            warn = " 🔴 cap hit" if left <= 0 else (" ⚠️ 80%+" if spent >= 0.8 * c.cap_amount and c.cap_amount > 0 else "")
-            lines.append(f"- {label}: {left:,.2f}{warn}")
+            warn = " 🔴 cap hit" if left <= 0 else (" ⚠️ 80%+" if spent * 5 >= 4 * c.cap_cents and c.cap_cents > 0 else "")
+            lines.append(f"- {label}: {fmt_minor(left, DEFAULT_CURRENCY)}{warn}")
         await reply_md(update, "\n".join(lines))
 
 async def setweekly_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -528,7 +652,7 @@ async def setweekly_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await reply_md(update, "Please end with the amount, e.g., `Food 60`")
         return
     cat_part, amt_part = parts
-    cap = float(amt_part)
+    cap = to_minor(amt_part, DEFAULT_CURRENCY)
     parent = None
     if ";sub=" in cat_part or ";g=" in cat_part:
         if ";sub=" in cat_part:
@@ -538,12 +662,13 @@ async def setweekly_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         cat = cat_part.strip()
     async with SessionLocal() as s:
-        await set_weekly_cap(s, cat, parent, cap)
+        await set_weekly_cap(s, update.effective_user.id, cat, parent, cap)
     try:
-        sheets_sync.upsert_weeklycap(cat, parent, cap)
+        if _mirrors_sheet(update):
+            _sheets().upsert_weeklycap(cat, parent, cap)
     except Exception as e:
         LOG.exception("WeeklyCap sync failed: %s", e)
-    await reply_md(update, f"Weekly cap set for *{cat}*{(' › '+parent) if parent else ''}: `{cap:,.2f}`")
+    await reply_md(update, f"Weekly cap set for *{cat}*{(' › '+parent) if parent else ''}: `{fmt_minor(cap, DEFAULT_CURRENCY)}`")
 
 # ------------------------------------------------------------------------------
 # Freeze commands synced to Sheets
@@ -554,7 +679,13 @@ async def freeze_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     sub = context.args[0].lower()
     if sub == "list":
-        await reply_md(update, "Use your Sheets 'Freezes' tab as source of truth. (Listing via DB not implemented here to keep it simple.)")
+        async with SessionLocal() as s:
+            frozen = await list_freezes(s, update.effective_user.id)
+        if not frozen:
+            await reply_md(update, "No active freezes.")
+            return
+        lines = ["*Frozen*"] + [f"- {f.category}" + (f" › {f.parent}" if f.parent else "") for f in frozen]
+        await reply_md(update, "\n".join(lines))
         return
     # parse cat;sub=
     cat_part = " ".join(context.args[1:]) if len(context.args) > 1 else ""
@@ -566,11 +697,15 @@ async def freeze_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cat, parent = [p.strip() for p in cat_part.split(";g=")]
     else:
         cat = cat_part.strip()
+    if not cat:
+        await reply_md(update, "Usage: `/freeze add Food;sub=DiningOut` | `/freeze off Food;sub=DiningOut` | `/freeze list`")
+        return
     active = True if sub == "add" else False
     async with SessionLocal() as s:
-        await set_freeze(s, cat, parent, active)
+        await set_freeze(s, update.effective_user.id, cat, parent, active)
     try:
-        sheets_sync.upsert_freeze(cat, parent, active)
+        if _mirrors_sheet(update):
+            _sheets().upsert_freeze(cat, parent, active)
     except Exception as e:
         LOG.exception("Freeze sync failed: %s", e)
     await reply_md(update, f"Freeze {'ON' if active else 'OFF'} for *{cat}*{(' › '+parent) if parent else ''}")
@@ -586,9 +721,12 @@ async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         today = dt.date.today()
         start = f"{today.year:04d}-{today.month:02d}-01"
         end = today.isoformat()
+    src = txn_source(start)
     async with SessionLocal() as s:
-        q = await s.execute(Txn.__table__.select().where(Txn.user_tg_id == update.effective_user.id))
+        q = await s.execute(src.select().where(src.c.user_tg_id == update.effective_user.id))
         rows = [dict(r) for r in q.mappings().all()]
+        if retention.is_closed(start):
+            rows = await retention.archived_rows(s, update.effective_user.id, start[:7], end[:7]) + rows
     rows = [r for r in rows if start <= str(r["occurred_at"]) <= end]
     output = io.StringIO()
     writer = csv.DictWriter(output, fieldnames=["Date", "Month", "Type", "Amount", "Currency", "Category", "Sub-Category", "Note"])
@@ -598,7 +736,7 @@ async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Date": r["occurred_at"],
             "Month": r["month"],
             "Type": r["type"],
-            "Amount": r["amount"],
+            "Amount": from_minor(r["amount_cents"], r["currency"]),
             "Currency": r["currency"],
             "Category": r["category"],
             "Sub-Category": r["parent"] or "",
@@ -607,14 +745,15 @@ async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_chat.send_document(document=output.getvalue().encode("utf-8"), filename="transactions.csv")
 
 async def export_excel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    src = txn_source()
     async with SessionLocal() as s:
-        q = await s.execute(Txn.__table__.select().where(Txn.user_tg_id == update.effective_user.id))
-        rows = [dict(r) for r in q.mappings().all()]
+        q = await s.execute(src.select().where(src.c.user_tg_id == update.effective_user.id))
+        rows = await retention.archived_rows(s, update.effective_user.id) + [dict(r) for r in q.mappings().all()]
     rows = [{
         "Date": r["occurred_at"].isoformat() if hasattr(r["occurred_at"], "isoformat") else str(r["occurred_at"]),
         "Month": r["month"],
         "Type": r["type"],
-        "Amount": r["amount"],
+        "Amount": from_minor(r["amount_cents"], r["currency"]),
         "Currency": r["currency"],
         "Category": r["category"],
         "Sub-Category": r["parent"] or "",
@@ -623,39 +762,155 @@ async def export_excel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     xbytes = to_excel_bytes(rows)
     await update.effective_chat.send_document(document=xbytes, filename="transactions.xlsx")
 
+async def rehydrate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /rehydrate YYYY-MM — compacted months (see app/retention.py) come back as live rows
+    month = context.args[0] if context.args else ""
+    if not re.fullmatch(r"\d{4}-\d{2}", month):
+        await reply_md(update, "Usage: `/rehydrate YYYY-MM`")
+        return
+    async with SessionLocal() as s:
+        n = await retention.rehydrate(s, update.effective_user.id, month)
+    if n is None:
+        await reply_md(update, f"Nothing compacted for {month}: its transactions are all live.")
+        return
+    await reply_md(update, f"Restored {n} transactions from {month}. They stay live for {retention.HOLD_DAYS} days.")
+
 # ------------------------------------------------------------------------------
 # History / Undo / Edit
 # ------------------------------------------------------------------------------
 async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /history [#Category[;sub=Sub]] [expense|income] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [month=YYYY-MM]
+    try:
+        f = history.parse_filters(context.args or [])
+    except ValueError as e:
+        await reply_md(update, f"{e}. Usage: `/history [#Food;sub=DiningOut] [expense|income] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [month=YYYY-MM]`")
+        return
+    views = context.user_data.setdefault("history", {})
+    vid = max(views, default=0) + 1
+    for old in sorted(views)[:-4]:  # keep the last few lists clickable
+        del views[old]
+    view = views[vid] = {"f": f, "cursor": None, "select": False, "selected": set()}
     async with SessionLocal() as s:
-        q = await s.execute(
-            Txn.__table__.select()
-            .where(Txn.user_tg_id == update.effective_user.id)
-            .order_by(Txn.id.desc())
-            .limit(10)
-        )
-        rows = [dict(r) for r in q.mappings().all()]
-    if not rows:
-        await reply_md(update, "No transactions yet.")
+        await _history_load(s, update.effective_user.id, view)
+    if not view["rows"]:
+        await reply_md(update, "No transactions" + (f" for {history.describe(f)}." if f else " yet."))
         return
-    lines = ["*Last 10*"]
+    text, markup = _history_render(vid, view)
+    await update.effective_chat.send_message(text, parse_mode="Markdown", reply_markup=markup)
+
+async def _history_load(s, user_id: int, view: dict):
+    view["rows"], view["older"], view["newer"] = await history.fetch_page(s, user_id, view["f"], view["cursor"])
+    if not view["rows"] and view["cursor"]:  # paged past the end (rows deleted meanwhile)
+        view["cursor"] = None
+        view["rows"], view["older"], view["newer"] = await history.fetch_page(s, user_id, view["f"])
+
+def _history_render(vid: int, view: dict):
+    rows, sel = view["rows"], view["selected"]
+    title = "*History*" + (f" — {history.describe(view['f'])}" if view["f"] else "")
+    if view["select"]:
+        title += f"\nTick rows to delete ({len(sel)} selected)"
+    lines = [title]
+    for r in rows:
+        mark = ("☑ " if r["id"] in sel else "☐ ") if view["select"] else ""
+        lines.append(mark + history.row_label(r) + (f" — _{r['note']}_" if r["note"] else ""))
     buttons = []
+    if view["select"]:
+        for r in rows:
+            mark = "☑" if r["id"] in sel else "☐"
+            buttons.append([InlineKeyboardButton(f"{mark} {history.row_label(r)}"[:64], callback_data=f"H:{vid}:T:{r['id']}")])
+    nav = []
+    if view["newer"]:
+        nav.append(InlineKeyboardButton("« Newer", callback_data=f"H:{vid}:P:{rows[0]['id']}"))
+    if view["older"]:
+        nav.append(InlineKeyboardButton("Older »", callback_data=f"H:{vid}:N:{rows[-1]['id']}"))
+    if nav:
+        buttons.append(nav)
+    if view["select"]:
+        buttons.append([
+            InlineKeyboardButton(f"🗑 Delete {len(sel)}", callback_data=f"H:{vid}:D"),
+            InlineKeyboardButton("Cancel", callback_data=f"H:{vid}:X"),
+        ])
+    else:
+        buttons.append([InlineKeyboardButton("🗑 Select to delete", callback_data=f"H:{vid}:S")])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+async def history_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    query = update.callback_query
+    uid = update.effective_user.id
+    _, vid, action, *arg = data.split(":")
+    view = context.user_data.get("history", {}).get(int(vid))
+    if view is None:
+        await query.edit_message_text("This list has expired — run /history again.")
+        return
+    deleted = []
+    if action in ("N", "P"):
+        view["cursor"] = (action, int(arg[0]))
+    elif action == "S":
+        view["select"] = True
+    elif action == "X":
+        view["select"], view["selected"] = False, set()
+    elif action == "T":
+        view["selected"] ^= {int(arg[0])}
+        text, markup = _history_render(int(vid), view)
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=markup)
+        return
+    elif action == "D" and view["selected"]:
+        # one DELETE ... WHERE id IN (...) per table; counters and Sheets in one batch each
+        async with SessionLocal() as s:
+            deleted = await ledger.delete_txns(s, uid, view["selected"])
+            await s.commit()
+        view["select"], view["selected"] = False, set()
+        if deleted and SHEETS_ENABLED:
+            _sheets().queue_delete(r["id"] for r in deleted)
+    async with SessionLocal() as s:
+        await _history_load(s, uid, view)
+    if not view["rows"]:
+        await query.edit_message_text(f"Deleted {len(deleted)} transaction(s) ✅ — nothing left to show." if deleted else "No transactions.")
+        return
+    text, markup = _history_render(int(vid), view)
+    if deleted:
+        text = f"Deleted {len(deleted)} transaction(s) ✅\n\n" + text
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=markup)
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /search costco [2026-03..2026-04] [#Food] [expense|income] [from=..] [to=..]
+    terms, f = search.parse_query(context.args or [])
+    if not terms:
+        await reply_md(update, "Usage: `/search costco [2026-03-01..2026-03-31] [#Food] [expense|income]` (`cost*` for prefixes)")
+        return
+    views = context.user_data.setdefault("search", {})
+    vid = max(views, default=0) + 1
+    for old in sorted(views)[:-4]:
+        del views[old]
+    views[vid] = {"terms": terms, "f": f}
+    text, markup = await _search_page(update.effective_user.id, views[vid], vid, 0)
+    await update.effective_chat.send_message(text, parse_mode="Markdown", reply_markup=markup)
+
+async def _search_page(user_id: int, view: dict, vid: int, page: int):
+    async with SessionLocal() as s:
+        rows, totals, more = await search.search(s, user_id, view["terms"], view["f"], page)
+    what = " ".join(view["terms"]) + (f" — {history.describe(view['f'])}" if view["f"] else "")
+    if not rows:
+        return f"No matches for `{what}`.", None
+    n = sum(c for c, _ in totals.values())
+    summary = ", ".join(f"{t} `{fmt_minor(amt, DEFAULT_CURRENCY)}` ({c})" for t, (c, amt) in sorted(totals.items()))
+    lines = [f"*Search* `{what}` — {n} match{'es' if n != 1 else ''}", summary, ""]
     for r in rows:
-        label = (
-            f"#{r['id']} {r['occurred_at']} {r['type']} {r['amount']:,.2f} {r['category']}"
-            + (f" › {r['parent']}" if r['parent'] else "")
-            + (f" — _{r['note'] or ''}_" if r['note'] else "")
-        )
-        lines.append(label)
-        buttons.append([InlineKeyboardButton(f"Delete #{r['id']}", callback_data=f"DEL:{r['id']}")])
-    await update.effective_chat.send_message("\n".join(lines), parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(buttons))
+        lines.append(history.row_label(r) + (f" — _{r['note']}_" if r["note"] else ""))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("« Better", callback_data=f"Q:{vid}:{page - 1}"))
+    if more:
+        nav.append(InlineKeyboardButton("More »", callback_data=f"Q:{vid}:{page + 1}"))
+    return "\n".join(lines), (InlineKeyboardMarkup([nav]) if nav else None)
 
 async def undo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    src = txn_source()
     async with SessionLocal() as s:
         q = await s.execute(
-            Txn.__table__.select()
-            .where(Txn.user_tg_id == update.effective_user.id)
-            .order_by(Txn.id.desc())
+            src.select()
+            .where(src.c.user_tg_id == update.effective_user.id)
+            .order_by(src.c.id.desc())
             .limit(1)
         )
         r = q.mappings().first()
@@ -663,39 +918,47 @@ async def undo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await reply_md(update, "Nothing to undo.")
             return
         tid = r["id"]
-        await s.execute(Txn.__table__.delete().where(Txn.id == tid))
+        if not await idempotency.claim(s, update):
+            return
+        await ledger.delete_txns(s, update.effective_user.id, [tid])
         await s.commit()
+    if SHEETS_ENABLED:
+        _sheets().queue_delete([tid])
     await reply_md(update, f"Undid transaction #{tid} ✅")
 
 async def edit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await reply_md(update, 'Usage: `/edit <id> [amount=..] [note="..."] [#Category] [;sub=Sub]`')
+        await reply_md(update, 'Usage: `/edit <id> [amount=..] [note="..."] [#Category] [;sub=Sub] [on=YYYY-MM-DD]`')
         return
     tid = int(context.args[0])
     rest = " ".join(context.args[1:])
     m_amt = re.search(r"amount=([0-9]+(?:\.[0-9]{1,2})?)", rest)
     m_note = re.search(r'note="([^"]*)"', rest)
-    try:
-        parsed = parse_message("0 " + rest)
-        cat, sub = parsed["categories"][0]
-    except Exception:
-        cat = None; sub = None
+    m_on = re.search(r"\bon=(\d{4}-\d{2}-\d{2})\b", rest)
+    cat = None; sub = None
+    if "#" in rest:  # without a tag parse_message falls back to Uncategorized
+        try:
+            parsed = parse_message("0 " + rest, DEFAULT_CURRENCY)
+            cat, sub = parsed["categories"][0]
+        except Exception:
+            pass
     async with SessionLocal() as s:
         updates = {}
-        if m_amt: updates["amount"] = float(m_amt.group(1))
+        if m_amt: updates["amount_cents"] = to_minor(m_amt.group(1), DEFAULT_CURRENCY)
         if m_note: updates["note"] = m_note.group(1)
+        if m_on: updates["occurred_at"] = date.fromisoformat(m_on.group(1))
         if cat: updates["category"] = cat
         if sub is not None: updates["parent"] = sub
         if not updates:
             await reply_md(update, "No changes parsed.")
             return
-        await s.execute(
-            Txn.__table__
-            .update()
-            .where(Txn.id == tid, Txn.user_tg_id == update.effective_user.id)
-            .values(**updates)
-        )
+        new = await ledger.update_txn(s, update.effective_user.id, tid, **updates)
         await s.commit()
+    if new is None:
+        await reply_md(update, f"Transaction #{tid} not found.")
+        return
+    if SHEETS_ENABLED:
+        _sheets().queue_upsert([new])
     await reply_md(update, f"Updated transaction #{tid} ✅")
 
 # ------------------------------------------------------------------------------
@@ -703,92 +966,165 @@ async def edit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------------------------------------------------------------------
 async def handle_free_text(update: Update, context: ContextTypes.DEFAULT_TYPE, forced_text: Optional[str] = None, bypass_caps: bool = False):
     raw = forced_text if forced_text is not None else (update.message.text or "").strip()
-    # Apply shorthand/aliases/default category
-    text = await apply_shorthand(raw, update.effective_user.id)
+    await log_entries(context, [(update, raw)], forced=forced_text is not None, bypass_caps=bypass_caps)
 
-    try:
-        parsed = parse_message(text)
-    except Exception as e:
-        await reply_md(update, f"⚠️ {e}")
+async def log_entries(context: ContextTypes.DEFAULT_TYPE, items: list, forced: bool = False, bypass_caps: bool = False):
+    """
+    Log entries [(update, text)] of one user in one transaction and answer them
+    with one reply (to the last). More than one: entries held back by
+    app.admission; each is checked, claimed and warned about as if on its own.
+    """
+    update = items[-1][0]
+    user_id = update.effective_user.id
+    batch = len(items) > 1
+    head = [f"Caught up on {len(items)} messages sent in quick succession:"] if batch else []
+    entries, msgs = [], []
+    for u, raw in items:
+        # Apply shorthand/aliases/default category
+        text = await apply_shorthand(raw, user_id)
+        try:
+            parsed = parse_message(text, DEFAULT_CURRENCY)
+        except Exception as e:
+            msgs.append(f"⚠️ `{raw}`: {e}" if batch else f"⚠️ {e}")
+            continue
+        entries.append((u, raw, parsed, split_minor(parsed["amount_cents"], len(parsed["categories"]))))
+    if not entries:
+        await reply_md(update, "\n".join(head + msgs))
         return
 
-    cats = parsed["categories"]
-    n = len(cats)
-    amounts = [parsed["amount"] / n] * n
-    msgs = []
-    today = parsed["date"]
-    month = f"{today.year:04d}-{today.month:02d}"
-    rows_for_sheet = []
-
     async with SessionLocal() as s:
-        await ensure_user(update.effective_user.id, update.effective_user.full_name, update.effective_chat.id)
-
-        # Weekly caps (soft)
-        if not bypass_caps and parsed["type"] == "Expense":
-            for idx, (cat, sub) in enumerate(cats):
-                cap = await get_weekly_cap(s, cat, sub)
-                if cap and cap.cap_amount > 0:
-                    spent = await weekly_spent(s, today, cat, sub)
-                    new_total = spent + amounts[idx]
-                    if new_total >= cap.cap_amount:
-                        await reply_md(update, f"🔒 Weekly cap for *{cat}*{(' › '+sub) if sub else ''} will be exceeded. Use `/override {raw}` to log anyway.")
-                        return
-                    elif new_total >= 0.8 * cap.cap_amount:
-                        msgs.append(f"⚠️ Weekly 80% reached for *{cat}*{(' › '+sub) if sub else ''}.")
+        await ensure_user(user_id, update.effective_user.full_name, update.effective_chat.id)
+
+        # Freezes, then weekly caps (soft); a batch's earlier entries count toward the cap
+        kept, pending = [], {}
+        for u, raw, parsed, amounts in entries:
+            cats, today = parsed["categories"], parsed["date"]
+            notes, stop = [], None
+            if not bypass_caps and parsed["type"] == "Expense":
+                for cat, sub in cats:
+                    hit = await frozen_by(s, user_id, cat, sub)
+                    if hit:
+                        lift = f"/freeze off {hit[0]}" + (f";sub={hit[1]}" if hit[1] else "")
+                        stop = f"🧊 *{hit[0]}*{(' › '+hit[1]) if hit[1] else ''} is frozen. Use `/override {raw}` to log anyway, or `{lift}` to lift it."
+                        break
+                for idx, (cat, sub) in enumerate(cats):
+                    if stop:
+                        break
+                    cap = await get_weekly_cap(s, user_id, cat, sub)
+                    if cap and cap.cap_cents > 0:
+                        key = (week_range(today)[0], cat, sub or "")
+                        spent = await weekly_spent(s, user_id, today, cat, sub) + pending.get(key, 0)
+                        new_total = spent + amounts[idx]
+                        if new_total >= cap.cap_cents:
+                            stop = f"🔒 Weekly cap for *{cat}*{(' › '+sub) if sub else ''} will be exceeded. Use `/override {raw}` to log anyway."
+                        elif new_total * 5 >= 4 * cap.cap_cents:
+                            notes.append(f"⚠️ Weekly 80% reached for *{cat}*{(' › '+sub) if sub else ''}.")
+            if stop:
+                msgs.append(stop)
+                continue
+            if not await idempotency.claim(s, u, forced=forced):
+                continue
+            if parsed["type"] == "Expense":
+                for idx, (cat, sub) in enumerate(cats):
+                    key = (week_range(today)[0], cat, sub or "")
+                    pending[key] = pending.get(key, 0) + amounts[idx]
+            msgs.extend(notes)
+            kept.append((raw, parsed, amounts))
 
         # Insert and queue
-        for idx, (cat, sub) in enumerate(cats):
-            t = Txn(
-                user_tg_id=update.effective_user.id,
-                occurred_at=today,
-                month=month,
-                type=parsed["type"],
-                amount=float(amounts[idx]),
-                currency=os.getenv("CURRENCY", "USD"),
-                category=cat,
-                parent=sub,
-                note=parsed["note"],
-            )
-            s.add(t)
-            rows_for_sheet.append({
-                "Date": today.isoformat(),
-                "Month": month,
-                "Type": parsed["type"],
-                "Amount": float(amounts[idx]),
-                "Currency": os.getenv("CURRENCY", "USD"),
-                "Category": cat,
-                "Sub-Category": sub or "",
-                "Note": parsed["note"] or ""
-            })
+        logged = []  # (txn, parsed, unusual)
+        for raw, parsed, amounts in kept:
+            today = parsed["date"]
+            for idx, (cat, sub) in enumerate(parsed["categories"]):
+                t = Txn(
+                    user_tg_id=user_id,
+                    occurred_at=today,
+                    month=f"{today.year:04d}-{today.month:02d}",
+                    type=parsed["type"],
+                    amount_cents=amounts[idx],
+                    currency=os.getenv("CURRENCY", "USD"),
+                    category=cat,
+                    parent=sub,
+                    note=parsed["note"],
+                )
+                # judged against the envelope's norm before this entry joins it
+                hit = await anomaly.check(s, user_id, cat, sub, amounts[idx], today) if parsed["type"] == "Expense" else None
+                logged.append((t, parsed, hit))
+        new_txns = [t for t, _p, _h in logged]
+        if not new_txns:
+            if msgs:  # nothing to say when every entry was already handled
+                await reply_md(update, "\n".join(head + msgs))
+            return
+        await ledger.add_txns(s, new_txns)
         await s.commit()
+        if SHEETS_ENABLED:
+            _sheets().queue_upsert([ledger.row_dict(t) for t in new_txns])
 
         # Envelope warnings
-        for idx, (cat, sub) in enumerate(cats):
-            if parsed["type"] != "Expense":
-                continue
-            q = await s.execute(Budget.__table__.select().where(Budget.month == month, Budget.category == cat, Budget.parent == sub))
-            r = q.mappings().first()
-            warn = ""
-            if r and r["limit_amount"] > 0:
-                spent = await spent_by(s, month, cat, sub)
-                ratio = spent / r["limit_amount"] if r["limit_amount"] else 0
-                if ratio >= 1.0:
-                    warn = " 🔴 *Budget hit!* Consider a short freeze."
-                elif ratio >= 0.8:
-                    warn = " ⚠️ *80% reached.*"
-                warn2 = burn_rate_warning(today, r["limit_amount"], spent)
-            else:
-                warn2 = ""
-            label = f"{cat}" + (f" › {sub}" if sub else "")
-            msgs.append(f"Logged `{amounts[idx]:,.2f}` {parsed['type']} — *{label}*  _{parsed['note'] or ''}_\n{warn}{warn2}")
-
-    # Sheets sync (best-effort)
-    try:
-        sheets_sync.append_transactions(rows_for_sheet)
-    except Exception as e:
-        LOG.exception("Sheets append failed: %s", e)
+        carries = {}
+        for t, parsed, hit in logged:
+            warn = warn2 = ""
+            if t.type == "Expense":
+                if t.month not in carries:
+                    carries[t.month] = await carry_in(s, user_id, t.month)
+                b = await get_budget(s, user_id, t.month, t.category, t.parent)
+                limit = b.limit_cents + carries[t.month].get((t.category, t.parent or ""), 0) if b else 0
+                if limit > 0:
+                    spent = await spent_by(s, user_id, t.month, t.category, t.parent)
+                    if spent >= limit:
+                        warn = " 🔴 *Budget hit!* Consider a short freeze."
+                    elif spent * 5 >= 4 * limit:
+                        warn = " ⚠️ *80% reached.*"
+                    warn2 = burn_rate_warning(t.occurred_at, limit, spent)
+            label = f"{t.category}" + (f" › {t.parent}" if t.parent else "")
+            if hit:
+                warn2 += f"\n📈 Unusual for *{label}*: {hit['z']:.1f}σ above your usual `{fmt_minor(round(hit['mean']), DEFAULT_CURRENCY)}`."
+            line = f"Logged `{fmt_minor(t.amount_cents, DEFAULT_CURRENCY)}` {t.type} — *{label}*  _{parsed['note'] or ''}_\n{warn}{warn2}"
+            msgs.append(line.rstrip() if batch else line)
+
+    # no tag typed: offer the user's usual categories as one-tap corrections
+    markup = None
+    if not batch and "#" not in items[0][1] and len(new_txns) == 1:
+        markup = await _quick_pick(context, user_id, new_txns[0].id, kept[0][1]["categories"][0])
+    await reply_md(update, "\n".join(head + msgs), reply_markup=markup)
+
+async def _quick_pick(context, user_id: int, tid: int, current: tuple):
+    picks = [k for k in await mru.top_categories(user_id, mru.QUICK_PICKS + 1) if k != tuple(current)][:mru.QUICK_PICKS]
+    if not picks:
+        return None
+    # callback data is capped at 64 bytes, so buttons carry an index into the stored picks
+    views = context.user_data.setdefault("quickpick", {})
+    views[tid] = picks
+    for old in sorted(views)[:-5]:
+        del views[old]
+    buttons = [
+        InlineKeyboardButton(c + (f" › {p}" if p else ""), callback_data=f"CAT:{tid}:{i}")
+        for i, (c, p) in enumerate(picks)
+    ]
+    return InlineKeyboardMarkup([buttons[i:i + 3] for i in range(0, len(buttons), 3)])
 
-    await reply_md(update, "\n".join(msgs))
+async def quick_pick_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    query = update.callback_query
+    _, tid, i = data.split(":")
+    picks = context.user_data.get("quickpick", {}).get(int(tid))
+    if not picks:
+        await query.edit_message_reply_markup(None)
+        return
+    cat, sub = picks[int(i)]
+    async with SessionLocal() as s:
+        new = await ledger.update_txn(s, update.effective_user.id, int(tid), category=cat, parent=sub)
+        await s.commit()
+    if new is None:
+        await query.edit_message_text(f"Transaction #{tid} no longer exists.")
+        return
+    if SHEETS_ENABLED:
+        _sheets().queue_upsert([new])
+    context.user_data["quickpick"].pop(int(tid), None)
+    label = cat + (f" › {sub}" if sub else "")
+    await query.edit_message_text(
+        f"Logged `{fmt_minor(new['amount_cents'], new['currency'])}` {new['type']} — *{label}*  _{new['note'] or ''}_",
+        parse_mode="Markdown",
+    )
 
 async def override_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -798,18 +1134,357 @@ async def override_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await handle_free_text(update, context, msg, bypass_caps=True)
 
 # ------------------------------------------------------------------------------
-# PDF report
+# Trends & PDF report
 # ------------------------------------------------------------------------------
+async def trends_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /trends [months] [#Category[;sub=Sub]]
+    usage = f"Usage: `/trends [months] [#Category;sub=Sub]`, e.g. `/trends 12 #Food` (1–{trends.MAX_MONTHS} months)"
+    n, f = trends.DEFAULT_MONTHS, {}
+    for a in context.args or []:
+        if a.isdigit():
+            n = int(a)
+            continue
+        try:
+            f.update(history.parse_filters([a]))
+        except ValueError:
+            f = None
+            break
+    if f is None or set(f) - {"category", "parent"} or not 1 <= n <= trends.MAX_MONTHS:
+        await reply_md(update, usage)
+        return
+    async with SessionLocal() as s:
+        c = await trends.chart(s, update.effective_user.id, dt.date.today(), n, f.get("category"), f.get("parent"), DEFAULT_CURRENCY)
+    if c["file_id"]:
+        try:
+            await update.effective_chat.send_photo(photo=c["file_id"], caption=c["caption"])
+            return
+        except BadRequest as e:
+            LOG.warning("Cached chart file_id rejected (%s); uploading again.", e)
+    msg = await update.effective_chat.send_photo(photo=c["png"], caption=c["caption"])
+    if msg.photo:
+        c["file_id"] = msg.photo[-1].file_id
+
 async def report_pdf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from .reports import build_weekly_pdf
     month = current_month()
-    pdf_bytes = await build_weekly_pdf(month)
+    async with SessionLocal() as s:
+        chart = await trends.chart(s, update.effective_user.id, dt.date.today(), currency=DEFAULT_CURRENCY)
+    pdf_bytes = await build_weekly_pdf(update.effective_user.id, month, chart_png=chart["png"])
     await update.effective_chat.send_document(document=pdf_bytes, filename=f"weekly_report_{month}.pdf")
-    if REPORT_EMAIL_TO and os.getenv("SENDGRID_API_KEY", "").strip():
+    if EMAIL_ENABLED and update.effective_user.id == OWNER_ID:
         try:
+            from .emailer import send_email_with_pdf
             send_email_with_pdf(REPORT_EMAIL_TO, f"BudgetBot Weekly Report — {month}", "<p>Attached is your weekly report.</p>", pdf_bytes, filename=f"weekly_report_{month}.pdf")
         except Exception as e:
             LOG.exception("Email send failed: %s", e)
 
+# ------------------------------------------------------------------------------
+# Admin: slow query log, statistics backfill, admission counters
+# ------------------------------------------------------------------------------
+async def slowqueries_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /slowqueries [N] | /slowqueries reset
+    if not is_admin(update):
+        return
+    if not profiler.ENABLED:
+        await reply_md(update, "Query profiler is off. Set `QUERY_PROFILER=1` (threshold `SLOW_QUERY_MS`).")
+        return
+    if context.args and context.args[0].lower() == "reset":
+        profiler.reset()
+        await reply_md(update, "Slow query log cleared ✅")
+        return
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else profiler.TOP_N
+    rows = profiler.top_slow(n)
+    if not rows:
+        await reply_md(update, f"No statements over {profiler.SLOW_QUERY_MS:.0f} ms yet.")
+        return
+    lines = [f"Slowest queries (>{profiler.SLOW_QUERY_MS:.0f} ms, rolling window)"]
+    for i, (fp, count, max_ms, avg_ms, handlers, plan) in enumerate(rows, start=1):
+        lines.append(f"\n{i}. max {max_ms:,.0f} ms, avg {avg_ms:,.0f} ms, x{count} — {', '.join(handlers)}")
+        lines.append(textwrap.shorten(fp, width=300, placeholder=" …"))
+        if plan:
+            lines.append("plan: " + textwrap.shorten(plan.replace("\n", " | "), width=300, placeholder=" …"))
+    # plain text: SQL is full of Markdown metacharacters
+    await update.effective_chat.send_message("\n".join(lines)[:4000])
+
+async def backfill_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /backfill_stats — rebuild the per-envelope expense statistics behind unusual-amount flags
+    if not is_admin(update):
+        return
+    async with SessionLocal() as s:
+        n = await anomaly.backfill(s)
+    await reply_md(update, f"Expense statistics rebuilt for {n} envelopes ✅")
+
+async def admission_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /admission | /admission reset — per-user rate limiting counters since start (or reset)
+    if not is_admin(update):
+        return
+    if admission.RATE <= 0:
+        await reply_md(update, "Admission control is off. Set `ADMISSION_RATE` (per second) to turn it on.")
+        return
+    if context.args and context.args[0].lower() == "reset":
+        admission.reset()
+        await reply_md(update, "Admission counters cleared ✅")
+        return
+    c = admission.COUNTS
+    lines = [
+        f"Admission: {admission.RATE:g}/s per user, bursts of {admission.BURST}; "
+        f"exports & reports {admission.HEAVY_RATE * 60:g}/min, bursts of {admission.HEAVY_BURST}",
+    ]
+    for cls in ("default", "heavy"):
+        lines.append(f"{cls}: admitted {c['admitted', cls]}, throttled {c['throttled', cls]}")
+    lines.append(f"entries held {c['held', 'default']}, logged in batches {c['merged', 'default']}, "
+                 f"dropped with a cooldown reply {c['dropped', 'default'] + c['dropped', 'heavy']}")
+    top = admission.THROTTLED_USERS.most_common(5)
+    if top:
+        lines.append("most throttled: " + ", ".join(f"{uid} ({n})" for uid, n in top))
+    await update.effective_chat.send_message("\n".join(lines))
+
+# Per-user rate limits (registered ahead of every handler in main)
+GATE = admission.Gate(log_entries) if admission.RATE > 0 else None
+
+async def _flush_held(app):
+    # stopping: log what the gate holds rather than leave it for the next start
+    if GATE is not None:
+        await GATE.flush_all(app)
+
+# ------------------------------------------------------------------------------
+# Goals & month-end sweep
+# ------------------------------------------------------------------------------
+def _split_trailing_amounts(args: list[str], n_max: int) -> tuple[str, list[int]]:
+    """'Emergency fund 1200 100' -> ('Emergency fund', [120000, 10000])."""
+    amounts = []
+    while args and len(amounts) < n_max and re.fullmatch(r"\d+(?:\.\d{1,2})?", args[-1]):
+        amounts.insert(0, to_minor(args[-1], DEFAULT_CURRENCY))
+        args = args[:-1]
+    return " ".join(args).strip(), amounts
+
+async def goal_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    usage = "Usage: `/goal add <Name> <Target> [Monthly]`, `/goal list`, `/goal contribute <Name> <Amount>`"
+    uid = update.effective_user.id
+    sub = context.args[0].lower() if context.args else "list"
+    if sub == "add":
+        name, amounts = _split_trailing_amounts(context.args[1:], 2)
+        if not name or not amounts:
+            await reply_md(update, usage)
+            return
+        target, monthly = amounts[0], (amounts[1] if len(amounts) > 1 else 0)
+        async with SessionLocal() as s:
+            await goals.add_goal(s, uid, name, target, monthly)
+        per_month = f", `{fmt_minor(monthly, DEFAULT_CURRENCY)}`/month from leftovers" if monthly else ""
+        await reply_md(update, f"🎯 Goal *{name}*: `{fmt_minor(target, DEFAULT_CURRENCY)}`{per_month}")
+    elif sub == "list":
+        async with SessionLocal() as s:
+            rows = await goals.list_goals(s, uid)
+        if not rows:
+            await reply_md(update, "No goals yet. " + usage)
+            return
+        lines = ["*Goals*"]
+        for g in rows:
+            pct = int(g.balance_cents * 100 / g.target_cents) if g.target_cents else 0
+            per_month = f" · {fmt_minor(g.monthly_cents, DEFAULT_CURRENCY)}/month" if g.monthly_cents else ""
+            lines.append(
+                f"- {g.name}: `{fmt_minor(g.balance_cents, DEFAULT_CURRENCY)}` of "
+                f"`{fmt_minor(g.target_cents, DEFAULT_CURRENCY)}` ({pct}%){per_month}"
+            )
+        await reply_md(update, "\n".join(lines))
+    elif sub == "contribute":
+        name, amounts = _split_trailing_amounts(context.args[1:], 1)
+        if not name or not amounts:
+            await reply_md(update, usage)
+            return
+        async with SessionLocal() as s:
+            if not await idempotency.claim(s, update):
+                return
+            g = await goals.contribute(s, uid, name, amounts[0])
+        if g is None:
+            await reply_md(update, f"No goal named *{name}*. See `/goal list`.")
+            return
+        await reply_md(update, f"Added `{fmt_minor(amounts[0], DEFAULT_CURRENCY)}` to *{g.name}* → `{fmt_minor(g.balance_cents, DEFAULT_CURRENCY)}` of `{fmt_minor(g.target_cents, DEFAULT_CURRENCY)}`")
+    else:
+        await reply_md(update, usage)
+
+async def sweep_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # same statement as the month-end job, restricted to this user
+    uid, month = update.effective_user.id, current_month()
+    async with SessionLocal() as s:
+        await goals.sweep_month(s, month, uid)
+        items = (await goals.pending_sweeps(s, month, uid)).get(uid)
+    if not items:
+        await reply_md(update, "Nothing to sweep: no leftover budget, or no goal with a monthly amount (`/goal add <Name> <Target> <Monthly>`).")
+        return
+    await update.effective_chat.send_message(
+        goals.sweep_text(month, items, DEFAULT_CURRENCY), parse_mode="Markdown", reply_markup=goals.sweep_keyboard(month)
+    )
+
+# ------------------------------------------------------------------------------
+# Templates & recurring
+# ------------------------------------------------------------------------------
+def _command_names(application) -> set[str]:
+    return {c for hs in application.handlers.values() for h in hs if isinstance(h, CommandHandler) for c in h.commands}
+
+async def template_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    usage = "Usage: `/template add lunch 12 #Food;sub=DiningOut`, `/template list`, `/template del lunch`"
+    uid = update.effective_user.id
+    sub = context.args[0].lower() if context.args else "list"
+    if sub == "add" and len(context.args) >= 3:
+        name, body = context.args[1].lower().lstrip("/"), " ".join(context.args[2:])
+        if not templates.NAME_RE.match(name):
+            await reply_md(update, "Template names are 1–32 characters: `a-z`, `0-9` and `_`.")
+            return
+        if name in _command_names(context.application):
+            await reply_md(update, f"`/{name}` is already a command — pick another name.")
+            return
+        if not AMOUNT_RE.search(body):
+            await reply_md(update, "The template needs an amount, e.g. `12 #Food;sub=DiningOut`.")
+            return
+        async with SessionLocal() as s:
+            await templates.add(s, uid, name, body)
+        await reply_md(update, f"Saved `/{name}` → `{body}`")
+    elif sub == "list":
+        mine = templates.for_user(uid)
+        if not mine:
+            await reply_md(update, "No templates yet. " + usage)
+            return
+        await reply_md(update, "*Templates*\n" + "\n".join(f"- /{n} → `{t}`" for n, t in sorted(mine.items())))
+    elif sub in ("del", "delete", "rm") and len(context.args) == 2:
+        async with SessionLocal() as s:
+            gone = await templates.remove(s, uid, context.args[1].lstrip("/"))
+        await reply_md(update, "Template removed ✅" if gone else "No such template.")
+    else:
+        await reply_md(update, usage)
+
+async def template_dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # any /command no other handler claimed: resolve it from the in-memory templates
+    if not update.message or not update.message.text:
+        return
+    head, *rest = update.message.text.split()
+    body = templates.lookup(update.effective_user.id, head[1:].split("@")[0])
+    if body is None:
+        return
+    if rest and re.fullmatch(r"\d+(?:[.,]\d{1,2})?", rest[0]):
+        # /lunch 15 → same template, different amount (keeps a leading +/-)
+        m = AMOUNT_RE.search(body)
+        sign = m.group(2)[0] if m.group(2)[0] in "+-" else ""
+        body = body[:m.start(2)] + sign + rest.pop(0) + body[m.end(2):]
+    if rest:
+        body += " " + " ".join(rest)
+    await handle_free_text(update, context, forced_text=body)
+
+async def recurring_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    usage = (
+        "Usage: `/recurring add monthly 1200 rent #Housing [on=YYYY-MM-DD]` "
+        "(daily|weekly|monthly|yearly), `/recurring list`, `/recurring stop <id>`"
+    )
+    uid = update.effective_user.id
+    sub = context.args[0].lower() if context.args else "list"
+    if sub == "add" and len(context.args) >= 3 and context.args[1].lower() in recurring.EVERY:
+        every = context.args[1].lower()
+        text = await apply_shorthand(" ".join(context.args[2:]), uid)
+        try:
+            parsed = parse_message(text, DEFAULT_CURRENCY)
+        except Exception as e:
+            await reply_md(update, f"⚠️ {e}")
+            return
+        today = dt.date.today()
+        async with SessionLocal() as s:
+            if not await idempotency.claim(s, update):
+                return
+            r = await recurring.add_schedule(s, uid, every, parsed["date"], parsed, DEFAULT_CURRENCY)
+            posted = await recurring.post_due(s, today, uid) if r.next_due <= today else []
+        cat, parent = parsed["categories"][0]
+        label = f"{cat}" + (f" › {parent}" if parent else "")
+        msg = f"🔁 #{r.id}: `{fmt_minor(r.amount_cents, DEFAULT_CURRENCY)}` {r.type} *{label}* {every}, from {r.next_due}"
+        if posted:
+            msg += f"\nPosted {len(posted)} occurrence(s) due so far."
+        await reply_md(update, msg)
+    elif sub == "list":
+        async with SessionLocal() as s:
+            rows = await recurring.list_schedules(s, uid)
+        if not rows:
+            await reply_md(update, "No recurring items. " + usage)
+            return
+        lines = ["*Recurring*"]
+        for r in rows:
+            label = f"{r.category}" + (f" › {r.parent}" if r.parent else "")
+            lines.append(f"#{r.id} {r.every} `{fmt_minor(r.amount_cents, r.currency)}` {r.type} *{label}* — next {r.next_due}")
+        await reply_md(update, "\n".join(lines))
+    elif sub == "stop" and len(context.args) == 2 and context.args[1].lstrip("#").isdigit():
+        async with SessionLocal() as s:
+            ok = await recurring.stop_schedule(s, uid, int(context.args[1].lstrip("#")))
+        await reply_md(update, "Stopped ✅" if ok else "No such recurring item.")
+    else:
+        await reply_md(update, usage)
+
+async def recurring_job(context: ContextTypes.DEFAULT_TYPE):
+    async with SessionLocal() as s:
+        posted = await recurring.post_due(s, dt.date.today())
+        if not posted:
+            return
+        uids = {t.user_tg_id for t in posted}
+        q = await s.execute(User.__table__.select().where(User.tg_id.in_(uids)))
+        chats = {r["tg_id"]: r["last_chat_id"] for r in q.mappings().all()}
+    LOG.info("Posted %s recurring txns for %s users", len(posted), len(uids))
+    if SHEETS_ENABLED:
+        _sheets().queue_upsert([ledger.row_dict(t) for t in posted])
+    by_user = defaultdict(list)
+    for t in posted:
+        by_user[t.user_tg_id].append(t)
+    for uid, txns in by_user.items():
+        if not chats.get(uid):
+            continue
+        lines = ["🔁 Posted recurring:"]
+        for t in txns:
+            label = f"{t.category}" + (f" › {t.parent}" if t.parent else "")
+            lines.append(f"- `{fmt_minor(t.amount_cents, t.currency)}` *{label}* on {t.occurred_at}")
+        try:
+            await context.bot.send_message(chats[uid], "\n".join(lines), parse_mode="Markdown")
+        except Exception as e:
+            LOG.warning("Recurring notice to %s failed: %s", uid, e)
+
+# ------------------------------------------------------------------------------
+# Sheets Transactions tab: queued changes go out in one batch per flush
+# ------------------------------------------------------------------------------
+def _sheets_turn():
+    # several workers share the tab: one flush/reconcile at a time, cluster-wide
+    if cluster.ROLE == "single":
+        return contextlib.nullcontext(True)
+    return cluster.exclusive(cluster.MUTEX_SHEETS)
+
+async def sheets_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    sheets = _sheets()
+    try:
+        if await asyncio.to_thread(sheets.needs_reconcile):
+            await sheets_reconcile_job(context)
+            return
+    except Exception as e:
+        LOG.warning("Sheets header check failed: %s", e)
+        return
+    async with _sheets_turn() as mine:
+        if not mine:
+            return
+        if cluster.ROLE != "single":
+            sheets.forget_index()  # other workers have written rows since
+        await asyncio.to_thread(sheets.flush)
+
+async def sheets_reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    sheets = _sheets()
+    src = txn_source()
+    async with _sheets_turn() as mine:
+        if not mine:
+            return
+        # the DB read below covers everything queued so far
+        sheets.drop_pending()
+        async with SessionLocal() as s:
+            # only the cell values are kept, not every txn's full row
+            res = await s.stream(src.select().order_by(src.c.id).execution_options(yield_per=5000))
+            rows = [sheets.txn_values(r) async for r in res.mappings()]
+        try:
+            n = await asyncio.to_thread(sheets.reconcile, rows)
+            if n:
+                LOG.info("Sheets reconcile rewrote %s rows.", n)
+        except Exception as e:
+            LOG.exception("Sheets reconcile failed: %s", e)
+
 # ------------------------------------------------------------------------------
 # Callback handler
 # ------------------------------------------------------------------------------
@@ -817,80 +1492,210 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
     await query.answer()
-    if data.startswith("DEL:"):
+    if data.startswith("H:"):
+        await history_cb(update, context, data)
+    elif data.startswith("CAT:"):
+        await quick_pick_cb(update, context, data)
+    elif data.startswith("Q:"):
+        _, vid, page = data.split(":")
+        view = context.user_data.get("search", {}).get(int(vid))
+        if view is None:
+            await query.edit_message_text("These results have expired — run /search again.")
+            return
+        text, markup = await _search_page(update.effective_user.id, view, int(vid), int(page))
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=markup)
+    elif data.startswith("DEL:"):
+        # buttons on /history messages sent before pagination
         tid = int(data.split(":")[1])
         async with SessionLocal() as s:
-            await s.execute(Txn.__table__.delete().where(Txn.id == tid, Txn.user_tg_id == update.effective_user.id))
+            deleted = await ledger.delete_txns(s, update.effective_user.id, [tid])
             await s.commit()
+        if deleted and SHEETS_ENABLED:
+            _sheets().queue_delete([tid])
         await query.edit_message_text(f"Deleted transaction #{tid} ✅")
+    elif data.startswith("SWEEP:"):
+        _, action, month = data.split(":", 2)
+        async with SessionLocal() as s:
+            moved = await goals.settle_sweep(s, update.effective_user.id, month, confirm=(action == "OK"))
+        if action == "OK":
+            await query.edit_message_text(f"Swept {fmt_minor(moved, DEFAULT_CURRENCY)} into your goals ✅")
+        else:
+            await query.edit_message_text(f"Sweep for {month} skipped.")
 
 # ------------------------------------------------------------------------------
 # Reminders & weekly PDF
 # ------------------------------------------------------------------------------
-async def daily_checkin(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.chat_id
-    await context.bot.send_message(
-        chat_id,
-        "Daily check-in: log anything? `12 coffee #Food` or `+200 tutoring #OtherIncome`",
-        parse_mode="Markdown",
-    )
+CHECKIN_TEXT = "Daily check-in: log anything? `12 coffee #Food` or `+200 tutoring #OtherIncome`"
+
+async def reminder_tick(context: ContextTypes.DEFAULT_TYPE):
+    """One run per bucket: check-ins at DAILY_REMINDER_HOUR and digests at WEEKLY_DIGEST_HOUR, users' local time."""
+    bucket = reminders.bucket_start(datetime.now(dt.timezone.utc))
+    async with SessionLocal() as s:
+        zones = await reminders.reminder_zones(s)
+        checkins = await reminders.due_chats(
+            s, reminders.zones_at(zones, bucket, DAILY_REMINDER_HOUR), skip_logged=True
+        )
+        digests = await reminders.due_chats(
+            s, reminders.zones_at(zones, bucket, WEEKLY_DIGEST_HOUR, WEEKLY_DIGEST_DOW), skip_logged=False
+        )
+    if checkins:
+        n = await reminders.send_paced(
+            checkins.values(), lambda chat_id: context.bot.send_message(chat_id, CHECKIN_TEXT, parse_mode="Markdown")
+        )
+        LOG.info("Sent %s daily check-ins.", n)
+    if digests:
+        await weekly_digest(context, digests)
 
-async def weekly_pdf_job(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.chat_id
+async def weekly_digest(context: ContextTypes.DEFAULT_TYPE, chats: dict[int, int]):
+    """Send each user ({user: chat}) a report of their own month so far."""
+    from .reports import build_weekly_pdf
     month = current_month()
-    pdf_bytes = await build_weekly_pdf(month)
-    await context.bot.send_document(
-        chat_id=chat_id,
-        document=pdf_bytes,
-        filename=f"weekly_report_{month}.pdf",
-        caption="Weekly report",
-    )
-    if REPORT_EMAIL_TO and os.getenv("SENDGRID_API_KEY", "").strip():
+    owner_pdf = None
+
+    async def send(uid):
+        nonlocal owner_pdf
+        pdf_bytes = await build_weekly_pdf(uid, month)
+        if uid == OWNER_ID:
+            owner_pdf = pdf_bytes
+        await context.bot.send_document(
+            chat_id=chats[uid],
+            document=pdf_bytes,
+            filename=f"weekly_report_{month}.pdf",
+            caption="Weekly report",
+        )
+
+    await reminders.send_paced(list(chats), send)
+    if EMAIL_ENABLED and owner_pdf:
         try:
+            from .emailer import send_email_with_pdf
             send_email_with_pdf(
                 REPORT_EMAIL_TO,
                 f"BudgetBot Weekly Report — {month}",
                 "<p>Attached is your weekly report.</p>",
-                pdf_bytes,
+                owner_pdf,
                 filename=f"weekly_report_{month}.pdf",
             )
         except Exception as e:
             LOG.exception("Email send failed: %s", e)
 
-async def restore_jobs(app):
-    """Schedule daily check-ins and weekly PDFs for users who enabled reminders."""
-    async with SessionLocal() as s:
-        q = await s.execute(User.__table__.select().where(User.daily_reminders == True))
-        for r in q.mappings().all():
-            chat_id = r.get("last_chat_id")
-            if not chat_id:
-                continue
-            # Daily reminder
-            app.job_queue.run_daily(
-                daily_checkin,
-                time=time(hour=DAILY_REMINDER_HOUR, minute=0),
-                chat_id=chat_id,
-            )
-            # Weekly PDF on configured DOW
-            app.job_queue.run_daily(
-                weekly_pdf_job,
-                time=time(hour=WEEKLY_DIGEST_HOUR, minute=0),
-                days=(WEEKLY_DIGEST_DOW,),
-                chat_id=chat_id,
-            )
-
 # ------------------------------------------------------------------------------
 # Post-init hook: clear webhook & restore jobs
 # ------------------------------------------------------------------------------
 async def after_init(app):
-    # Clear any old webhook & drop queued updates to avoid conflicts with polling
+    # Only one process may poll Telegram (and run the jobs); runs before polling starts
+    if not await acquire_single_instance_lock():
+        LOG.error("Another BudgetBot instance already holds the DB lock; exiting.")
+        raise SystemExit(1)
+    # Clear any old webhook so polling works; queued updates are kept (handlers that
+    # write are idempotent, see app.idempotency) and worked off on start
     try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        LOG.info("Webhook deleted & pending updates dropped.")
+        await app.bot.delete_webhook(drop_pending_updates=False)
     except Exception as e:
         LOG.warning("delete_webhook failed: %s", e)
-    # Re-schedule jobs inside PTB's loop
-    await restore_jobs(app)
+    # Week-to-date counters for databases that predate them
+    async with SessionLocal() as s:
+        if await ledger.backfill_weekly(s, only_if_empty=True):
+            LOG.info("Backfilled weekly spend counters.")
+        if await anomaly.backfill(s, only_if_empty=True):
+            LOG.info("Backfilled expense statistics.")
+    # Check-ins and weekly PDFs: one tick per bucket, on the bucket boundaries
+    app.job_queue.run_repeating(
+        reminder_tick,
+        interval=reminders.BUCKET_MINUTES * 60,
+        first=reminders.seconds_to_next_bucket(datetime.now(dt.timezone.utc)),
+    )
+    # Move closed months out of the hot txns store (daily, plus once after boot)
+    app.job_queue.run_daily(partitions.archive_job, time=time(hour=3, minute=15))
+    app.job_queue.run_once(partitions.archive_job, when=60)
+    # Entries held back by the rate limit when the last run stopped
+    if GATE is not None and cluster.ROLE == "single":
+        n = await GATE.restore(app)
+        if n:
+            LOG.info("Restored %s held entries.", n)
+    # Template commands resolve from memory
+    LOG.info("Loaded %s templates.", await templates.load_all())
+    async with SessionLocal() as s:
+        LOG.info("Loaded %s active freezes.", await load_freezes(s))
+    # Rent, subscriptions, ... (daily, plus once after boot to catch up)
+    app.job_queue.run_daily(recurring_job, time=time(hour=recurring.RECURRING_HOUR, minute=0))
+    app.job_queue.run_once(recurring_job, when=30)
+    # Keys of handled updates only need to outlive Telegram's redelivery window
+    app.job_queue.run_daily(idempotency.prune_job, time=time(hour=3, minute=45))
+    # Months past the retention horizon → summaries + compressed archives (opt-in)
+    if retention.MONTHS > 0:
+        app.job_queue.run_daily(retention.retention_job, time=time(hour=4, minute=15))
+    # Leftover envelopes → goals, on the last day of every month
+    app.job_queue.run_monthly(goals.sweep_job, when=time(hour=goals.SWEEP_HOUR, minute=0), day=-1)
+    # Transactions tab: batched flushes, plus a periodic checksum reconcile against the DB
+    if SHEETS_ENABLED:
+        app.job_queue.run_repeating(sheets_flush_job, interval=SHEETS_FLUSH_SECONDS, first=SHEETS_FLUSH_SECONDS)
+        app.job_queue.run_repeating(sheets_reconcile_job, interval=SHEETS_RECONCILE_MINUTES * 60, first=300)
+        # Budgets / WeeklyCaps / Freezes tabs: hand edits come back into the DB
+        if OWNER_ID:
+            app.job_queue.run_repeating(sheets_pull.pull_job, interval=sheets_pull.PULL_SECONDS, first=10, data=OWNER_ID)
+        else:
+            LOG.warning("Sheets config tabs are not pulled: set OWNER_ID (or ADMIN_IDS) to the user they belong to.")
+
+# ------------------------------------------------------------------------------
+# Multi-worker mode (see app/cluster.py)
+# ------------------------------------------------------------------------------
+def _in_shards(shards):
+    shards = set(shards)
+    return lambda uid: cluster.shard_of_user(uid) in shards
+
+async def _shards_gained(app, shards):
+    # users may have been handled by another worker since this one cached anything about them
+    mru.forget(_in_shards(shards))
+    ledger.bump_version()
+    await templates.load_all()
+    async with SessionLocal() as s:
+        await load_freezes(s)
+    # entries the previous owner held back and didn't get to log
+    if GATE is not None:
+        await GATE.restore(app, _in_shards(shards))
+
+async def _shards_shed(app, shards):
+    if GATE is not None:
+        await GATE.flush_all(app, _in_shards(shards))
+        # whatever failed to log stays in held_entries for the shards' next owner
+        GATE.forget(_in_shards(shards))
+
+async def _shards_lost(shards):
+    if GATE is not None:
+        GATE.forget(_in_shards(shards))
+
+async def _reload_freezes_job(context: ContextTypes.DEFAULT_TYPE):
+    async with SessionLocal() as s:
+        await load_freezes(s)
+
+async def run_cluster_role(app):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await app.initialize()
+    if cluster.ROLE == "ingress":
+        await after_init(app)  # instance lock, webhook, scheduled jobs
+    else:
+        await templates.load_all()
+        # freezes changed by the ingress (Sheets pull) or other workers reach this one on a timer
+        app.job_queue.run_repeating(_reload_freezes_job, interval=FREEZE_RELOAD_SECONDS, first=FREEZE_RELOAD_SECONDS)
+        if SHEETS_ENABLED:
+            app.job_queue.run_repeating(sheets_flush_job, interval=SHEETS_FLUSH_SECONDS, first=SHEETS_FLUSH_SECONDS)
+    await app.start()
+    try:
+        if cluster.ROLE == "ingress":
+            await cluster.ingress(app.bot, stop)
+        else:
+            worker = cluster.Worker(
+                lambda u: app.process_update(Update.de_json(u, app.bot)),
+                on_gain=lambda g: _shards_gained(app, g), on_shed=lambda g: _shards_shed(app, g), on_lost=_shards_lost,
+            )
+            await worker.run(stop)
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await release_single_instance_lock()
 
 # ------------------------------------------------------------------------------
 # Main
@@ -906,9 +1711,16 @@ def main():
         ApplicationBuilder()
         .token(TOKEN)
         .post_init(after_init)   # important: run inside PTB loop
+        .concurrent_updates(idempotency.PerUserUpdates())
+        .post_stop(_flush_held)
+        .post_shutdown(release_single_instance_lock)
         .build()
     )
 
+    # Per-user rate limits, ahead of every handler below
+    if GATE is not None:
+        app.add_handler(TypeHandler(Update, GATE), group=-1)
+
     # Commands
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("start", start))
@@ -916,21 +1728,33 @@ def main():
     app.add_handler(CommandHandler("bootstrap_sheet", bootstrap_sheet_cmd))
     app.add_handler(CommandHandler("setbudget", setbudget_cmd))
     app.add_handler(CommandHandler("left", left_cmd))
+    app.add_handler(CommandHandler("forecast", forecast_cmd))
+    app.add_handler(CommandHandler("whatif", whatif_cmd))
     app.add_handler(CommandHandler("weeklyleft", weeklyleft_cmd))
     app.add_handler(CommandHandler("setweekly", setweekly_cmd))
     app.add_handler(CommandHandler("freeze", freeze_cmd))
     app.add_handler(CommandHandler("export", export_cmd))
     app.add_handler(CommandHandler("export_to_excel", export_excel_cmd))
+    app.add_handler(CommandHandler("rehydrate", rehydrate_cmd))
     app.add_handler(CommandHandler("history", history_cmd))
+    app.add_handler(CommandHandler("search", search_cmd))
     app.add_handler(CommandHandler("undo", undo_cmd))
     app.add_handler(CommandHandler("edit", edit_cmd))
     app.add_handler(CommandHandler("override", override_cmd))
     app.add_handler(CommandHandler("report_pdf", report_pdf_cmd))
+    app.add_handler(CommandHandler("trends", trends_cmd))
     app.add_handler(CommandHandler("totals", totals_cmd))
     app.add_handler(CommandHandler("today", today_cmd))
     app.add_handler(CommandHandler("week", week_cmd))
     app.add_handler(CommandHandler("month", month_cmd))
     app.add_handler(CommandHandler(["income", "in"], income_cmd))
+    app.add_handler(CommandHandler("slowqueries", slowqueries_cmd))
+    app.add_handler(CommandHandler("backfill_stats", backfill_stats_cmd))
+    app.add_handler(CommandHandler("admission", admission_cmd))
+    app.add_handler(CommandHandler("goal", goal_cmd))
+    app.add_handler(CommandHandler("sweep", sweep_cmd))
+    app.add_handler(CommandHandler("template", template_cmd))
+    app.add_handler(CommandHandler("recurring", recurring_cmd))
 
 
 
@@ -939,23 +1763,22 @@ def main():
 
     # Free-text logging
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_free_text))
+    # /<template> — registered last so real commands always win
+    app.add_handler(MessageHandler(filters.COMMAND, template_dispatch))
 
-    # Py 3.13: make sure a loop exists (defensive)
-    try:
-        asyncio.get_running_loop()
-    except RuntimeError:
-        asyncio.set_event_loop(asyncio.new_event_loop())
-
-    app.run_polling()
-
-    asyncio.run(init_db())
-
-    # Ensure only one instance runs
-    if not asyncio.run(acquire_single_instance_lock()):
-        LOG.error("Another BudgetBot instance already holds the DB lock; exiting.")
-        return
-
-
+    if cluster.ROLE == "single":
+        # Py 3.13: make sure a loop exists (defensive)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+        app.run_polling(drop_pending_updates=False)
+    elif cluster.ROLE in ("ingress", "worker"):
+        if engine.dialect.name != "postgresql":
+            raise SystemExit(f"BOT_ROLE={cluster.ROLE} needs Postgres (advisory locks).")
+        asyncio.run(run_cluster_role(app))
+    else:
+        raise SystemExit(f"Unknown BOT_ROLE {cluster.ROLE!r} (single, ingress or worker).")
 
 if __name__ == "__main__":
     main()
@@ -1,37 +1,174 @@
+import os, time
 from datetime import date, datetime, timedelta
-from sqlalchemy import select, func
+from sqlalchemy import select, func, case, cast, and_, union_all, true, Integer
 from sqlalchemy.ext.asyncio import AsyncSession
-from .db import Txn, Budget, Freeze, WeeklyCap
+from .db import Txn, Budget, Freeze, WeeklyCap, WeeklySpend, TxnSummary, dialect_insert
+from .partitions import txn_source
+from .utils import current_month
 
 def month_of(d: date) -> str:
     return f"{d.year:04d}-{d.month:02d}"
 
-async def spent_by(session: AsyncSession, month: str, category: str, parent: str|None):
+async def spent_by(session: AsyncSession, user_tg_id: int, month: str, category: str, parent: str|None):
+    t = txn_source(month).c
     q = await session.execute(
-        select(func.sum(Txn.amount)).where(
-            Txn.type=="Expense", Txn.month==month, Txn.category==category, Txn.parent==parent
+        select(func.sum(t.amount_cents)).where(
+            t.user_tg_id==user_tg_id, t.type=="Expense", t.month==month, t.category==category, t.parent==(parent or None)
         )
     )
-    return float(q.scalar() or 0.0)
+    spent = int(q.scalar() or 0)
+    if month < current_month():  # closed months may be partly compacted (app.retention)
+        q = await session.execute(
+            select(func.sum(TxnSummary.amount_cents)).where(
+                TxnSummary.user_tg_id==user_tg_id, TxnSummary.type=="Expense", TxnSummary.month==month,
+                TxnSummary.category==category, TxnSummary.parent==(parent or "")
+            )
+        )
+        spent += int(q.scalar() or 0)
+    return spent
+
+async def spent_all(session: AsyncSession, user_tg_id: int, month: str) -> dict:
+    """{(category, parent or ""): spent} for all of the user's envelopes in one month."""
+    t = txn_source(month).c
+    parent = func.coalesce(t.parent, "")
+    q = await session.execute(
+        select(t.category, parent, func.sum(t.amount_cents))
+        .where(t.user_tg_id==user_tg_id, t.type=="Expense", t.month==month)
+        .group_by(t.category, parent)
+    )
+    out = {(c, p): int(v or 0) for c, p, v in q.all()}
+    if month < current_month():
+        q = await session.execute(
+            select(TxnSummary.category, TxnSummary.parent, func.sum(TxnSummary.amount_cents))
+            .where(TxnSummary.user_tg_id==user_tg_id, TxnSummary.type=="Expense", TxnSummary.month==month)
+            .group_by(TxnSummary.category, TxnSummary.parent)
+        )
+        for c, p, v in q.all():
+            out[(c, p)] = out.get((c, p), 0) + int(v or 0)
+    return out
 
-async def budget_left(session: AsyncSession, month: str):
+async def get_budget(session: AsyncSession, user_tg_id: int, month: str, category: str, parent: str|None):
+    q = await session.execute(select(Budget).where(
+        Budget.user_tg_id==user_tg_id, Budget.month==month, Budget.category==category, Budget.parent==(parent or "")
+    ))
+    return q.scalars().first()
+
+async def budget_left(session: AsyncSession, user_tg_id: int, month: str):
+    """{(category, parent or ""): (limit incl. rollover carry, spent, left)}"""
+    q = await session.execute(select(Budget).where(Budget.user_tg_id==user_tg_id, Budget.month==month))
+    budgets = q.scalars().all()
+    if not budgets:
+        return {}
+    carry = await carry_in(session, user_tg_id, month)
+    spent = await spent_all(session, user_tg_id, month)
     res = {}
-    q = await session.execute(select(Budget).where(Budget.month==month))
-    for b in q.scalars().all():
-        spent = await spent_by(session, month, b.category, b.parent)
-        res[(b.category, b.parent or "")] = (b.limit_amount, spent, b.limit_amount - spent)
+    for b in budgets:
+        key = (b.category, b.parent)
+        limit = b.limit_cents + carry.get(key, 0)
+        res[key] = (limit, spent.get(key, 0), limit - spent.get(key, 0))
     return res
 
-async def add_or_update_budget(session: AsyncSession, month: str, category: str, parent: str|None, limit: float):
-    q = await session.execute(select(Budget).where(Budget.month==month, Budget.category==category, Budget.parent==parent))
-    b = q.scalars().first()
-    if not b:
-        b = Budget(month=month, category=category, parent=parent, limit_amount=limit)
-        session.add(b)
-    else:
-        b.limit_amount = limit
+async def add_or_update_budget(session: AsyncSession, user_tg_id: int, month: str, category: str, parent: str|None, limit_cents: int, rollover: bool|None = None) -> bool:
+    """Set the envelope's limit (and rollover, unless None) in one upsert. Returns whether it rolls over."""
+    ins = dialect_insert(session.bind)(Budget).values(
+        user_tg_id=user_tg_id, month=month, category=category, parent=parent or "",
+        limit_cents=limit_cents, rollover=bool(rollover),
+    )
+    changes = {"limit_cents": ins.excluded.limit_cents}
+    if rollover is not None:
+        changes["rollover"] = ins.excluded.rollover
+    q = await session.execute(
+        ins.on_conflict_do_update(index_elements=["user_tg_id", "month", "category", "parent"], set_=changes)
+        .returning(Budget.rollover)
+    )
+    rolls = bool(q.scalar())
     await session.commit()
-    return b
+    if month < current_month():
+        forget_carry(user_tg_id)
+    return rolls
+
+# Rollover: an envelope whose budget row has `rollover` set passes its leftover
+# (or overspend) on to the same envelope next month, carry it got included, so a
+# chain of rollover months adds up until a month without rollover or a gap.
+CARRY_TTL_SECONDS = int(os.getenv("ROLLOVER_CACHE_SECONDS", "900"))  # bounds staleness from other processes' writes
+_CARRY: dict = {}  # (user, month) -> (monotonic time, {(category, parent): carry into it})
+
+def forget_carry(user_tg_id: int | None = None):
+    """Closed months changed (a txn or budget in one was written): carries are recomputed on next use."""
+    if user_tg_id is None:
+        _CARRY.clear()
+        return
+    for key in [k for k in _CARRY if k[0] == user_tg_id]:
+        del _CARRY[key]
+
+def _month_index(col):
+    return cast(func.substr(col, 1, 4), Integer) * 12 + cast(func.substr(col, 6, 2), Integer)
+
+def _prev_month(m: str) -> str:
+    y, mo = map(int, m.split("-"))
+    return f"{y - (mo == 1):04d}-{(mo - 2) % 12 + 1:02d}"
+
+async def _chain_ends(session: AsyncSession, user_tg_id: int, month: str) -> dict:
+    """{(category, parent): what each rollover envelope of `month` passes on to the next}, in one query."""
+    b = Budget.__table__
+    src = txn_source().c
+    s = TxnSummary
+    lp = func.coalesce(src.parent, "")
+    live = (
+        select(src.month, src.category, lp.label("parent"), func.sum(src.amount_cents).label("spent"))
+        .where(src.user_tg_id == user_tg_id, src.type == "Expense", src.month <= month)
+        .group_by(src.month, src.category, lp)
+    )
+    compacted = (
+        select(s.month, s.category, s.parent, func.sum(s.amount_cents).label("spent"))
+        .where(s.user_tg_id == user_tg_id, s.type == "Expense", s.month <= month)
+        .group_by(s.month, s.category, s.parent)
+    )
+    both = union_all(live, compacted).subquery("both_spent")
+    spent = (
+        select(both.c.month, both.c.category, both.c.parent, func.sum(both.c.spent).label("spent"))
+        .group_by(both.c.month, both.c.category, both.c.parent)
+        .subquery("spent")
+    )
+    bp = b.c.parent
+    env = [b.c.category, bp]
+    idx = _month_index(b.c.month)
+    rows = (
+        select(
+            b.c.month, b.c.category, bp.label("parent"), b.c.rollover, idx.label("idx"),
+            (b.c.limit_cents - func.coalesce(spent.c.spent, 0)).label("left"),
+            func.lag(idx).over(partition_by=env, order_by=b.c.month).label("prev_idx"),
+            func.lag(b.c.rollover).over(partition_by=env, order_by=b.c.month).label("prev_rollover"),
+        )
+        .select_from(b.outerjoin(spent, and_(spent.c.month == b.c.month, spent.c.category == b.c.category, spent.c.parent == bp)))
+        .where(b.c.user_tg_id == user_tg_id, b.c.month <= month)
+        .subquery("envelope_months")
+    )
+    # gaps and islands: a new chain starts at every month that gets nothing from the month right before it
+    starts = case((and_(rows.c.prev_rollover == true(), rows.c.prev_idx == rows.c.idx - 1), 0), else_=1)
+    islands = select(
+        rows.c.month, rows.c.category, rows.c.parent, rows.c.rollover, rows.c.left,
+        func.sum(starts).over(partition_by=[rows.c.category, rows.c.parent], order_by=rows.c.month).label("chain"),
+    ).subquery("islands")
+    running = select(
+        islands.c.month, islands.c.category, islands.c.parent, islands.c.rollover,
+        func.sum(islands.c.left).over(
+            partition_by=[islands.c.category, islands.c.parent, islands.c.chain], order_by=islands.c.month,
+        ).label("total"),
+    ).subquery("running")
+    q = select(running.c.category, running.c.parent, running.c.total).where(running.c.month == month, running.c.rollover == true())
+    return {(c, p): int(v or 0) for c, p, v in (await session.execute(q)).all()}
+
+async def carry_in(session: AsyncSession, user_tg_id: int, month: str) -> dict:
+    """{(category, parent): carry} for the user's envelopes this month that last month rolled over into."""
+    hit = _CARRY.get((user_tg_id, month))
+    if hit is None or time.monotonic() - hit[0] > CARRY_TTL_SECONDS:
+        hit = (time.monotonic(), await _chain_ends(session, user_tg_id, _prev_month(month)))
+        if month <= current_month():  # later months carry from the open one, which changes with every txn
+            if len(_CARRY) > 1000:
+                _CARRY.clear()
+            _CARRY[(user_tg_id, month)] = hit
+    return hit[1]
 
 # Weekly caps helpers
 def week_range(d: date):
@@ -39,61 +176,95 @@ def week_range(d: date):
     end = start + timedelta(days=6)
     return start, end
 
-async def weekly_spent(session: AsyncSession, d: date, category: str, parent: str|None):
-    start, end = week_range(d)
+async def weekly_spent(session: AsyncSession, user_tg_id: int, d: date, category: str, parent: str|None):
+    # point read of the counter app.ledger keeps in step with txns
     q = await session.execute(
-        select(func.sum(Txn.amount)).where(
-            Txn.type=="Expense",
-            Txn.category==category,
-            Txn.parent==parent,
-            Txn.occurred_at >= start,
-            Txn.occurred_at <= end
+        select(WeeklySpend.spent_cents).where(
+            WeeklySpend.user_tg_id==user_tg_id,
+            WeeklySpend.week_start==week_range(d)[0],
+            WeeklySpend.category==category,
+            WeeklySpend.parent==(parent or "")
         )
     )
-    return float(q.scalar() or 0.0)
-
-async def set_weekly_cap(session: AsyncSession, category: str, parent: str|None, cap: float):
-    q = await session.execute(select(WeeklyCap).where(WeeklyCap.category==category, WeeklyCap.parent==parent))
-    w = q.scalars().first()
-    if not w:
-        w = WeeklyCap(category=category, parent=parent, cap_amount=cap)
-        session.add(w)
-    else:
-        w.cap_amount = cap
+    return int(q.scalar() or 0)
+
+async def weekly_spent_all(session: AsyncSession, user_tg_id: int, d: date) -> dict:
+    """{(category, parent or ""): spent} for the user's week containing d."""
+    q = await session.execute(
+        select(WeeklySpend.category, WeeklySpend.parent, WeeklySpend.spent_cents).where(
+            WeeklySpend.user_tg_id==user_tg_id, WeeklySpend.week_start==week_range(d)[0]
+        )
+    )
+    return {(c, p): int(v) for c, p, v in q.all()}
+
+async def set_weekly_cap(session: AsyncSession, user_tg_id: int, category: str, parent: str|None, cap_cents: int):
+    ins = dialect_insert(session.bind)(WeeklyCap).values(
+        user_tg_id=user_tg_id, category=category, parent=parent or "", cap_cents=cap_cents
+    )
+    await session.execute(ins.on_conflict_do_update(
+        index_elements=["user_tg_id", "category", "parent"], set_={"cap_cents": ins.excluded.cap_cents}
+    ))
     await session.commit()
-    return w
 
-async def get_weekly_caps(session: AsyncSession):
-    q = await session.execute(select(WeeklyCap))
+async def get_weekly_caps(session: AsyncSession, user_tg_id: int):
+    q = await session.execute(select(WeeklyCap).where(WeeklyCap.user_tg_id==user_tg_id))
     return q.scalars().all()
 
-async def get_weekly_cap(session: AsyncSession, category: str, parent: str|None):
-    q = await session.execute(select(WeeklyCap).where(WeeklyCap.category==category, WeeklyCap.parent==parent))
+async def get_weekly_cap(session: AsyncSession, user_tg_id: int, category: str, parent: str|None):
+    q = await session.execute(select(WeeklyCap).where(
+        WeeklyCap.user_tg_id==user_tg_id, WeeklyCap.category==category, WeeklyCap.parent==(parent or "")
+    ))
     return q.scalars().first()
 
-async def is_frozen(session: AsyncSession, category: str, parent: str|None) -> bool:
-    q = await session.execute(select(Freeze).where(Freeze.category==category, Freeze.parent==parent, Freeze.active==True))
-    return q.scalars().first() is not None
-
-async def set_freeze(session: AsyncSession, category: str, parent: str|None, active: bool):
-    q = await session.execute(select(Freeze).where(Freeze.category==category, Freeze.parent==parent))
-    f = q.scalars().first()
-    if not f:
-        f = Freeze(category=category, parent=parent, active=active)
-        session.add(f)
-    else:
-        f.active = active
+# Freezes are checked on every logged expense, from memory: the active set is
+# loaded once and reloaded when freezes change (set_freeze, the Sheets pull).
+_FROZEN: dict | None = None  # user -> {(category, parent or "")}; None until loaded
+
+async def load_freezes(session: AsyncSession) -> int:
+    global _FROZEN
+    q = await session.execute(select(Freeze.user_tg_id, Freeze.category, Freeze.parent).where(Freeze.active==True))
+    frozen = {}
+    for u, c, p in q.all():
+        frozen.setdefault(u, set()).add((c, p or ""))
+    _FROZEN = frozen
+    return sum(len(v) for v in frozen.values())
+
+async def frozen_by(session: AsyncSession, user_tg_id: int, category: str, parent: str|None) -> tuple|None:
+    """The user's active freeze that blocks category › parent (its own, or the whole category's), else None."""
+    if _FROZEN is None:
+        await load_freezes(session)
+    mine = _FROZEN.get(user_tg_id, ())
+    for key in ((category, parent or ""), (category, "")):
+        if key in mine:
+            return key
+    return None
+
+async def list_freezes(session: AsyncSession, user_tg_id: int):
+    q = await session.execute(
+        select(Freeze).where(Freeze.user_tg_id==user_tg_id, Freeze.active==True).order_by(Freeze.category, Freeze.parent)
+    )
+    return q.scalars().all()
+
+async def set_freeze(session: AsyncSession, user_tg_id: int, category: str, parent: str|None, active: bool):
+    ins = dialect_insert(session.bind)(Freeze).values(
+        user_tg_id=user_tg_id, category=category, parent=parent or "", active=active
+    )
+    await session.execute(ins.on_conflict_do_update(
+        index_elements=["user_tg_id", "category", "parent"], set_={"active": ins.excluded.active}
+    ))
     await session.commit()
-    return f
+    if _FROZEN is not None:
+        mine = _FROZEN.setdefault(user_tg_id, set())
+        (mine.add if active else mine.discard)((category, parent or ""))
 
-def burn_rate_warning(today: date, month_limit: float, spent: float) -> str:
+def burn_rate_warning(today: date, month_limit: int, spent: int) -> str:
     if month_limit <= 0:
         return ""
     next_month = today.replace(day=28) + timedelta(days=4)
     last_day = (next_month - timedelta(days=next_month.day)).day
-    pace_allowed = month_limit * (today.day / last_day)
-    if spent > pace_allowed * 1.1:
+    # integer cross-multiplication: spent > limit * day/last_day * 1.1
+    if spent * last_day * 10 > month_limit * today.day * 11:
         return " ⏳ You’re spending faster than pace for this envelope."
-    if spent >= month_limit * 0.8:
+    if spent * 5 >= month_limit * 4:
         return " ⚠️ 80% of monthly budget used."
     return ""
@@ -0,0 +1,66 @@
+"""
+Chart images drawn with Pillow (already installed with ReportLab).
+
+Kept free of app imports: these functions run in app.trends' process pool,
+whose workers import only this module.
+"""
+import io, math
+
+WIDTH, HEIGHT = 900, 480
+_LEFT, _RIGHT, _TOP, _BOTTOM = 90, 20, 56, 64
+_GRID, _AXIS, _TEXT = (225, 225, 225), (120, 120, 120), (30, 30, 30)
+
+def _font(size: int):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1: bitmap font only
+        return ImageFont.load_default()
+
+def _step(top: float) -> float:
+    """A 1/2/5 x 10^k gridline step giving about five lines up to `top`."""
+    raw = top / 5
+    mag = 10 ** math.floor(math.log10(raw))
+    return next(m * mag for m in (1, 2, 5, 10) if m * mag >= raw)
+
+def bar_chart(title: str, labels: list[str], series: list[tuple[str, tuple, list[float]]]) -> bytes:
+    """Grouped bars, one group per label; series = [(name, rgb, values)]. Returns PNG bytes."""
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", (WIDTH, HEIGHT), "white")
+    d = ImageDraw.Draw(img)
+    font, small = _font(18), _font(13)
+    d.text((_LEFT, 16), title, fill=_TEXT, font=font)
+
+    x0, x1, y0, y1 = _LEFT, WIDTH - _RIGHT, _TOP, HEIGHT - _BOTTOM
+    top = max((v for _n, _c, vals in series for v in vals), default=0)
+    step = _step(top) if top > 0 else 1
+    top = step * max(1, math.ceil(top / step))
+    y_of = lambda v: y1 - (y1 - y0) * v / top
+    for k in range(int(round(top / step)) + 1):
+        y = y_of(k * step)
+        d.line([(x0, y), (x1, y)], fill=_GRID)
+        d.text((x0 - 8, y), f"{k * step:,.0f}", fill=_AXIS, font=small, anchor="rm")
+    d.line([(x0, y1), (x1, y1)], fill=_AXIS)
+
+    groups = max(len(labels), 1)
+    slot = (x1 - x0) / groups
+    bar = slot * 0.7 / max(len(series), 1)
+    for i, label in enumerate(labels):
+        left = x0 + slot * i + slot * 0.15
+        for j, (_name, color, vals) in enumerate(series):
+            if vals[i] > 0:
+                d.rectangle([left + bar * j, y_of(vals[i]), left + bar * (j + 1) - 2, y1], fill=color)
+        d.text((x0 + slot * (i + 0.5), y1 + 8), label, fill=_TEXT, font=small, anchor="mt")
+
+    lx = x1
+    for name, color, _vals in reversed(series):
+        lx -= d.textlength(name, font=small) + 8
+        d.text((lx, 28), name, fill=_TEXT, font=small)
+        lx -= 18
+        d.rectangle([lx, 29, lx + 12, 41], fill=color)
+        lx -= 14
+
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
@@ -0,0 +1,287 @@
+"""
+Multi-worker mode (Postgres only), picked with BOT_ROLE:
+
+- `single` (default): one process polls Telegram and handles everything.
+- `ingress`: the one process that talks to Telegram. It long-polls
+  getUpdates into `update_queue`, tagging each update with its shard
+  (user id % CLUSTER_SHARDS), and runs the scheduled jobs.
+- `worker`: any number of processes that handle queued updates. A worker
+  owns shards through session-level advisory locks held on one dedicated
+  connection, so each user's updates are handled by exactly one worker, in
+  order. Workers heartbeat into `cluster_workers` and, on every heartbeat,
+  take or shed shards toward an even share of the live workers. A worker
+  that stops heartbeating has its lock connection terminated by the others,
+  which frees its shards; one that dies outright frees them with its
+  connection. Before a worker releases shards (shedding, or stopping) it
+  calls `on_shed`; when it finds shards taken from it, `on_lost`.
+"""
+import os, json, socket, asyncio, logging, zlib
+from contextlib import asynccontextmanager, suppress
+from datetime import timedelta
+
+from sqlalchemy import select, delete, func, text
+
+from .db import engine, SessionLocal, UpdateQueue, ClusterWorker, dialect_insert
+
+_LOG = logging.getLogger(__name__)
+
+ROLE = os.getenv("BOT_ROLE", "single").strip().lower()  # single / ingress / worker
+SHARDS = int(os.getenv("CLUSTER_SHARDS", "64"))
+HEARTBEAT_SECONDS = float(os.getenv("CLUSTER_HEARTBEAT_SECONDS", "5"))
+DEAD_AFTER_SECONDS = float(os.getenv("CLUSTER_DEAD_AFTER_SECONDS", "20"))
+POLL_SECONDS = float(os.getenv("CLUSTER_POLL_SECONDS", "0.2"))  # idle worker queue poll
+BATCH = int(os.getenv("CLUSTER_BATCH", "100"))
+LONG_POLL_SECONDS = int(os.getenv("CLUSTER_LONG_POLL_SECONDS", "30"))
+# advisory locks use the two-key form: (LOCK_CLASS, shard) for shards, (LOCK_CLASS, MUTEX_BASE + n) for mutexes
+LOCK_CLASS = int(os.getenv("CLUSTER_LOCK_CLASS", "7284"))
+MUTEX_BASE = 1_000_000
+MUTEX_SHEETS = 1  # the Sheets Transactions tab
+
+def shard_of_user(user_id: int) -> int:
+    return user_id % SHARDS
+
+def shard_of(update: dict) -> int:
+    """Shard for a raw update: its sender, else its chat, else shard 0."""
+    for v in update.values():
+        if isinstance(v, dict):
+            who = v.get("from") or v.get("user") or v.get("chat") or (v.get("message") or {}).get("chat")
+            if isinstance(who, dict) and "id" in who:
+                return shard_of_user(abs(int(who["id"])))
+    return 0
+
+@asynccontextmanager
+async def exclusive(n: int):
+    """Cluster-wide try-mutex; yields False (without waiting) if another process holds it."""
+    async with engine.connect() as c:
+        got = (await c.execute(text("SELECT pg_try_advisory_lock(:c, :k)"), {"c": LOCK_CLASS, "k": MUTEX_BASE + n})).scalar()
+        await c.commit()
+        try:
+            yield bool(got)
+        finally:
+            if got:
+                await c.execute(text("SELECT pg_advisory_unlock(:c, :k)"), {"c": LOCK_CLASS, "k": MUTEX_BASE + n})
+                await c.commit()
+
+# ------------------------------------------------------------------------------
+# Ingress
+# ------------------------------------------------------------------------------
+async def enqueue(updates: list[dict]):
+    if not updates:
+        return
+    async with SessionLocal() as s:
+        ins = dialect_insert(s.bind)(UpdateQueue).values([
+            dict(update_id=u["update_id"], shard=shard_of(u), payload=json.dumps(u)) for u in updates
+        ])
+        await s.execute(ins.on_conflict_do_nothing(index_elements=["update_id"]))
+        await s.commit()
+
+async def ingress(bot, stop: asyncio.Event):
+    """Long-poll Telegram into update_queue until `stop` is set. An update is
+    confirmed to Telegram (by the next offset) only after it is committed."""
+    from telegram import Update
+    from telegram.error import NetworkError
+
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=LONG_POLL_SECONDS, allowed_updates=Update.ALL_TYPES,
+                read_timeout=LONG_POLL_SECONDS + 10,
+            )
+        except NetworkError as e:
+            _LOG.warning("getUpdates failed: %s", e)
+            await asyncio.sleep(1)
+            continue
+        if updates:
+            await enqueue([u.to_dict() for u in updates])
+            offset = updates[-1].update_id + 1
+
+# ------------------------------------------------------------------------------
+# Worker
+# ------------------------------------------------------------------------------
+class Worker:
+    def __init__(self, process, on_gain=None, on_shed=None, on_lost=None):
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+        self.process = process    # async (update dict) -> None
+        self.on_gain = on_gain    # async (new shards) -> None, e.g. to drop per-user caches
+        self.on_shed = on_shed    # async (shards) -> None, still owned: e.g. finish per-user work
+        self.on_lost = on_lost    # async (shards) -> None, already someone else's
+        self.owned: set[int] = set()
+        self.target = SHARDS
+        self._conn = None
+        self._conn_lock = asyncio.Lock()  # heartbeat and shed share the lock connection
+        self._beat = None
+        self._confirmed = 0.0  # monotonic time the lock connection last answered
+
+    async def run(self, stop: asyncio.Event):
+        # the shard locks live as long as this connection; losing it means losing
+        # the shards, so any error on it ends the worker (let the supervisor restart it)
+        async with engine.connect() as conn:
+            self._conn = conn
+            pid = (await conn.execute(text("SELECT pg_backend_pid()"))).scalar()
+            await conn.commit()
+            await self.heartbeat(pid)
+            # heartbeats run beside the handlers, so a slow batch can't make this worker look dead
+            self._beat = beat = asyncio.create_task(self._heartbeats(pid, stop))
+            try:
+                while not stop.is_set():
+                    if beat.done():
+                        beat.result()  # re-raise what killed it
+                        break
+                    await self.shed()  # only between batches: never while a shard is mid-update
+                    if not await self.drain():
+                        with suppress(asyncio.TimeoutError):
+                            await asyncio.wait_for(stop.wait(), POLL_SECONDS)
+            finally:
+                # a dead lock connection means the shards may be someone else's already
+                alive = not beat.done() or beat.exception() is None
+                beat.cancel()
+                with suppress(BaseException):
+                    await beat
+                if self.owned:
+                    await self._release(sorted(self.owned), alive)
+                with suppress(Exception):
+                    async with self._conn_lock:
+                        await conn.execute(delete(ClusterWorker).where(ClusterWorker.worker_id == self.id))
+                        await conn.commit()
+                self.owned.clear()
+
+    async def _heartbeats(self, pid: int, stop: asyncio.Event):
+        while not stop.is_set():
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), HEARTBEAT_SECONDS)
+            if not stop.is_set():
+                await self.heartbeat(pid)
+
+    async def heartbeat(self, pid: int):
+        """Mark this worker alive, evict dead ones and take free shards up to an even share."""
+        c = self._conn
+        async with self._conn_lock:
+            ins = dialect_insert(c)(ClusterWorker).values(worker_id=self.id, backend_pid=pid, shards=len(self.owned))
+            await c.execute(ins.on_conflict_do_update(
+                index_elements=["worker_id"], set_={"backend_pid": pid, "shards": len(self.owned), "heartbeat_at": func.now()},
+            ))
+            cutoff = func.now() - timedelta(seconds=DEAD_AFTER_SECONDS)
+            dead = (await c.execute(
+                select(ClusterWorker.worker_id, ClusterWorker.backend_pid).where(ClusterWorker.heartbeat_at < cutoff)
+            )).all()
+            for wid, bpid in dead:
+                # a hung worker still holds its locks; ending its connection releases them
+                # (only if that backend still holds shard locks: pids get reused)
+                await c.execute(text(
+                    "SELECT pg_terminate_backend(pid) FROM pg_locks "
+                    "WHERE locktype = 'advisory' AND classid = :c AND objsubid = 2 AND pid = :p LIMIT 1"
+                ), {"c": LOCK_CLASS, "p": bpid})
+                await c.execute(delete(ClusterWorker).where(ClusterWorker.worker_id == wid))
+                _LOG.warning("Worker %s missed its heartbeats; its shards are up for grabs.", wid)
+            live = (await c.execute(select(func.count()).select_from(ClusterWorker))).scalar() or 1
+            self.target = -(-SHARDS // live)
+            gained = []
+            # probe from a per-worker offset so workers don't all contend for the same shards first
+            start = zlib.crc32(self.id.encode()) % SHARDS
+            for k in range(SHARDS):
+                if len(self.owned) + len(gained) >= self.target:
+                    break
+                shard = (start + k) % SHARDS
+                if shard in self.owned:
+                    continue
+                if (await c.execute(text("SELECT pg_try_advisory_lock(:c, :s)"), {"c": LOCK_CLASS, "s": shard})).scalar():
+                    gained.append(shard)
+            await c.commit()
+        self._confirmed = asyncio.get_running_loop().time()
+        if gained:
+            # drained only once on_gain is done (it may pick up per-user work the last owner left)
+            if self.on_gain:
+                await self.on_gain(gained)
+            self.owned.update(gained)
+            _LOG.info("Worker %s took shards %s (%s owned, %s live workers).", self.id, gained, len(self.owned), live)
+
+    async def _release(self, shards: list[int], owned: bool):
+        hook = self.on_shed if owned else self.on_lost
+        if hook:
+            try:
+                await hook(shards)
+            except Exception:
+                _LOG.exception("Releasing shards %s failed", shards)
+
+    async def shed(self):
+        """Give up shards above the current even share (a worker joined)."""
+        extra = sorted(self.owned)[self.target:]
+        if not extra:
+            return
+        await self._release(extra, True)
+        async with self._conn_lock:
+            for shard in extra:
+                await self._conn.execute(text("SELECT pg_advisory_unlock(:c, :s)"), {"c": LOCK_CLASS, "s": shard})
+                self.owned.discard(shard)
+            await self._conn.commit()
+        _LOG.info("Worker %s released shards %s.", self.id, extra)
+
+    async def drain(self) -> int:
+        """Handle up to BATCH queued updates for owned shards; shards run concurrently, each in order."""
+        if not self.owned:
+            return 0
+        async with SessionLocal() as s:
+            rows = (await s.execute(
+                select(UpdateQueue.id, UpdateQueue.shard, UpdateQueue.payload)
+                .where(UpdateQueue.shard.in_(sorted(self.owned)))
+                .order_by(UpdateQueue.id)
+                .limit(BATCH)
+            )).all()
+        if not rows:
+            return 0
+        by_shard = {}
+        for r in rows:
+            by_shard.setdefault(r.shard, []).append(r)
+        done = await asyncio.gather(*(self._run_shard(rs) for rs in by_shard.values()))
+        handled = [i for ids in done for i in ids]
+        if handled:
+            async with SessionLocal() as s:
+                await s.execute(delete(UpdateQueue).where(UpdateQueue.id.in_(handled)))
+                await s.commit()
+        return len(handled)
+
+    async def _still_owns(self, shard: int) -> bool:
+        """Fencing: does this worker still hold `shard`? A worker that was paused
+        past DEAD_AFTER_SECONDS may have had its lock connection terminated and
+        its shards taken while it wasn't looking; if the connection hasn't
+        answered within a heartbeat, ask the server before handling anything."""
+        if shard not in self.owned or self._beat is None or self._beat.done():
+            return False
+        if asyncio.get_running_loop().time() - self._confirmed < HEARTBEAT_SECONDS:
+            return True
+        try:
+            async with self._conn_lock:
+                held = (await self._conn.execute(text(
+                    "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND classid = :c "
+                    "AND objid = :s AND objsubid = 2 AND pid = pg_backend_pid() AND granted"
+                ), {"c": LOCK_CLASS, "s": shard})).scalar()
+                await self._conn.commit()
+        except Exception:
+            _LOG.warning("Worker %s lost its lock connection.", self.id, exc_info=True)
+            lost, self.owned = sorted(self.owned), set()
+            await self._release(lost, False)
+            return False
+        if not held:
+            self.owned.discard(shard)
+            await self._release([shard], False)
+            return False
+        self._confirmed = asyncio.get_running_loop().time()
+        return True
+
+    async def _run_shard(self, rows) -> list[int]:
+        """Handle one shard's rows in order; returns the ids handled. Stops at the
+        first update the shard is no longer owned for, leaving the rest queued
+        for its new owner."""
+        handled = []
+        for r in rows:
+            if not await self._still_owns(r.shard):
+                _LOG.warning("Worker %s no longer owns shard %s; leaving %s updates to its new owner.",
+                             self.id, r.shard, len(rows) - len(handled))
+                break
+            try:
+                await self.process(json.loads(r.payload))
+            except Exception:
+                _LOG.exception("Update %s failed", r.id)
+            handled.append(r.id)
+        return handled
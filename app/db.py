@@ -4,11 +4,72 @@ from typing import Optional
 
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Integer, Float, Date, Boolean, Text, UniqueConstraint, DateTime
+from sqlalchemy import String, Integer, BigInteger, Float, Date, Boolean, Text, LargeBinary, UniqueConstraint, Index, DateTime, event, inspect, text, func
+from sqlalchemy.engine import make_url
+
+from . import profiler
+from .utils import CURRENCY_EXPONENTS, minor_exponent
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./budget.db")
+DEFAULT_CURRENCY = os.getenv("CURRENCY", "USD")
+
+# Storage tuning: DB_PROFILE=tuned (default) applies the per-backend settings
+# below; DB_PROFILE=default leaves the engine at library defaults.
+DB_PROFILE = os.getenv("DB_PROFILE", "tuned").strip().lower()
+
+# SQLite (applied as PRAGMAs on every new connection)
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Postgres (pool sized for the worker's concurrent handlers)
+PG_POOL_SIZE = int(os.getenv("PG_POOL_SIZE", "5"))
+PG_MAX_OVERFLOW = int(os.getenv("PG_MAX_OVERFLOW", "5"))
+PG_POOL_RECYCLE_S = int(os.getenv("PG_POOL_RECYCLE_S", "1800"))
+PG_STATEMENT_TIMEOUT_MS = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", "15000"))
+PG_PREPARE_THRESHOLD = int(os.getenv("PG_PREPARE_THRESHOLD", "5"))
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+def _sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    try:
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    finally:
+        cur.close()
+
+def make_engine(url: str = DATABASE_URL, profile: str = DB_PROFILE):
+    """Create the async engine with the storage profile for its backend."""
+    backend = make_url(url).get_backend_name()
+    driver = make_url(url).get_driver_name()
+    kwargs = {}
+    if profile == "tuned" and backend == "postgresql":
+        kwargs.update(
+            pool_size=PG_POOL_SIZE,
+            max_overflow=PG_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=PG_POOL_RECYCLE_S,
+        )
+        if driver == "asyncpg":
+            kwargs["connect_args"] = {
+                "server_settings": {"statement_timeout": str(PG_STATEMENT_TIMEOUT_MS)},
+                "prepared_statement_cache_size": 100 if PG_PREPARE_THRESHOLD > 0 else 0,
+            }
+        else:  # psycopg 3
+            kwargs["connect_args"] = {
+                "options": f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}",
+                "prepare_threshold": PG_PREPARE_THRESHOLD if PG_PREPARE_THRESHOLD > 0 else None,
+            }
+    eng = create_async_engine(url, echo=False, future=True, **kwargs)
+    if profile == "tuned" and backend == "sqlite":
+        event.listen(eng.sync_engine, "connect", _sqlite_pragmas)
+    profiler.install(eng)
+    return eng
+
+engine = make_engine()
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 class Base(DeclarativeBase):
@@ -16,6 +77,8 @@ class Base(DeclarativeBase):
 
 class User(Base):
     __tablename__ = "users"
+    # the reminder tick: WHERE daily_reminders AND tz IN (...)
+    __table_args__ = (Index("ix_users_reminders", "daily_reminders", "tz"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     tg_id: Mapped[int] = mapped_column(Integer, unique=True, index=True)
     name: Mapped[Optional[str]] = mapped_column(String(120), nullable=True)
@@ -24,42 +87,310 @@ class User(Base):
     daily_reminders: Mapped[bool] = mapped_column(Boolean, default=False)
     last_chat_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
+# Budgets, weekly caps and freezes are per user. Their keys are unique indexes
+# rather than constraints so that _migrate can add them to existing tables.
 class Budget(Base):
     __tablename__ = "budgets"
+    __table_args__ = (Index("ux_budgets_user_envelope", "user_tg_id", "month", "category", "parent", unique=True),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer, default=0)
     month: Mapped[str] = mapped_column(String(7), index=True)  # YYYY-MM
     category: Mapped[str] = mapped_column(String(80), index=True)
-    parent: Mapped[Optional[str]] = mapped_column(String(80), nullable=True)
-    limit_amount: Mapped[float] = mapped_column(Float, default=0.0)
+    parent: Mapped[str] = mapped_column(String(80), default="")  # "" = no sub-category
+    limit_cents: Mapped[int] = mapped_column(BigInteger, default=0)  # minor units
+    rollover: Mapped[bool] = mapped_column(Boolean, default=False)  # leftover (or overspend) carries into next month
 
 class WeeklyCap(Base):
     __tablename__ = "weekly_caps"
+    __table_args__ = (Index("ux_weekly_caps_user_envelope", "user_tg_id", "category", "parent", unique=True),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer, default=0)
     category: Mapped[str] = mapped_column(String(80), index=True)
-    parent: Mapped[Optional[str]] = mapped_column(String(80), nullable=True)
-    cap_amount: Mapped[float] = mapped_column(Float, default=0.0)
+    parent: Mapped[str] = mapped_column(String(80), default="")  # "" = no sub-category
+    cap_cents: Mapped[int] = mapped_column(BigInteger, default=0)  # minor units
 
 class Freeze(Base):
     __tablename__ = "freezes"
+    __table_args__ = (Index("ux_freezes_user_envelope", "user_tg_id", "category", "parent", unique=True),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer, default=0)
     category: Mapped[str] = mapped_column(String(80))
-    parent: Mapped[Optional[str]] = mapped_column(String(80), nullable=True)
+    parent: Mapped[str] = mapped_column(String(80), default="")  # "" = no sub-category
     active: Mapped[bool] = mapped_column(Boolean, default=True)
 
 class Txn(Base):
     __tablename__ = "txns"
+    # keyset pagination of a user's history: WHERE user_tg_id = ? AND id < ? ORDER BY id DESC.
+    # AUTOINCREMENT: ids must never come back once their row moved to txns_archive,
+    # a compacted blob, or was deleted (SQLite otherwise hands out max(rowid)+1)
+    __table_args__ = (Index("ix_txns_user_id", "user_tg_id", "id"), {"sqlite_autoincrement": True})
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_tg_id: Mapped[int] = mapped_column(Integer, index=True)
     occurred_at: Mapped[date] = mapped_column(Date, index=True)
     month: Mapped[str] = mapped_column(String(7), index=True)  # YYYY-MM
     type: Mapped[str] = mapped_column(String(12))  # Income / Expense / Transfer
-    amount: Mapped[float] = mapped_column(Float)
+    amount_cents: Mapped[int] = mapped_column(BigInteger)  # minor units of `currency`
     currency: Mapped[str] = mapped_column(String(8), default="USD")
     category: Mapped[str] = mapped_column(String(80))
     parent: Mapped[Optional[str]] = mapped_column(String(80), nullable=True)
     note: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
 
+class WeeklySpend(Base):
+    # week-to-date Expense per user/envelope, maintained by app.ledger with every txn write
+    __tablename__ = "weekly_spend"
+    __table_args__ = (UniqueConstraint("user_tg_id", "week_start", "category", "parent", name="uq_weekly_spend"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    week_start: Mapped[date] = mapped_column(Date)  # ISO week (Monday)
+    category: Mapped[str] = mapped_column(String(80))
+    parent: Mapped[str] = mapped_column(String(80), default="")  # "" = no sub-category
+    spent_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+
+class TxnStat(Base):
+    # running Expense amount statistics per user/envelope (Welford), maintained by app.ledger
+    __tablename__ = "txn_stats"
+    __table_args__ = (UniqueConstraint("user_tg_id", "category", "parent", name="uq_txn_stats"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    category: Mapped[str] = mapped_column(String(80))
+    parent: Mapped[str] = mapped_column(String(80), default="")  # "" = no sub-category
+    n: Mapped[int] = mapped_column(Integer, default=0)
+    mean: Mapped[float] = mapped_column(Float, default=0.0)  # minor units
+    m2: Mapped[float] = mapped_column(Float, default=0.0)    # sum of squared deviations from the mean
+
+class TxnStatBucket(Base):
+    # per-month log-scale histogram of Expense amounts per user/envelope (quantile sketch), maintained by app.ledger
+    __tablename__ = "txn_stat_buckets"
+    __table_args__ = (UniqueConstraint("user_tg_id", "category", "parent", "month", "bucket", name="uq_txn_stat_bucket"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    category: Mapped[str] = mapped_column(String(80))
+    parent: Mapped[str] = mapped_column(String(80), default="")
+    month: Mapped[str] = mapped_column(String(7))
+    bucket: Mapped[int] = mapped_column(Integer)  # amounts in [GAMMA^bucket, GAMMA^(bucket+1))
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+class TxnSummary(Base):
+    # compacted months (app.retention): what their txns add up to per user/envelope
+    __tablename__ = "txn_summaries"
+    __table_args__ = (UniqueConstraint("user_tg_id", "month", "type", "category", "parent", "currency", name="uq_txn_summary"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    month: Mapped[str] = mapped_column(String(7))
+    type: Mapped[str] = mapped_column(String(12))
+    category: Mapped[str] = mapped_column(String(80))
+    parent: Mapped[str] = mapped_column(String(80), default="")  # "" = no sub-category
+    currency: Mapped[str] = mapped_column(String(8))
+    txn_count: Mapped[int] = mapped_column(Integer)
+    amount_cents: Mapped[int] = mapped_column(BigInteger)
+
+class TxnArchive(Base):
+    # compacted months (app.retention): a user's raw txns for the month as gzip JSONL
+    __tablename__ = "txn_archives"
+    __table_args__ = (UniqueConstraint("user_tg_id", "month", name="uq_txn_archive_user_month"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    month: Mapped[str] = mapped_column(String(7), index=True)
+    txn_count: Mapped[int] = mapped_column(Integer, default=0)
+    data: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)  # None once rehydrated
+    held_until: Mapped[Optional[date]] = mapped_column(Date, nullable=True)  # rehydrated: not compacted again before this
+
+class Goal(Base):
+    __tablename__ = "goals"
+    __table_args__ = (UniqueConstraint("user_tg_id", "name", name="uq_goal_user_name"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer, index=True)
+    name: Mapped[str] = mapped_column(String(80))
+    target_cents: Mapped[int] = mapped_column(BigInteger)  # minor units
+    monthly_cents: Mapped[int] = mapped_column(BigInteger, default=0)  # planned contribution per month
+    balance_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+    active: Mapped[bool] = mapped_column(Boolean, default=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+class GoalContribution(Base):
+    __tablename__ = "goal_contributions"
+    __table_args__ = (Index("ix_goal_contrib_user_month", "user_tg_id", "month"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    goal_id: Mapped[int] = mapped_column(Integer, index=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    month: Mapped[str] = mapped_column(String(7))  # YYYY-MM the money was left over in
+    amount_cents: Mapped[int] = mapped_column(BigInteger)
+    kind: Mapped[str] = mapped_column(String(12))  # sweep / manual
+    status: Mapped[str] = mapped_column(String(12), default="confirmed")  # pending / confirmed / skipped
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+class Template(Base):
+    # /<name> logs `text` as if it had been typed
+    __tablename__ = "templates"
+    __table_args__ = (UniqueConstraint("user_tg_id", "name", name="uq_template_user_name"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer)
+    name: Mapped[str] = mapped_column(String(32))
+    text: Mapped[str] = mapped_column(Text)
+
+class Recurring(Base):
+    __tablename__ = "recurring"
+    __table_args__ = (Index("ix_recurring_due", "active", "next_due"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(Integer, index=True)
+    every: Mapped[str] = mapped_column(String(8))  # daily / weekly / monthly / yearly
+    anchor_day: Mapped[int] = mapped_column(Integer)  # day of month to return to after short months
+    next_due: Mapped[date] = mapped_column(Date)
+    type: Mapped[str] = mapped_column(String(12))
+    amount_cents: Mapped[int] = mapped_column(BigInteger)
+    currency: Mapped[str] = mapped_column(String(8), default="USD")
+    category: Mapped[str] = mapped_column(String(80))
+    parent: Mapped[Optional[str]] = mapped_column(String(80), nullable=True)
+    note: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    active: Mapped[bool] = mapped_column(Boolean, default=True)
+
+class UpdateQueue(Base):
+    # multi-worker mode: updates received by the ingress, waiting for the worker owning their shard
+    __tablename__ = "update_queue"
+    __table_args__ = (Index("ix_update_queue_shard_id", "shard", "id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    update_id: Mapped[int] = mapped_column(BigInteger, unique=True)
+    shard: Mapped[int] = mapped_column(Integer)
+    payload: Mapped[str] = mapped_column(Text)  # Update.to_dict() as JSON
+    received_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+class ProcessedUpdate(Base):
+    # updates whose writes are committed (see app.idempotency); pruned after a few days
+    __tablename__ = "processed_updates"
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)  # u:<update_id> / m:<chat>:<message>
+    processed_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class HeldEntry(Base):
+    # app.admission: entries over a user's rate limit, kept until their batch is logged
+    __tablename__ = "held_entries"
+    __table_args__ = (Index("ix_held_entries_user_id", "user_tg_id", "id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(BigInteger)
+    update_id: Mapped[int] = mapped_column(BigInteger, unique=True)
+    payload: Mapped[str] = mapped_column(Text)  # Update.to_dict() as JSON
+    held_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+class ClusterWorker(Base):
+    __tablename__ = "cluster_workers"
+    worker_id: Mapped[str] = mapped_column(String(120), primary_key=True)
+    backend_pid: Mapped[int] = mapped_column(Integer)  # the connection holding its shard locks
+    shards: Mapped[int] = mapped_column(Integer, default=0)
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+def dialect_insert(bind):
+    """insert() for the active backend, so callers get .on_conflict_do_update()."""
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+# ------------------------------------------------------------------------------
+# In-place upgrades for databases created by older versions (idempotent)
+# ------------------------------------------------------------------------------
+# (table, old float column, new integer minor-units column)
+_MONEY_COLUMNS = [
+    ("txns", "amount", "amount_cents"),
+    ("budgets", "limit_amount", "limit_cents"),
+    ("weekly_caps", "cap_amount", "cap_cents"),
+]
+
+# (table, column, DDL) for columns added to existing tables
+_ADDED_COLUMNS = [
+    ("budgets", "rollover", "BOOLEAN NOT NULL DEFAULT FALSE"),
+]
+
+# (table, envelope key without the user) for config that used to be shared by all users
+_USER_SCOPED = [
+    ("budgets", ("month", "category", "parent")),
+    ("weekly_caps", ("category", "parent")),
+    ("freezes", ("category", "parent")),
+]
+
+def _minor_scale_sql(table: str) -> str:
+    if table == "txns":
+        cases = " ".join(f"WHEN '{c}' THEN {10 ** e}" for c, e in CURRENCY_EXPONENTS.items())
+        return f"(CASE UPPER(currency) {cases} ELSE 100 END)"
+    # budgets / caps carry no currency column: they are in the bot's currency
+    return str(10 ** minor_exponent(DEFAULT_CURRENCY))
+
+def _sqlite_autoincrement_txns(conn):
+    """Rebuild a txns table created without AUTOINCREMENT, and start its sequence
+    above every id issued so far (hot, archived or in a compacted blob)."""
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'txns'")).scalar() or ""
+    if "AUTOINCREMENT" in ddl.upper():
+        return
+    import gzip, json
+    from sqlalchemy import MetaData
+    from sqlalchemy.schema import CreateTable
+
+    tables = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+    top = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM txns")).scalar()
+    if "txns_archive" in tables:
+        top = max(top, conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM txns_archive")).scalar())
+    for (data,) in conn.execute(text("SELECT data FROM txn_archives WHERE data IS NOT NULL")):
+        top = max([top] + [json.loads(line)["id"] for line in gzip.decompress(data).decode("utf-8").splitlines()])
+    # the txns_all view and the search triggers are recreated by partitions.setup / search.setup
+    conn.execute(text("DROP VIEW IF EXISTS txns_all"))
+    conn.execute(text("PRAGMA legacy_alter_table = ON"))  # the archive's triggers name txns: don't rewrite them
+    rebuilt = Txn.__table__.to_metadata(MetaData(), name="txns_rebuild")
+    conn.execute(CreateTable(rebuilt))
+    # the old table's columns only: any it lacks take the model's defaults
+    have = {r[1] for r in conn.execute(text("PRAGMA table_info(txns)"))}
+    cols = ", ".join(c.name for c in Txn.__table__.columns if c.name in have)
+    conn.execute(text(f"INSERT INTO txns_rebuild ({cols}) SELECT {cols} FROM txns"))
+    conn.execute(text("DROP TABLE txns"))
+    conn.execute(text("ALTER TABLE txns_rebuild RENAME TO txns"))
+    conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'txns'"))
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('txns', :top)"), {"top": top})
+
+def _migrate(conn):
+    insp = inspect(conn)
+    for table, old, new in _MONEY_COLUMNS:
+        cols = {c["name"] for c in insp.get_columns(table)}
+        if old not in cols:
+            continue
+        if new not in cols:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {new} BIGINT NOT NULL DEFAULT 0"))
+        conn.execute(text(f"UPDATE {table} SET {new} = CAST(ROUND({old} * {_minor_scale_sql(table)}) AS BIGINT)"))
+        conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {old}"))
+    for table, col, ddl in _ADDED_COLUMNS:
+        if col not in {c["name"] for c in insp.get_columns(table)}:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}"))
+    insp = inspect(conn)  # the inspector caches columns; the ALTERs above changed them
+    for table, key in _USER_SCOPED:
+        cols = [c["name"] for c in insp.get_columns(table)]
+        if "user_tg_id" not in cols:
+            # shared rows become every existing user's own copy
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN user_tg_id INTEGER NOT NULL DEFAULT 0"))
+            copy = ", ".join(c for c in cols if c != "id")
+            conn.execute(text(
+                f"INSERT INTO {table} (user_tg_id, {copy}) SELECT u.tg_id, {', '.join('t.' + c for c in cols if c != 'id')} "
+                f"FROM {table} t CROSS JOIN users u WHERE t.user_tg_id = 0"
+            ))
+            conn.execute(text(f"DELETE FROM {table} WHERE user_tg_id = 0 AND EXISTS (SELECT 1 FROM users)"))
+        if not any(i.get("unique") and i["column_names"][0] == "user_tg_id" for i in insp.get_indexes(table)):
+            # NULL parents never compare equal, so they'd slip past the unique key
+            conn.execute(text(f"UPDATE {table} SET parent = '' WHERE parent IS NULL"))
+            # rows duplicated by the old select-then-insert writes: keep the newest
+            conn.execute(text(
+                f"DELETE FROM {table} WHERE id NOT IN "
+                f"(SELECT MAX(id) FROM {table} GROUP BY user_tg_id, {', '.join(key)})"
+            ))
+    # after the column migrations above: the rebuild copies txns as they now are
+    if conn.dialect.name == "sqlite":
+        _sqlite_autoincrement_txns(conn)
+    # indexes added to existing tables after they were first created (and the rebuilt txns')
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(conn, checkfirst=True)
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_migrate)
+        from . import partitions, search
+        await conn.run_sync(partitions.setup)
+        await conn.run_sync(search.setup)
@@ -0,0 +1,141 @@
+"""
+End-of-month projections for every envelope of a user at once.
+
+A user's daily Expense series for all envelopes is loaded with one grouped
+query into an (envelopes x days) array. Past months give a day-of-week profile
+per envelope; this month's spend divided by the profile weight of the days
+elapsed gives a seasonality-adjusted pace, which is projected over the
+profile weight of the days left.
+"""
+import os
+from calendar import monthrange
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import select, func
+
+from .db import Budget
+from .budget import carry_in
+from .partitions import txn_source
+from . import ledger
+
+HISTORY_MONTHS = int(os.getenv("FORECAST_HISTORY_MONTHS", "24"))
+PRIOR_DAYS = 3.0  # pull an early-month pace toward the historical daily mean
+
+_MODELS: dict = {}   # (user, day) -> (envelope index, dow profile[E, 7], daily mean[E])
+_RESULTS: dict = {}  # (user, day, data version) -> {envelope: (limit, spent, projected)}
+
+def _history_start(today: date) -> date:
+    y, m = today.year, today.month - HISTORY_MONTHS
+    while m <= 0:
+        y, m = y - 1, m + 12
+    return date(y, m, 1)
+
+def _dow_counts(start: date, end: date) -> np.ndarray:
+    """How many of each weekday (Mon=0) fall in [start, end]."""
+    days = (end - start).days + 1
+    counts = np.full(7, days // 7, dtype=np.float64)
+    for i in range(days % 7):
+        counts[(start.weekday() + i) % 7] += 1
+    return counts
+
+def seasonality(history: np.ndarray, first_day: date):
+    """history[E, D] daily spend from first_day -> (dow profile[E, 7] averaging 1, daily mean[E])."""
+    n_env, n_days = history.shape
+    if n_days == 0:
+        return np.ones((n_env, 7)), np.zeros(n_env)
+    dows = (np.arange(n_days) + first_day.weekday()) % 7
+    per_dow = np.zeros((n_env, 7))
+    for k in range(7):
+        per_dow[:, k] = history[:, dows == k].sum(axis=1)
+    counts = np.bincount(dows, minlength=7).astype(np.float64)
+    per_dow = per_dow / np.maximum(counts, 1)
+    daily_mean = history.sum(axis=1) / n_days
+    with np.errstate(divide="ignore", invalid="ignore"):
+        profile = np.where(daily_mean[:, None] > 0, per_dow / daily_mean[:, None], 1.0)
+    return profile, daily_mean
+
+def project(spent: np.ndarray, profile: np.ndarray, daily_mean: np.ndarray, today: date) -> np.ndarray:
+    """Projected month-end totals[E] from month-to-date spend[E] (all int minor units in, float out)."""
+    month_start = today.replace(day=1)
+    month_end = today.replace(day=monthrange(today.year, today.month)[1])
+    w_elapsed = profile @ _dow_counts(month_start, today)
+    w_left = profile @ _dow_counts(today + timedelta(days=1), month_end) if today < month_end else np.zeros(len(spent))
+    pace = (spent + daily_mean * PRIOR_DAYS) / np.maximum(w_elapsed + PRIOR_DAYS, 1e-9)
+    return spent + pace * w_left
+
+async def _load_model(session, user_id: int, today: date):
+    key = (user_id, today)
+    if key in _MODELS:
+        return _MODELS[key]
+    start = _history_start(today)
+    month_start = today.replace(day=1)
+    src = txn_source(start).c
+    parent = func.coalesce(src.parent, "")
+    q = await session.execute(
+        select(src.category, parent, src.occurred_at, func.sum(src.amount_cents))
+        .where(src.user_tg_id == user_id, src.type == "Expense", src.occurred_at >= start, src.occurred_at < month_start)
+        .group_by(src.category, parent, src.occurred_at)
+    )
+    rows = q.all()
+    envelopes = sorted({(c, p) for c, p, _d, _v in rows})
+    index = {e: i for i, e in enumerate(envelopes)}
+    # history only counts from the first day the user logged anything
+    first = min((d for _c, _p, d, _v in rows), default=month_start)
+    history = np.zeros((len(envelopes), (month_start - first).days))
+    if rows:
+        env_idx = np.fromiter((index[(c, p)] for c, p, _d, _v in rows), dtype=np.intp, count=len(rows))
+        day_idx = np.fromiter(((d - first).days for _c, _p, d, _v in rows), dtype=np.intp, count=len(rows))
+        np.add.at(history, (env_idx, day_idx), np.fromiter((v for *_k, v in rows), dtype=np.float64, count=len(rows)))
+    profile, daily_mean = seasonality(history, first)
+    model = (index, profile, daily_mean)
+    if len(_MODELS) > 1000:
+        _MODELS.clear()
+    _MODELS[key] = model
+    return model
+
+async def forecast_month(session, user_id: int, today: date) -> dict:
+    """{(category, parent or ""): (limit, spent, projected)} for this month's envelopes."""
+    key = (user_id, today, ledger.data_version(user_id))
+    if key in _RESULTS:
+        return _RESULTS[key]
+    month = f"{today.year:04d}-{today.month:02d}"
+    q = await session.execute(select(Budget.category, Budget.parent, Budget.limit_cents).where(
+        Budget.user_tg_id == user_id, Budget.month == month
+    ))
+    limits = {(c, p or ""): int(v or 0) for c, p, v in q.all()}
+    if not limits:
+        return {}
+    for e, cents in (await carry_in(session, user_id, month)).items():
+        if e in limits:
+            limits[e] += cents
+    envelopes = sorted(limits)
+    src = txn_source(month).c
+    parent = func.coalesce(src.parent, "")
+    q = await session.execute(
+        select(src.category, parent, func.sum(src.amount_cents))
+        .where(src.user_tg_id == user_id, src.type == "Expense", src.month == month, src.occurred_at <= today)
+        .group_by(src.category, parent)
+    )
+    mtd = {(c, p): int(v) for c, p, v in q.all()}
+
+    index, profile_all, mean_all = await _load_model(session, user_id, today)
+    # envelopes without history get a flat profile and no prior
+    profile = np.ones((len(envelopes), 7))
+    daily_mean = np.zeros(len(envelopes))
+    for i, e in enumerate(envelopes):
+        if e in index:
+            profile[i] = profile_all[index[e]]
+            daily_mean[i] = mean_all[index[e]]
+    spent = np.array([mtd.get(e, 0) for e in envelopes], dtype=np.float64)
+    projected = project(spent, profile, daily_mean, today)
+
+    result = {e: (limits[e], int(spent[i]), int(round(projected[i]))) for i, e in enumerate(envelopes)}
+    if len(_RESULTS) > 1000:
+        _RESULTS.clear()
+    _RESULTS[key] = result
+    return result
+
+def overshoots(result: dict) -> dict:
+    """Envelopes projected to end the month over their limit."""
+    return {e: v for e, v in result.items() if v[0] > 0 and v[2] > v[0]}
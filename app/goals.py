@@ -0,0 +1,199 @@
+"""
+Savings goals and the month-end sweep of leftover envelopes into them.
+
+The sweep is set-based: one INSERT ... SELECT computes every user's leftover
+for the month (sum of max(limit - spent, 0) over the month's envelopes) and
+splits it across their open goals in id order, each goal taking up to its
+monthly contribution (capped at what is still missing). Rows land as
+`pending` contributions; the user confirms or skips them with a button, and
+confirmation moves the money into the goal balances with two UPDATEs.
+"""
+import os, asyncio, logging
+
+from sqlalchemy import select, update, insert, func, case, and_, exists, literal, true, false
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from .db import Goal, GoalContribution, Budget, User, SessionLocal, DEFAULT_CURRENCY, dialect_insert
+from .partitions import txn_source
+from .utils import current_month, fmt_minor
+
+_LOG = logging.getLogger(__name__)
+
+SWEEP_HOUR = int(os.getenv("SWEEP_HOUR", "20"))
+SWEEP_SEND_PER_SEC = float(os.getenv("SWEEP_SEND_PER_SEC", "25"))  # stay under Telegram's broadcast limit
+
+# ------------------------------------------------------------------------------
+# Goals
+# ------------------------------------------------------------------------------
+async def add_goal(session, user_id: int, name: str, target_cents: int, monthly_cents: int):
+    """Create the goal, or update target/monthly if the user already has one by that name."""
+    ins = dialect_insert(session.bind)(Goal).values(
+        user_tg_id=user_id, name=name, target_cents=target_cents, monthly_cents=monthly_cents,
+        balance_cents=0, active=True,
+    )
+    await session.execute(ins.on_conflict_do_update(
+        index_elements=["user_tg_id", "name"],
+        set_={"target_cents": target_cents, "monthly_cents": monthly_cents, "active": True},
+    ))
+    await session.commit()
+
+async def list_goals(session, user_id: int):
+    q = await session.execute(
+        select(Goal).where(Goal.user_tg_id == user_id, Goal.active == True).order_by(Goal.id)
+    )
+    return q.scalars().all()
+
+async def contribute(session, user_id: int, name: str, amount_cents: int):
+    """Manual contribution; returns the goal (None if the user has no such goal)."""
+    q = await session.execute(select(Goal).where(Goal.user_tg_id == user_id, Goal.name == name, Goal.active == True))
+    g = q.scalars().first()
+    if not g:
+        return None
+    g.balance_cents += amount_cents
+    session.add(GoalContribution(
+        goal_id=g.id, user_tg_id=user_id, month=current_month(), amount_cents=amount_cents,
+        kind="manual", status="confirmed",
+    ))
+    await session.commit()
+    return g
+
+# ------------------------------------------------------------------------------
+# Sweep
+# ------------------------------------------------------------------------------
+def _sweep_stmt(month: str, user_id: int | None = None):
+    g, c, b = Goal.__table__, GoalContribution.__table__, Budget.__table__
+    src = txn_source(month)
+
+    open_goal = (g.c.active == true()) & (g.c.monthly_cents > 0) & (g.c.balance_cents < g.c.target_cents)
+    if user_id is not None:
+        open_goal &= g.c.user_tg_id == user_id
+    # a goal is swept at most once per month
+    unswept = ~exists().where(c.c.goal_id == g.c.id, c.c.month == month, c.c.kind == "sweep")
+
+    users = select(g.c.user_tg_id).where(open_goal, unswept).distinct().subquery("sweep_users")
+    parent = func.coalesce(src.c.parent, "")
+    spent = (
+        select(src.c.user_tg_id, src.c.category, parent.label("parent"), func.sum(src.c.amount_cents).label("spent"))
+        .where(src.c.type == "Expense", src.c.month == month, src.c.user_tg_id.in_(select(users.c.user_tg_id)))
+        .group_by(src.c.user_tg_id, src.c.category, parent)
+        .subquery("sweep_spent")
+    )
+    env_left = b.c.limit_cents - func.coalesce(spent.c.spent, 0)
+    leftover = (
+        select(users.c.user_tg_id, func.sum(case((env_left > 0, env_left), else_=0)).label("leftover"))
+        .select_from(
+            # rollover envelopes keep their leftover for next month
+            users.join(b, (b.c.user_tg_id == users.c.user_tg_id) & (b.c.month == month) & (b.c.rollover == false()))
+            .outerjoin(spent, and_(
+                spent.c.user_tg_id == users.c.user_tg_id,
+                spent.c.category == b.c.category,
+                spent.c.parent == b.c.parent,
+            ))
+        )
+        .group_by(users.c.user_tg_id)
+        .subquery("sweep_leftover")
+    )
+    # leftover already promised to goals swept earlier in the month
+    promised = (
+        select(c.c.user_tg_id, func.sum(c.c.amount_cents).label("amount"))
+        .where(c.c.month == month, c.c.kind == "sweep", c.c.status != "skipped")
+        .group_by(c.c.user_tg_id)
+        .subquery("sweep_promised")
+    )
+    missing = g.c.target_cents - g.c.balance_cents
+    want = case((missing < g.c.monthly_cents, missing), else_=g.c.monthly_cents)
+    wants = (
+        select(
+            g.c.id.label("goal_id"), g.c.user_tg_id, want.label("want"),
+            func.sum(want).over(partition_by=g.c.user_tg_id, order_by=g.c.id).label("upto"),
+        )
+        .where(open_goal, unswept)
+        .subquery("sweep_wants")
+    )
+    avail = leftover.c.leftover - func.coalesce(promised.c.amount, 0) - (wants.c.upto - wants.c.want)
+    sel = (
+        select(
+            wants.c.goal_id, wants.c.user_tg_id, literal(month),
+            case((avail < wants.c.want, avail), else_=wants.c.want),
+            literal("sweep"), literal("pending"),
+        )
+        .select_from(
+            wants.join(leftover, leftover.c.user_tg_id == wants.c.user_tg_id)
+            .outerjoin(promised, promised.c.user_tg_id == wants.c.user_tg_id)
+        )
+        .where(avail > 0)
+    )
+    # derived tables rather than CTEs: the statement must start with INSERT for rowcount
+    return insert(c).from_select(["goal_id", "user_tg_id", "month", "amount_cents", "kind", "status"], sel)
+
+async def sweep_month(session, month: str, user_id: int | None = None) -> int:
+    """Queue pending sweep contributions for every user (or one). Returns rows inserted."""
+    res = await session.execute(_sweep_stmt(month, user_id))
+    await session.commit()
+    return res.rowcount or 0
+
+async def pending_sweeps(session, month: str, user_id: int | None = None) -> dict:
+    """{user: [(goal name, amount)]} awaiting confirmation."""
+    c = GoalContribution.__table__
+    q = select(c.c.user_tg_id, Goal.name, c.c.amount_cents).join(Goal, Goal.id == c.c.goal_id).where(
+        c.c.month == month, c.c.kind == "sweep", c.c.status == "pending"
+    )
+    if user_id is not None:
+        q = q.where(c.c.user_tg_id == user_id)
+    out = {}
+    for uid, name, amt in (await session.execute(q.order_by(c.c.user_tg_id, c.c.goal_id))).all():
+        out.setdefault(uid, []).append((name, int(amt)))
+    return out
+
+async def settle_sweep(session, user_id: int, month: str, confirm: bool) -> int:
+    """Confirm (credit the goals) or skip the user's pending sweep. Returns the amount credited."""
+    c = GoalContribution.__table__
+    pending = (c.c.user_tg_id == user_id) & (c.c.month == month) & (c.c.kind == "sweep") & (c.c.status == "pending")
+    total = int((await session.execute(select(func.sum(c.c.amount_cents)).where(pending))).scalar() or 0)
+    if confirm and total:
+        per_goal = (
+            select(func.sum(c.c.amount_cents)).where(pending, c.c.goal_id == Goal.id).scalar_subquery()
+        )
+        await session.execute(
+            update(Goal)
+            .where(Goal.user_tg_id == user_id, exists().where(pending, c.c.goal_id == Goal.id))
+            .values(balance_cents=Goal.balance_cents + per_goal)
+        )
+    await session.execute(update(c).where(pending).values(status="confirmed" if confirm else "skipped"))
+    await session.commit()
+    return total if confirm else 0
+
+def sweep_text(month: str, items, currency: str) -> str:
+    lines = [f"*Month-end sweep ({month})* — move leftover budget into your goals?"]
+    for name, amt in items:
+        lines.append(f"- {name}: `{fmt_minor(amt, currency)}`")
+    return "\n".join(lines)
+
+def sweep_keyboard(month: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Sweep", callback_data=f"SWEEP:OK:{month}"),
+        InlineKeyboardButton("Skip", callback_data=f"SWEEP:NO:{month}"),
+    ]])
+
+async def sweep_job(context):
+    """Runs on the last day of the month: queue every user's sweep, then ask each to confirm."""
+    month = current_month()
+    async with SessionLocal() as s:
+        queued = await sweep_month(s, month)
+        pending = await pending_sweeps(s, month)
+        chats = dict((await s.execute(
+            select(User.tg_id, User.last_chat_id).where(User.tg_id.in_(list(pending)), User.last_chat_id.is_not(None))
+        )).all()) if pending else {}
+    _LOG.info("Sweep %s: %s contributions queued for %s users", month, queued, len(pending))
+    for uid, items in pending.items():
+        chat_id = chats.get(uid)
+        if not chat_id:
+            continue
+        try:
+            await context.bot.send_message(
+                chat_id, sweep_text(month, items, DEFAULT_CURRENCY),
+                parse_mode="Markdown", reply_markup=sweep_keyboard(month),
+            )
+        except Exception as e:
+            _LOG.warning("Sweep prompt to %s failed: %s", uid, e)
+        await asyncio.sleep(1 / SWEEP_SEND_PER_SEC)
@@ -0,0 +1,85 @@
+"""
+/history pages, fetched by keyset on (user_tg_id, id) — never OFFSET — so the
+hundredth page costs the same as the first.
+
+A page is either the newest rows (cursor None), the rows older than the last
+one shown ("N", id) or the rows newer than the first one shown ("P", id).
+"""
+import os, re
+from calendar import monthrange
+from datetime import date
+
+from sqlalchemy import select
+
+from .partitions import txn_source
+from .utils import fmt_minor
+
+PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
+
+_CAT_RE = re.compile(r"^#([^;/:>]+)(?:(?:;sub=|/|:|>)(.+))?$")
+
+def parse_filters(args: list[str]) -> dict:
+    """`#Food;sub=X from=YYYY-MM-DD to=YYYY-MM-DD month=YYYY-MM expense|income` -> filters; raises ValueError."""
+    f = {}
+    for a in args:
+        low = a.lower()
+        if low in ("expense", "income", "type=expense", "type=income"):
+            f["type"] = low.split("=")[-1].capitalize()
+        elif low.startswith("from="):
+            f["from"] = date.fromisoformat(a[5:])
+        elif low.startswith("to="):
+            f["to"] = date.fromisoformat(a[3:])
+        elif low.startswith("month="):
+            y, m = map(int, a[6:].split("-"))
+            f["from"] = date(y, m, 1)
+            f["to"] = date(y, m, monthrange(y, m)[1])
+        elif _CAT_RE.match(a):
+            m = _CAT_RE.match(a)
+            f["category"], f["parent"] = m.group(1), m.group(2)
+        else:
+            raise ValueError(f"Unknown filter `{a}`")
+    return f
+
+def describe(f: dict) -> str:
+    parts = []
+    if "category" in f:
+        parts.append(f["category"] + (f" › {f['parent']}" if f["parent"] else ""))
+    if "type" in f:
+        parts.append(f["type"])
+    if "from" in f or "to" in f:
+        parts.append(f"{f.get('from', '…')} → {f.get('to', '…')}")
+    return ", ".join(parts)
+
+async def fetch_page(session, user_id: int, f: dict, cursor=None, size: int = PAGE_SIZE):
+    """-> (rows newest first, has_older, has_newer)"""
+    src = txn_source(f.get("from"))
+    q = select(src).where(src.c.user_tg_id == user_id)
+    if "category" in f:
+        q = q.where(src.c.category == f["category"])
+        if f["parent"]:
+            q = q.where(src.c.parent == f["parent"])
+    if "type" in f:
+        q = q.where(src.c.type == f["type"])
+    if "from" in f:
+        q = q.where(src.c.occurred_at >= f["from"])
+    if "to" in f:
+        q = q.where(src.c.occurred_at <= f["to"])
+
+    if cursor and cursor[0] == "P":
+        q = q.where(src.c.id > cursor[1]).order_by(src.c.id.asc())
+    else:
+        if cursor:
+            q = q.where(src.c.id < cursor[1])
+        q = q.order_by(src.c.id.desc())
+    rows = [dict(r) for r in (await session.execute(q.limit(size + 1))).mappings().all()]
+    more = len(rows) > size
+    rows = rows[:size]
+    if cursor and cursor[0] == "P":
+        return rows[::-1], True, more
+    return rows, more, cursor is not None
+
+def row_label(r: dict) -> str:
+    return (
+        f"#{r['id']} {r['occurred_at']} {r['type']} {fmt_minor(r['amount_cents'], r['currency'])} {r['category']}"
+        + (f" › {r['parent']}" if r['parent'] else "")
+    )
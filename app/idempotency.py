@@ -0,0 +1,90 @@
+"""
+Safe redelivery of Telegram updates.
+
+A handler that writes claims its update in `processed_updates` inside the
+same transaction as the write, so an update handled twice (Telegram
+redelivering after a crash, a worker re-running a batch) changes nothing the
+second time. That lets the bot keep the backlog on restart instead of
+dropping it, and catch up with users handled concurrently (each user's
+updates still one at a time, in order).
+"""
+import os, asyncio, logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+from telegram.ext import BaseUpdateProcessor
+
+from .db import ProcessedUpdate, SessionLocal, PG_POOL_SIZE, PG_MAX_OVERFLOW, dialect_insert
+
+_LOG = logging.getLogger(__name__)
+
+TTL_DAYS = int(os.getenv("PROCESSED_UPDATES_TTL_DAYS", "3"))  # Telegram keeps undelivered updates for 24h
+# handlers running at once; each holds a pooled connection, so no more than the pool
+MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT_UPDATES", str(PG_POOL_SIZE + PG_MAX_OVERFLOW)))
+
+def update_key(update, forced: bool = False) -> str:
+    """`u:<update_id>`; `m:<chat>:<message>` when the text being handled came from
+    a command (/override, templates), which can be retried as a new update."""
+    msg = getattr(update, "effective_message", None)
+    if forced and msg is not None:
+        return f"m:{msg.chat_id}:{msg.message_id}"
+    return f"u:{update.update_id}"
+
+async def claim(session, update, forced: bool = False) -> bool:
+    """Record the update as handled (not committed: the caller's write commits it).
+    False if it already was, in which case the caller should do nothing."""
+    key = update_key(update, forced)
+    ins = dialect_insert(session.bind)(ProcessedUpdate).values(key=key, processed_at=datetime.utcnow())
+    # psycopg's cursor is closed before rowcount is read on a plain INSERT unless asked to keep it
+    res = await session.execute(ins.on_conflict_do_nothing(index_elements=["key"]).execution_options(preserve_rowcount=True))
+    if not res.rowcount:
+        _LOG.info("Update %s already handled; skipping.", key)
+        return False
+    return True
+
+async def prune(session, ttl_days: int = TTL_DAYS) -> int:
+    res = await session.execute(
+        delete(ProcessedUpdate).where(ProcessedUpdate.processed_at < datetime.utcnow() - timedelta(days=ttl_days))
+    )
+    await session.commit()
+    return res.rowcount or 0
+
+async def prune_job(context):
+    async with SessionLocal() as s:
+        n = await prune(s)
+    if n:
+        _LOG.info("Pruned %s processed update keys.", n)
+
+class PerUserUpdates(BaseUpdateProcessor):
+    """Handle different users' updates concurrently and each user's in arrival order.
+
+    A slot is taken only once the update is next in line for its user: PTB's own
+    semaphore is taken before do_process_update, so a user with a backlog would
+    hold one slot per queued update while those just wait on the user's lock."""
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT):
+        super().__init__(1 << 30)  # effectively unlimited; the real limit is self._slots
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._locks: dict[int, list] = {}  # user -> [lock, tasks holding or waiting]
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,191 @@
+"""
+Every write to txns goes through here, so the state derived from txns
+(week-to-date counters, amount statistics, ...) changes in the same transaction as the rows
+themselves, and in-memory state (data versions, category usage) with them.
+Nothing in this module commits; the caller does. Category usage is only
+updated once that commit succeeds (a rollback drops the update).
+"""
+from collections import defaultdict
+
+from sqlalchemy import select, delete, insert, func, cast, Date, event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .db import Txn, WeeklySpend, dialect_insert
+from .budget import week_range, month_of, forget_carry
+from .partitions import txn_source, txn_tables, unarchive_current
+from .utils import current_month
+from . import mru, anomaly
+
+# Bumped on every write, so in-memory caches built from a user's data (forecasts,
+# snapshots, ...) can key on it. None is the shared slot (budgets, caps).
+_VERSIONS = defaultdict(int)
+
+def data_version(user_id: int) -> tuple:
+    return (_VERSIONS[None], _VERSIONS[user_id])
+
+def bump_version(user_id: int | None = None):
+    _VERSIONS[user_id] += 1
+
+def _on_commit(session: AsyncSession, fn, *args):
+    """Call fn(*args) when the session's transaction commits; never if it rolls back."""
+    session.sync_session.info.setdefault("on_commit", []).append((fn, args))
+
+@event.listens_for(Session, "after_commit")
+def _run_on_commit(session):
+    for fn, args in session.info.pop("on_commit", []):
+        fn(*args)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_on_rollback(session):
+    session.info.pop("on_commit", None)
+
+def _closed_months_written(rows):
+    # rollover carries are cached per month and only depend on closed months
+    for uid in {r["user_tg_id"] for r in rows if r["month"] < current_month()}:
+        forget_carry(uid)
+
+def row_dict(t: Txn) -> dict:
+    return {c.name: getattr(t, c.name) for c in Txn.__table__.columns}
+
+# ------------------------------------------------------------------------------
+# Week-to-date counters
+# ------------------------------------------------------------------------------
+def _weekly_deltas(rows, sign: int, deltas: dict):
+    for r in rows:
+        if r["type"] != "Expense":
+            continue
+        key = (r["user_tg_id"], week_range(r["occurred_at"])[0], r["category"], r["parent"] or "")
+        deltas[key] = deltas.get(key, 0) + sign * int(r["amount_cents"])
+
+async def _bump_weekly(session: AsyncSession, deltas: dict):
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    ins = dialect_insert(session.bind)(WeeklySpend).values([
+        dict(user_tg_id=u, week_start=w, category=c, parent=p, spent_cents=v)
+        for (u, w, c, p), v in deltas.items()
+    ])
+    await session.execute(ins.on_conflict_do_update(
+        index_elements=["user_tg_id", "week_start", "category", "parent"],
+        set_={"spent_cents": WeeklySpend.spent_cents + ins.excluded.spent_cents},
+    ))
+
+async def backfill_weekly(session: AsyncSession, only_if_empty: bool = False) -> int:
+    """Rebuild weekly_spend from txns with one INSERT ... SELECT ... GROUP BY."""
+    if only_if_empty and (await session.execute(select(WeeklySpend.id).limit(1))).first():
+        return 0
+    src = txn_source()
+    if session.bind.dialect.name == "postgresql":
+        week = cast(func.date_trunc("week", src.c.occurred_at), Date)
+    else:
+        week = func.date(src.c.occurred_at, "weekday 0", "-6 days")  # Monday of the ISO week
+    parent = func.coalesce(src.c.parent, "")
+    sel = (
+        select(src.c.user_tg_id, week, src.c.category, parent, func.sum(src.c.amount_cents))
+        .where(src.c.type == "Expense")
+        .group_by(src.c.user_tg_id, week, src.c.category, parent)
+    )
+    await session.execute(delete(WeeklySpend))
+    res = await session.execute(
+        insert(WeeklySpend).from_select(["user_tg_id", "week_start", "category", "parent", "spent_cents"], sel)
+    )
+    await session.commit()
+    return res.rowcount or 0
+
+# ------------------------------------------------------------------------------
+# Txn writes
+# ------------------------------------------------------------------------------
+async def add_txns(session: AsyncSession, txns: list[Txn]) -> list[Txn]:
+    session.add_all(txns)
+    await session.flush()  # assigns ids
+    for uid in {t.user_tg_id for t in txns}:
+        bump_version(uid)
+    rows = [row_dict(t) for t in txns]
+    _on_commit(session, mru.added, rows)
+    _closed_months_written(rows)
+    deltas = {}
+    _weekly_deltas(rows, +1, deltas)
+    await _bump_weekly(session, deltas)
+    stats, buckets = {}, {}
+    anomaly.deltas(rows, +1, stats, buckets)
+    await anomaly.apply(session, stats, buckets)
+    return txns
+
+async def fetch_txns(session: AsyncSession, user_id: int, ids) -> list[dict]:
+    src = txn_source()
+    q = await session.execute(src.select().where(src.c.id.in_(list(ids)), src.c.user_tg_id == user_id))
+    return [dict(r) for r in q.mappings().all()]
+
+async def update_txn(session: AsyncSession, user_id: int, tid: int, **changes) -> dict | None:
+    """Apply column changes to one of the user's txns; returns the new row (None if not found)."""
+    rows = await fetch_txns(session, user_id, [tid])
+    if not rows:
+        return None
+    old = rows[0]
+    if "occurred_at" in changes:
+        changes["month"] = month_of(changes["occurred_at"])
+    for t in txn_tables():
+        await session.execute(t.update().where(t.c.id == tid, t.c.user_tg_id == user_id).values(**changes))
+    if "month" in changes:
+        await unarchive_current(session, [tid])
+    bump_version(user_id)
+    new = {**old, **changes}
+    _on_commit(session, mru.changed, old, new)
+    _closed_months_written([old, new])
+    deltas = {}
+    _weekly_deltas([old], -1, deltas)
+    _weekly_deltas([new], +1, deltas)
+    await _bump_weekly(session, deltas)
+    stats, buckets = {}, {}
+    anomaly.deltas([old], -1, stats, buckets)
+    anomaly.deltas([new], +1, stats, buckets)
+    await anomaly.apply(session, stats, buckets)
+    return new
+
+async def delete_txns(session: AsyncSession, user_id: int, ids) -> list[dict]:
+    """Delete the user's txns with these ids; returns the rows that were removed."""
+    ids = list(ids)
+    rows = await fetch_txns(session, user_id, ids)
+    if not rows:
+        return []
+    for t in txn_tables():
+        await session.execute(t.delete().where(t.c.id.in_(ids), t.c.user_tg_id == user_id))
+    bump_version(user_id)
+    _on_commit(session, mru.removed, rows)
+    _closed_months_written(rows)
+    deltas = {}
+    _weekly_deltas(rows, -1, deltas)
+    await _bump_weekly(session, deltas)
+    stats, buckets = {}, {}
+    anomaly.deltas(rows, -1, stats, buckets)
+    await anomaly.apply(session, stats, buckets)
+    return rows
+
+# ------------------------------------------------------------------------------
+# Compaction (app.retention): rows leave for a month archive and come back from it.
+# Week-to-date counters only matter for the current week and amount statistics
+# describe everything ever logged, so neither touches them.
+# ------------------------------------------------------------------------------
+_CHUNK = 500  # ids per DELETE, under SQLite's bound-parameter limit
+
+async def archive_out(session: AsyncSession, rows: list[dict]):
+    by_user = {}
+    for r in rows:
+        by_user.setdefault(r["user_tg_id"], []).append(r["id"])
+    # (user, id) like delete_txns: an id alone could match someone else's live row
+    for uid, ids in by_user.items():
+        for i in range(0, len(ids), _CHUNK):
+            for t in txn_tables():
+                await session.execute(t.delete().where(t.c.user_tg_id == uid, t.c.id.in_(ids[i:i + _CHUNK])))
+        bump_version(uid)
+    _on_commit(session, mru.removed, rows)
+
+async def restore(session: AsyncSession, rows: list[dict]):
+    """Put archived rows back, ids and all."""
+    if not rows:
+        return
+    await session.execute(insert(Txn), rows)
+    for uid in {r["user_tg_id"] for r in rows}:
+        bump_version(uid)
+    _on_commit(session, mru.removed, rows)  # usage counts are rebuilt with them on next use
@@ -0,0 +1,112 @@
+"""
+Per-user category usage: the most recently used (category, parent) and how
+often each pair has been used.
+
+A user's table is warmed from one GROUP BY the first time they need it and
+kept in step by app.ledger on every committed insert and edit (a delete drops
+it), so picking a default category for an untagged message never touches the
+DB.
+"""
+import os
+
+from sqlalchemy import select, func
+
+from .db import SessionLocal
+from .partitions import txn_source
+
+QUICK_PICKS = int(os.getenv("QUICK_PICKS", "6"))  # buttons on the quick-pick keyboard
+
+class _Usage:
+    __slots__ = ("counts", "seen", "last")
+
+    def __init__(self):
+        self.counts: dict[tuple, int] = {}  # (category, parent) -> uses
+        self.seen: dict[tuple, int] = {}    # (category, parent) -> newest txn id
+        self.last: tuple | None = None
+
+_USERS: dict[int, _Usage] = {}
+_WRITES: dict[int, int] = {}  # user -> committed writes seen, to spot a warm-up that raced one
+
+def _key(r) -> tuple:
+    return (r["category"], r["parent"] or None)
+
+async def _warm(user_id: int) -> _Usage:
+    before = _WRITES.get(user_id, 0)
+    src = txn_source()
+    q = (
+        select(src.c.category, src.c.parent, func.count(), func.max(src.c.id))
+        .where(src.c.user_tg_id == user_id)
+        .group_by(src.c.category, src.c.parent)
+    )
+    async with SessionLocal() as s:
+        rows = (await s.execute(q)).all()
+    u = _Usage()
+    for cat, parent, n, newest in rows:
+        k = (cat, parent or None)
+        u.counts[k] = u.counts.get(k, 0) + n
+        u.seen[k] = max(u.seen.get(k, 0), newest)
+    if u.seen:
+        u.last = max(u.seen, key=u.seen.get)
+    if _WRITES.get(user_id, 0) != before:
+        # a write committed while the query ran may be missing from its snapshot,
+        # and wasn't applied (nothing was cached yet): use this table once, warm again next time
+        return u
+    return _USERS.setdefault(user_id, u)
+
+async def usage(user_id: int) -> _Usage:
+    return _USERS.get(user_id) or await _warm(user_id)
+
+async def last_category(user_id: int) -> tuple | None:
+    return (await usage(user_id)).last
+
+async def top_categories(user_id: int, n: int = QUICK_PICKS) -> list[tuple]:
+    """Most used pairs first (ties: most recent first)."""
+    u = await usage(user_id)
+    return sorted(u.counts, key=lambda k: (u.counts[k], u.seen.get(k, 0)), reverse=True)[:n]
+
+def forget(pred):
+    """Drop the tables of users matching `pred` (rebuilt on next use)."""
+    for uid in [u for u in _USERS if pred(u)]:
+        del _USERS[uid]
+
+# ------------------------------------------------------------------------------
+# Kept in step by app.ledger, after the write commits. Users not cached are
+# skipped: their next warm-up sees the rows, or notices it raced them (_WRITES).
+# ------------------------------------------------------------------------------
+def _wrote(user_id: int) -> _Usage | None:
+    _WRITES[user_id] = _WRITES.get(user_id, 0) + 1
+    return _USERS.get(user_id)
+
+def added(rows):
+    for r in rows:
+        u = _wrote(r["user_tg_id"])
+        if u is None:
+            continue
+        k = _key(r)
+        u.counts[k] = u.counts.get(k, 0) + 1
+        if r["id"] >= u.seen.get(k, 0):
+            u.seen[k] = r["id"]
+        if u.last is None or r["id"] >= u.seen.get(u.last, 0):
+            u.last = k
+
+def removed(rows):
+    # which pair was used last before the deleted rows isn't known here; deletes
+    # are rare, so the user's table is simply rebuilt on next use
+    for r in rows:
+        _wrote(r["user_tg_id"])
+        _USERS.pop(r["user_tg_id"], None)
+
+def changed(old, new):
+    u = _wrote(old["user_tg_id"])
+    if u is None or _key(old) == _key(new):
+        return
+    was, k = _key(old), _key(new)
+    if u.counts.get(was, 0) > 1:
+        u.counts[was] -= 1
+    else:
+        u.counts.pop(was, None)
+        u.seen.pop(was, None)
+    u.counts[k] = u.counts.get(k, 0) + 1
+    u.seen[k] = max(u.seen.get(k, 0), new["id"])
+    if u.last == was and new["id"] >= u.seen.get(was, 0):
+        u.last = k
@@ -2,6 +2,8 @@ import re
 from datetime import datetime, timedelta, date
 from typing import Dict, List
 
+from .utils import to_minor
+
 AMOUNT_RE = re.compile(r"([$])?\s*([-+]?\d+(?:[\.,]\d{1,2})?)")
 HASH_RE = re.compile(r"#([A-Za-z][\w\-/ ]*)")
 SUB_RE = re.compile(r"(?:;sub=|;g=)([^\s]+)")
@@ -11,7 +13,7 @@ YESTERDAY_RE = re.compile(r"\byesterday\b", re.IGNORECASE)
 def _split_categories(t: str) -> List[str]:
     return [p.strip() for p in t.split("+")]
 
-def parse_message(text: str) -> Dict:
+def parse_message(text: str, currency: str = "USD") -> Dict:
     t = text.strip()
 
     if t.startswith("+"):
@@ -26,7 +28,7 @@ def parse_message(text: str) -> Dict:
     m = AMOUNT_RE.search(t)
     if not m:
         raise ValueError("No amount found. Try like: 12 coffee #Food")
-    amount = float(m.group(2).replace(",", ""))
+    amount_cents = to_minor(m.group(2).replace(",", ""), currency)
 
     d = datetime.utcnow().date()
     if YESTERDAY_RE.search(t):
@@ -34,6 +36,8 @@ def parse_message(text: str) -> Dict:
     mon = ON_RE.search(t)
     if mon:
         d = datetime.strptime(mon.group(1), "%Y-%m-%d").date()
+    # date tokens are not part of a category name ("#Housing on=2026-11-01")
+    t = YESTERDAY_RE.sub("", ON_RE.sub("", t))
 
     cat_parts = _split_categories(t)
     categories = []
@@ -54,4 +58,4 @@ def parse_message(text: str) -> Dict:
     note = YESTERDAY_RE.sub("", note)
     note = re.sub(AMOUNT_RE, "", note, count=1).strip()
 
-    return {"type": type_, "amount": amount, "note": note, "categories": categories, "date": d}
+    return {"type": type_, "amount_cents": amount_cents, "note": note, "categories": categories, "date": d}
@@ -0,0 +1,208 @@
+"""
+Hot/cold split of `txns` by month.
+
+Postgres: `txns` is a native declarative partitioned table (RANGE on `month`),
+one partition per month plus a DEFAULT catch-all. Filters on `month` prune to
+the right partition, so the current month only ever touches its own.
+
+SQLite: `txns` holds the hot data (current month, plus anything not archived
+yet), `txns_archive` holds closed months and `txns_all` is a UNION ALL view.
+`txn_source()` routes a read to the hot table when its range starts in the
+current month and to the view otherwise.
+
+The daily `archive_job` moves closed months out of the hot store (SQLite) or
+out of the DEFAULT partition into their own partitions (Postgres).
+"""
+import os, logging
+from datetime import date
+
+from sqlalchemy import MetaData, Table, Column, Index, text, insert, select, delete
+
+from .db import engine, Txn, SessionLocal
+from .utils import current_month
+
+_LOG = logging.getLogger(__name__)
+
+ENABLED = os.getenv("TXN_PARTITIONING", "1").strip().lower() not in ("0", "false", "no", "off")
+PARTITIONS_AHEAD = int(os.getenv("TXN_PARTITIONS_AHEAD", "2"))
+
+def _columns(**kw):
+    return [Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, **kw) for c in Txn.__table__.columns]
+
+# SQLite-only objects; kept off Base.metadata so create_all never builds them on Postgres
+_sqlite_meta = MetaData()
+txns_archive = Table(
+    "txns_archive", _sqlite_meta, *_columns(),
+    Index("ix_txns_archive_user_month", "user_tg_id", "month"),
+    Index("ix_txns_archive_month", "month"),
+    Index("ix_txns_archive_user_id", "user_tg_id", "id"),
+)
+txns_all = Table("txns_all", MetaData(), *_columns())  # the UNION ALL view
+
+def _sqlite() -> bool:
+    return ENABLED and engine.dialect.name == "sqlite"
+
+def _month_of(d) -> str:
+    if isinstance(d, date):
+        return f"{d.year:04d}-{d.month:02d}"
+    return str(d)[:7]
+
+def _next_month(m: str) -> str:
+    y, mo = map(int, m.split("-"))
+    return f"{y + mo // 12:04d}-{mo % 12 + 1:02d}"
+
+def txn_source(start=None):
+    """
+    Table to read txns from for a range beginning at `start` (date or YYYY-MM;
+    None = all history). Only the SQLite split needs routing.
+    """
+    if _sqlite() and (start is None or _month_of(start) < current_month()):
+        return txns_all
+    return Txn.__table__
+
+def txn_tables():
+    """Every physical table a txn row can live in (for id-based UPDATE/DELETE)."""
+    return [Txn.__table__, txns_archive] if _sqlite() else [Txn.__table__]
+
+# ------------------------------------------------------------------------------
+# Schema setup (called from init_db)
+# ------------------------------------------------------------------------------
+def setup(conn):
+    if not ENABLED:
+        return
+    if conn.dialect.name == "sqlite":
+        _setup_sqlite(conn)
+    elif conn.dialect.name == "postgresql":
+        _setup_postgres(conn)
+
+def _setup_sqlite(conn):
+    _sqlite_meta.create_all(conn)
+    for idx in txns_archive.indexes:
+        idx.create(conn, checkfirst=True)
+    have = {r[1] for r in conn.exec_driver_sql("PRAGMA table_info(txns_archive)")}
+    for c in Txn.__table__.columns:
+        if c.name not in have:  # columns added to txns after the archive was created
+            conn.exec_driver_sql(f"ALTER TABLE txns_archive ADD COLUMN {c.name} {c.type.compile(conn.dialect)}")
+    cols = ", ".join(c.name for c in Txn.__table__.columns)
+    conn.exec_driver_sql("DROP VIEW IF EXISTS txns_all")
+    conn.exec_driver_sql(f"CREATE VIEW txns_all AS SELECT {cols} FROM txns UNION ALL SELECT {cols} FROM txns_archive")
+
+def _partition_name(m: str) -> str:
+    return "txns_" + m.replace("-", "_")
+
+def _setup_postgres(conn):
+    kind = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'txns' AND relkind IN ('r', 'p')")).scalar()
+    if kind == "r":
+        _LOG.warning("Converting txns to a month-partitioned table…")
+        months = [r[0] for r in conn.execute(text("SELECT DISTINCT month FROM txns"))]
+        seq = conn.execute(text("SELECT pg_get_serial_sequence('txns', 'id')")).scalar()
+        if seq:
+            conn.execute(text(f"ALTER SEQUENCE {seq} OWNED BY NONE"))
+        conn.execute(text("CREATE TABLE txns_partitioned (LIKE txns INCLUDING DEFAULTS) PARTITION BY RANGE (month)"))
+        conn.execute(text("ALTER TABLE txns_partitioned ADD PRIMARY KEY (id, month)"))
+        conn.execute(text("CREATE TABLE txns_default PARTITION OF txns_partitioned DEFAULT"))
+        for m in months:
+            conn.execute(text(
+                f"CREATE TABLE {_partition_name(m)} PARTITION OF txns_partitioned "
+                f"FOR VALUES FROM ('{m}') TO ('{_next_month(m)}')"
+            ))
+        cols = ", ".join(c.name for c in Txn.__table__.columns)
+        conn.execute(text(f"INSERT INTO txns_partitioned ({cols}) SELECT {cols} FROM txns"))
+        conn.execute(text("DROP TABLE txns"))
+        conn.execute(text("ALTER TABLE txns_partitioned RENAME TO txns"))
+        if seq:
+            conn.execute(text(f"ALTER SEQUENCE {seq} OWNED BY txns.id"))
+        for idx in Txn.__table__.indexes:
+            idx.create(conn, checkfirst=True)
+    elif kind is None:
+        return
+    _ensure_pg_partitions(conn)
+
+def _ensure_pg_partitions(conn) -> int:
+    """Partitions for this month and the next few, plus any month parked in DEFAULT."""
+    wanted = [current_month()]
+    for _ in range(PARTITIONS_AHEAD):
+        wanted.append(_next_month(wanted[-1]))
+    wanted += [r[0] for r in conn.execute(text("SELECT DISTINCT month FROM txns_default"))]
+    existing = {r[0] for r in conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'txns'"
+    ))}
+    moved = 0
+    cols = ", ".join(c.name for c in Txn.__table__.columns)
+    for m in sorted(set(wanted)):
+        name = _partition_name(m)
+        if name in existing:
+            continue
+        # rows that landed in DEFAULT must leave it before the range can be attached
+        conn.execute(text(f"CREATE TABLE {name} (LIKE txns INCLUDING DEFAULTS)"))
+        res = conn.execute(text(
+            f"WITH moved AS (DELETE FROM txns_default WHERE month = :m RETURNING {cols}) "
+            f"INSERT INTO {name} ({cols}) SELECT {cols} FROM moved"
+        ), {"m": m})
+        moved += res.rowcount or 0
+        conn.execute(text(f"ALTER TABLE txns ATTACH PARTITION {name} FOR VALUES FROM ('{m}') TO ('{_next_month(m)}')"))
+    return moved
+
+# ------------------------------------------------------------------------------
+# Archival
+# ------------------------------------------------------------------------------
+async def archive_closed_months(session) -> int:
+    """Move every closed month out of the hot store. Returns rows moved."""
+    if not ENABLED:
+        return 0
+    if session.bind.dialect.name == "postgresql":
+        moved = await session.run_sync(lambda s: _ensure_pg_partitions(s.connection()))
+        await session.commit()
+        return moved
+    if session.bind.dialect.name != "sqlite":
+        return 0
+    hot = Txn.__table__
+    cols = [c.name for c in hot.columns]
+    # txns is AUTOINCREMENT (see db.Txn), so emptying it never re-issues archived ids
+    closed = hot.c.month < current_month()
+    res = await session.execute(insert(txns_archive).from_select(cols, select(*[hot.c[c] for c in cols]).where(closed)))
+    await session.execute(delete(hot).where(closed))
+    await session.commit()
+    return res.rowcount or 0
+
+async def unarchive_current(session, ids) -> None:
+    """Edits that move an archived txn into the current month bring it back to the hot table."""
+    if not _sqlite():
+        return
+    hot = Txn.__table__
+    cols = [c.name for c in hot.columns]
+    back = txns_archive.c.id.in_(list(ids)) & (txns_archive.c.month >= current_month())
+    await session.execute(insert(hot).from_select(cols, select(*[txns_archive.c[c] for c in cols]).where(back)))
+    await session.execute(delete(txns_archive).where(back))
+
+async def drop_empty_month(session, month: str) -> bool:
+    """Postgres: drop a closed month's partition once it holds no rows (app.retention
+    emptied it), which gives its space back at once. Rows that turn up for the
+    month later land in DEFAULT and get a new partition from archive_job."""
+    if not ENABLED or session.bind.dialect.name != "postgresql" or month >= current_month():
+        return False
+    name = _partition_name(month)
+    if not (await session.execute(text("SELECT to_regclass(:n)"), {"n": name})).scalar():
+        return False
+    # dropping a partition locks the parent too: lock it first (as inserts do, so
+    # no deadlock) and give up rather than queue behind long readers
+    await session.execute(text("SET LOCAL lock_timeout = '5s'"))
+    try:
+        await session.execute(text("LOCK TABLE txns IN ACCESS EXCLUSIVE MODE"))  # cascades to partitions
+        if (await session.execute(text(f"SELECT 1 FROM {name} LIMIT 1"))).first():
+            await session.rollback()
+            return False
+        await session.execute(text(f"DROP TABLE {name}"))
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        _LOG.warning("Could not drop partition %s: %s", name, e)
+        return False
+    return True
+
+async def archive_job(context):
+    async with SessionLocal() as s:
+        moved = await archive_closed_months(s)
+    if moved:
+        _LOG.info("Archived %s txns from closed months", moved)
@@ -0,0 +1,152 @@
+import os, re, time, random, logging
+from collections import deque, defaultdict
+from typing import Optional
+
+import greenlet
+from sqlalchemy import event
+
+_LOG = logging.getLogger(__name__)
+
+# Opt-in: QUERY_PROFILER=1 turns the hooks on. Everything else has sane defaults.
+ENABLED = os.getenv("QUERY_PROFILER", "").strip().lower() in ("1", "true", "yes", "on")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+EXPLAIN_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0.1"))
+TOP_N = int(os.getenv("SLOW_QUERY_TOP_N", "10"))
+
+# rolling window of recent slow statements; top-N is aggregated from it on demand
+_SLOW = deque(maxlen=int(os.getenv("SLOW_QUERY_WINDOW", "1000")))
+_PLANS: dict = {}
+
+_WS_RE = re.compile(r"\s+")
+_STR_RE = re.compile(r"'(?:[^']|'')*'")
+_NUM_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_RE = re.compile(r"\bIN\s*\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+|\$\d+)\s*,?)+\)", re.IGNORECASE)
+_POSTCOMPILE_RE = re.compile(r"\(__\[POSTCOMPILE_\w+\]\)")
+
+def fingerprint(statement: str) -> str:
+    """Collapse a statement to its shape: literals and IN-lists become placeholders."""
+    s = _WS_RE.sub(" ", statement).strip()
+    s = _STR_RE.sub("?", s)
+    s = _NUM_RE.sub("?", s)
+    s = _IN_RE.sub("IN (...)", s)
+    s = _POSTCOMPILE_RE.sub("(...)", s)
+    return s
+
+def params_shape(params) -> str:
+    """Types only, never values — parameters may contain notes and amounts."""
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        if params and isinstance(params[0], (list, tuple, dict)):
+            return f"[{len(params)} x {params_shape(params[0])}]"
+        return "(" + ", ".join(type(v).__name__ for v in params) + ")"
+    return type(params).__name__
+
+def _calling_handler() -> str:
+    """
+    Name the app coroutine that issued the statement. The sync engine runs in a
+    greenlet spawned by the async session, so the awaiting coroutine frames live
+    on the parent greenlet.
+    """
+    g = greenlet.getcurrent().parent
+    f = g.gr_frame if g is not None else None
+    outer = inner = None
+    while f is not None:
+        mod = f.f_globals.get("__name__", "")
+        if mod.startswith("app.") and mod != __name__:
+            inner = inner or f.f_code.co_name
+            outer = f.f_code.co_name
+        f = f.f_back
+    if not outer:
+        return "?"
+    return outer if outer == inner else f"{outer} → {inner}"
+
+def _explain(conn, statement: str, params) -> Optional[str]:
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect == "postgresql":
+        # the estimated plan only: ANALYZE would run the slow statement again, on the handler's path
+        prefix = "EXPLAIN "
+    else:
+        return None
+    # a fresh DBAPI cursor, so the caller's pending result set is untouched
+    cur = conn.connection.cursor()
+    # a savepoint, so a failed EXPLAIN (statement_timeout, ...) can't abort the caller's transaction
+    savepoint = dialect == "postgresql" and conn.in_transaction()
+    try:
+        if savepoint:
+            cur.execute("SAVEPOINT profiler_explain")
+        try:
+            cur.execute(prefix + statement, params)
+            rows = cur.fetchall()
+        except Exception:
+            if savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT profiler_explain")
+            raise
+        finally:
+            if savepoint:
+                cur.execute("RELEASE SAVEPOINT profiler_explain")
+    finally:
+        cur.close()
+    if dialect == "sqlite":
+        return "\n".join(str(r[-1]) for r in rows)
+    return "\n".join(str(r[0]) for r in rows)
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    # on the execution context, not the connection: a statement that raises never
+    # reaches _after, and its start time must not outlive it
+    context._profiler_start = time.perf_counter()
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_profiler_start", None)
+    if started is None:
+        return
+    ms = (time.perf_counter() - started) * 1000.0
+    if ms < SLOW_QUERY_MS or conn.info.get("explaining"):
+        return
+    fp = fingerprint(statement)
+    handler = _calling_handler()
+    shape = params_shape(parameters)
+    _LOG.warning("Slow query %.1f ms in %s params=%s: %s", ms, handler, shape, fp)
+    _SLOW.append((fp, ms, handler, time.time()))
+    if executemany or random.random() >= EXPLAIN_SAMPLE_RATE:
+        return
+    conn.info["explaining"] = True
+    try:
+        plan = _explain(conn, statement, parameters)
+        if plan:
+            _PLANS[fp] = plan
+            _LOG.warning("Plan for slow query %s:\n%s", fp, plan)
+    except Exception as e:
+        _LOG.warning("EXPLAIN failed for %s: %s", fp, e)
+    finally:
+        conn.info["explaining"] = False
+
+def install(engine) -> bool:
+    """Attach the cursor hooks to an (async) engine when QUERY_PROFILER is on."""
+    if not ENABLED:
+        return False
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", _before)
+    event.listen(sync_engine, "after_cursor_execute", _after)
+    _LOG.info("Query profiler on (threshold %.0f ms, explain rate %.2f)", SLOW_QUERY_MS, EXPLAIN_SAMPLE_RATE)
+    return True
+
+def top_slow(n: int = TOP_N):
+    """Slowest fingerprints in the rolling window: (fp, count, max_ms, avg_ms, handlers, plan)."""
+    agg = defaultdict(lambda: [0, 0.0, 0.0, set()])
+    for fp, ms, handler, _ts in _SLOW:
+        a = agg[fp]
+        a[0] += 1; a[1] = max(a[1], ms); a[2] += ms; a[3].add(handler)
+    rows = [(fp, c, mx, tot / c, sorted(h), _PLANS.get(fp)) for fp, (c, mx, tot, h) in agg.items()]
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows[:n]
+
+def reset():
+    _SLOW.clear()
+    _PLANS.clear()
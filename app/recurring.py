@@ -0,0 +1,93 @@
+"""
+Recurring transactions (rent, subscriptions, ...).
+
+One daily pass picks every due schedule with the indexed (active, next_due)
+query, posts all their occurrences through app.ledger in one flush and moves
+each schedule's next_due forward, all in the same transaction. Due rows are
+locked (SKIP LOCKED) and next_due only moves from the value that was read, so
+concurrent passes never post the same occurrence twice.
+"""
+import os
+from calendar import monthrange
+from collections import deque
+from datetime import date, timedelta
+
+from sqlalchemy import select, update
+
+from .db import Recurring, Txn
+from .budget import month_of
+from . import ledger
+
+RECURRING_HOUR = int(os.getenv("RECURRING_HOUR", "6"))
+MAX_CATCH_UP = int(os.getenv("RECURRING_MAX_CATCH_UP", "31"))  # occurrences per schedule per pass
+
+EVERY = ("daily", "weekly", "monthly", "yearly")
+
+def advance(d: date, every: str, anchor_day: int) -> date:
+    if every == "daily":
+        return d + timedelta(days=1)
+    if every == "weekly":
+        return d + timedelta(days=7)
+    y, m = (d.year + 1, d.month) if every == "yearly" else (d.year + d.month // 12, d.month % 12 + 1)
+    return date(y, m, min(anchor_day, monthrange(y, m)[1]))
+
+async def add_schedule(session, user_id: int, every: str, start: date, parsed: dict, currency: str) -> Recurring:
+    cat, sub = parsed["categories"][0]
+    r = Recurring(
+        user_tg_id=user_id, every=every, anchor_day=start.day, next_due=start,
+        type=parsed["type"], amount_cents=parsed["amount_cents"], currency=currency,
+        category=cat, parent=sub, note=parsed["note"] or None, active=True,
+    )
+    session.add(r)
+    await session.commit()
+    return r
+
+async def list_schedules(session, user_id: int):
+    q = await session.execute(
+        select(Recurring).where(Recurring.user_tg_id == user_id, Recurring.active == True).order_by(Recurring.next_due)
+    )
+    return q.scalars().all()
+
+async def stop_schedule(session, user_id: int, rid: int) -> bool:
+    res = await session.execute(
+        update(Recurring).where(Recurring.id == rid, Recurring.user_tg_id == user_id).values(active=False)
+    )
+    await session.commit()
+    return bool(res.rowcount)
+
+async def post_due(session, today: date, user_id: int | None = None) -> list[Txn]:
+    """Post every occurrence due up to today (one user, or everyone) and commit. Returns the new txns."""
+    q = select(Recurring).where(Recurring.active == True, Recurring.next_due <= today)
+    if user_id is not None:
+        q = q.where(Recurring.user_tg_id == user_id)
+    # schedules another pass (daily job, boot catch-up, /recurring add on a worker) is posting are skipped
+    q = q.with_for_update(skip_locked=True).execution_options(populate_existing=True)
+    due = (await session.execute(q)).scalars().all()
+    if not due:
+        return []
+    rt = Recurring.__table__
+    txns = []
+    for r in due:
+        # the newest MAX_CATCH_UP occurrences, up to and including today; older ones are skipped, not back-posted
+        d, dates = r.next_due, deque(maxlen=MAX_CATCH_UP)
+        while d <= today:
+            dates.append(d)
+            d = advance(d, r.every, r.anchor_day)
+        occurrences = [
+            Txn(
+                user_tg_id=r.user_tg_id, occurred_at=o, month=month_of(o), type=r.type,
+                amount_cents=r.amount_cents, currency=r.currency, category=r.category,
+                parent=r.parent, note=r.note,
+            )
+            for o in dates
+        ]
+        # claim the occurrences: moves next_due only if no other pass has (SQLite takes no row locks)
+        res = await session.execute(
+            update(rt).where(rt.c.id == r.id, rt.c.next_due == r.next_due).values(next_due=d)
+        )
+        if res.rowcount == 1:
+            txns += occurrences
+    if txns:
+        await ledger.add_txns(session, txns)
+    await session.commit()
+    return txns
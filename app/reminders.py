@@ -0,0 +1,81 @@
+"""
+Daily check-ins and weekly digests for every reminder-enabled user, from one
+scheduler tick per time bucket instead of two jobs per user.
+
+Each tick works out which of the users' time zones are at the reminder hour
+right now, then picks their users with one indexed query on
+(daily_reminders, tz); check-ins skip users who already logged something
+today (local date) with an anti-join on txns.
+"""
+import os, asyncio, logging
+from datetime import datetime, timedelta, timezone, date
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import select, exists, and_, or_, true
+
+from .db import User
+from .partitions import txn_source
+
+_LOG = logging.getLogger(__name__)
+
+BUCKET_MINUTES = int(os.getenv("REMINDER_BUCKET_MINUTES", "15"))  # every UTC offset is a multiple of 15 min
+SEND_PER_SEC = float(os.getenv("REMINDER_SEND_PER_SEC", "25"))  # stay under Telegram's broadcast limit
+
+@lru_cache(maxsize=None)
+def zone(name: str | None):
+    try:
+        return ZoneInfo(name or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        _LOG.warning("Unknown time zone %r, using UTC", name)
+        return timezone.utc
+
+def bucket_start(now: datetime) -> datetime:
+    """`now` (aware) rounded down to its bucket."""
+    now = now.astimezone(timezone.utc)
+    return now.replace(minute=now.minute - now.minute % BUCKET_MINUTES, second=0, microsecond=0)
+
+def seconds_to_next_bucket(now: datetime) -> float:
+    return (bucket_start(now) + timedelta(minutes=BUCKET_MINUTES) - now).total_seconds()
+
+def zones_at(tz_names, bucket: datetime, hour: int, weekday: int | None = None) -> dict[date, list[str]]:
+    """Zones whose local time is `hour`:00 at this bucket (and `weekday`, if given), by local date."""
+    out = {}
+    for name in tz_names:
+        local = bucket.astimezone(zone(name))
+        if local.hour == hour and local.minute < BUCKET_MINUTES and (weekday is None or local.weekday() == weekday):
+            out.setdefault(local.date(), []).append(name)
+    return out
+
+async def reminder_zones(session) -> list[str]:
+    q = select(User.tz).where(User.daily_reminders == true()).distinct()
+    return list((await session.execute(q)).scalars().all())
+
+async def due_chats(session, by_date: dict[date, list[str]], skip_logged: bool) -> dict[int, int]:
+    """{user: chat} for reminder users in these zones (minus those with a txn on their local date)."""
+    if not by_date:
+        return {}
+    u = User.__table__
+    groups = []
+    for d, names in by_date.items():
+        cond = u.c.tz.in_(names)
+        if skip_logged:
+            src = txn_source(d)
+            cond = and_(cond, ~exists().where(src.c.user_tg_id == u.c.tg_id, src.c.occurred_at == d))
+        groups.append(cond)
+    q = select(u.c.tg_id, u.c.last_chat_id).where(
+        u.c.daily_reminders == true(), u.c.last_chat_id.is_not(None), or_(*groups)
+    )
+    return dict((await session.execute(q)).all())
+
+async def send_paced(chats, send) -> int:
+    """Await `send(chat_id)` for each chat at SEND_PER_SEC; returns how many went out."""
+    sent = 0
+    for chat_id in chats:
+        try:
+            await send(chat_id)
+            sent += 1
+        except Exception as e:
+            _LOG.warning("Reminder to %s failed: %s", chat_id, e)
+        await asyncio.sleep(1 / SEND_PER_SEC)
+    return sent
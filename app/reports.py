@@ -1,16 +1,22 @@
-import io
+import io, os
 from datetime import date
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
 from reportlab.lib import colors
 from sqlalchemy import select, func
-from .db import SessionLocal, Txn, Budget
-from .budget import spent_by
+from .db import SessionLocal
+from .budget import budget_left
+from .partitions import txn_source
+from .utils import from_minor
+from .retention import month_totals
 
-async def build_weekly_pdf(month: str) -> bytes:
+CURRENCY = os.getenv("CURRENCY", "USD")
+
+async def build_weekly_pdf(user_id: int, month: str, chart_png: bytes | None = None) -> bytes:
     """
-    Simple 1-page weekly snapshot: totals + top categories + envelope status for current month.
+    Simple 1-page weekly snapshot of one user: totals + top categories + envelope status for
+    current month, plus a trend chart (PNG from app.trends) if one is given.
     """
     buf = io.BytesIO()
     c = canvas.Canvas(buf, pagesize=letter)
@@ -23,14 +29,18 @@ async def build_weekly_pdf(month: str) -> bytes:
 
     async with SessionLocal() as s:
         # Totals
-        q_inc = await s.execute(select(func.sum(Txn.amount)).where(Txn.type=="Income", Txn.month==month))
-        total_income = float(q_inc.scalar() or 0.0)
-        q_exp = await s.execute(select(func.sum(Txn.amount)).where(Txn.type=="Expense", Txn.month==month))
-        total_exp = float(q_exp.scalar() or 0.0)
+        t = txn_source(month).c
+        q_inc = await s.execute(select(func.sum(t.amount_cents)).where(t.user_tg_id==user_id, t.type=="Income", t.month==month))
+        total_income = int(q_inc.scalar() or 0)
+        q_exp = await s.execute(select(func.sum(t.amount_cents)).where(t.user_tg_id==user_id, t.type=="Expense", t.month==month))
+        total_exp = int(q_exp.scalar() or 0)
+        compacted = await month_totals(s, month, user_id)
+        total_income += compacted.get("Income", 0)
+        total_exp += compacted.get("Expense", 0)
         net = total_income - total_exp
 
         c.setFont("Helvetica", 12)
-        c.drawString(1*inch, y, f"Income: ${total_income:,.2f}   Expense: ${total_exp:,.2f}   Net: ${net:,.2f}")
+        c.drawString(1*inch, y, f"Income: ${from_minor(total_income, CURRENCY):,.2f}   Expense: ${from_minor(total_exp, CURRENCY):,.2f}   Net: ${from_minor(net, CURRENCY):,.2f}")
         y -= 0.3*inch
 
         # Envelope status table header
@@ -45,13 +55,8 @@ async def build_weekly_pdf(month: str) -> bytes:
         y -= 0.18*inch
 
         # Compute per-budget lines
-        q_bud = await s.execute(Budget.__table__.select().where(Budget.month==month))
         rows = []
-        for r in q_bud.mappings().all():
-            plan = float(r["limit_amount"] or 0.0)
-            cat = r["category"]; sub = r["parent"]
-            spent = await spent_by(s, month, cat, sub)
-            left = plan - spent
+        for (cat, sub), (plan, spent, left) in (await budget_left(s, user_id, month)).items():
             label = f"{cat}" + (f" › {sub}" if sub else "")
             rows.append((label, plan, spent, left))
         rows.sort(key=lambda x: x[2], reverse=True)
@@ -59,11 +64,22 @@ async def build_weekly_pdf(month: str) -> bytes:
             if y < 1*inch:
                 c.showPage(); y = height - 1*inch
             c.drawString(1*inch, y, label[:40])
-            c.drawRightString(5.0*inch, y, f"${plan:,.0f}")
-            c.drawRightString(6.0*inch, y, f"${spent:,.0f}")
-            c.drawRightString(7.0*inch, y, f"${left:,.0f}")
+            c.drawRightString(5.0*inch, y, f"${from_minor(plan, CURRENCY):,.0f}")
+            c.drawRightString(6.0*inch, y, f"${from_minor(spent, CURRENCY):,.0f}")
+            c.drawRightString(7.0*inch, y, f"${from_minor(left, CURRENCY):,.0f}")
             y -= 0.16*inch
 
+    if chart_png:
+        from reportlab.lib.utils import ImageReader
+        img = ImageReader(io.BytesIO(chart_png))
+        w = width - 2*inch
+        iw, ih = img.getSize()
+        h = w * ih / iw
+        y -= 0.2*inch
+        if y - h < 0.75*inch:
+            c.showPage(); y = height - 1*inch
+        c.drawImage(img, 1*inch, y - h, width=w, height=h)
+
     c.showPage()
     c.save()
     return buf.getvalue()
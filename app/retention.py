@@ -0,0 +1,202 @@
+"""
+Optional retention policy for closed history (off unless RETENTION_MONTHS > 0).
+
+Months older than the horizon are compacted user by user: their txns are
+summed into `txn_summaries` (one row per month, type, category, parent and
+currency) and the rows themselves are kept as a gzip-compressed JSONL blob in
+`txn_archives`, then deleted from txns. On Postgres a month's partition is
+dropped once it is empty, which gives the space back at once; SQLite reuses
+the freed pages.
+
+Reports add the summaries to the live rows; a range that cuts through a
+compacted month reads that month's archived rows instead, and exports read
+the archived rows. `/rehydrate YYYY-MM` puts a user's rows back and keeps the
+month out of compaction for RETENTION_HOLD_DAYS.
+"""
+import os, gzip, json, logging
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, delete, func
+
+from .db import SessionLocal, TxnSummary, TxnArchive, dialect_insert
+from .partitions import txn_source, drop_empty_month
+from .utils import current_month
+from . import ledger
+
+_LOG = logging.getLogger(__name__)
+
+MONTHS = int(os.getenv("RETENTION_MONTHS", "0"))  # closed months kept row by row; 0 = keep everything
+HOLD_DAYS = int(os.getenv("RETENTION_HOLD_DAYS", "30"))  # a rehydrated month stays live this long
+USERS_PER_BATCH = int(os.getenv("RETENTION_USERS_PER_BATCH", "200"))  # users compacted per transaction
+
+_SUMMARY_KEY = ["user_tg_id", "month", "type", "category", "parent", "currency"]
+
+def _month(d) -> str:
+    return f"{d.year:04d}-{d.month:02d}" if isinstance(d, date) else str(d)[:7]
+
+def _bounds(m: str) -> tuple[date, date]:
+    y, mo = map(int, m.split("-"))
+    return date(y, mo, 1), date(y, mo, monthrange(y, mo)[1])
+
+def horizon() -> str:
+    """The oldest month kept row by row; everything before it gets compacted."""
+    y, mo = map(int, current_month().split("-"))
+    k = y * 12 + mo - 1 - MONTHS
+    return f"{k // 12:04d}-{k % 12 + 1:02d}"
+
+def is_closed(d) -> bool:
+    """Only closed months can hold compacted data."""
+    return _month(d) < current_month()
+
+# ------------------------------------------------------------------------------
+# Archive blobs
+# ------------------------------------------------------------------------------
+def _pack(rows: list[dict]) -> bytes:
+    lines = (json.dumps(r, default=lambda v: v.isoformat(), separators=(",", ":")) for r in rows)
+    return gzip.compress("\n".join(lines).encode("utf-8"), compresslevel=9, mtime=0)
+
+def _unpack(data: bytes) -> list[dict]:
+    rows = []
+    for line in gzip.decompress(data).decode("utf-8").splitlines():
+        r = json.loads(line)
+        r["occurred_at"] = date.fromisoformat(r["occurred_at"])
+        if r.get("created_at"):
+            r["created_at"] = datetime.fromisoformat(r["created_at"])
+        rows.append(r)
+    return rows
+
+async def archived_rows(session, user_id: int, first: str | None = None, last: str | None = None) -> list[dict]:
+    """The user's compacted txns from months `first`..`last` (YYYY-MM, inclusive; None = open), id order."""
+    q = select(TxnArchive.data).where(TxnArchive.user_tg_id == user_id, TxnArchive.data.is_not(None))
+    if first:
+        q = q.where(TxnArchive.month >= first)
+    if last:
+        q = q.where(TxnArchive.month <= last)
+    rows = [r for data in (await session.execute(q)).scalars() for r in _unpack(data)]
+    return sorted(rows, key=lambda r: r["id"])
+
+# ------------------------------------------------------------------------------
+# Reads
+# ------------------------------------------------------------------------------
+async def report_rows(session, user_id: int, start: date, end: date) -> list[dict]:
+    """
+    What compacted months add to [start, end] for this user, as txn-like dicts
+    (type, category, parent, currency, amount_cents): summary rows for months
+    the range covers whole, the archived rows for months it cuts through.
+    """
+    if not is_closed(start):
+        return []
+    months = (await session.execute(
+        select(TxnArchive.month).where(
+            TxnArchive.user_tg_id == user_id, TxnArchive.data.is_not(None),
+            TxnArchive.month >= _month(start), TxnArchive.month <= _month(end),
+        )
+    )).scalars().all()
+    whole = [m for m in months if start <= _bounds(m)[0] and _bounds(m)[1] <= end]
+    cut = [m for m in months if m not in whole]
+    out = []
+    if whole:
+        s = TxnSummary
+        q = select(s.type, s.category, s.parent, s.currency, s.amount_cents).where(s.user_tg_id == user_id, s.month.in_(whole))
+        out += [{**r, "parent": r["parent"] or None} for r in (await session.execute(q)).mappings()]
+    for m in cut:  # at most the first and last month of the range
+        out += [r for r in await archived_rows(session, user_id, m, m) if start <= r["occurred_at"] <= end]
+    return out
+
+async def month_totals(session, month: str, user_id: int | None = None) -> dict[str, int]:
+    """{type: cents} compacted for this month, for one user (None: all users)."""
+    if not is_closed(month):
+        return {}
+    q = select(TxnSummary.type, func.sum(TxnSummary.amount_cents)).where(TxnSummary.month == month).group_by(TxnSummary.type)
+    if user_id is not None:
+        q = q.where(TxnSummary.user_tg_id == user_id)
+    return {t: int(v or 0) for t, v in (await session.execute(q)).all()}
+
+# ------------------------------------------------------------------------------
+# Compaction
+# ------------------------------------------------------------------------------
+async def compact(session) -> tuple[int, int]:
+    """Compact every month before the horizon. Returns (months, rows)."""
+    if MONTHS <= 0:
+        return 0, 0
+    src = txn_source()
+    months = (await session.execute(select(src.c.month).where(src.c.month < horizon()).distinct())).scalars().all()
+    total = 0
+    for m in sorted(months):
+        total += await compact_month(session, m)
+        await drop_empty_month(session, m)
+    return len(months), total
+
+async def compact_month(session, month: str) -> int:
+    """Summarize and archive one month's txns (committing per batch of users). Returns rows archived."""
+    src = txn_source(month)
+    held = select(TxnArchive.user_tg_id).where(TxnArchive.month == month, TxnArchive.held_until >= date.today())
+    cond = (src.c.month == month) & src.c.user_tg_id.not_in(held)
+    users = sorted((await session.execute(select(src.c.user_tg_id).where(cond).distinct())).scalars().all())
+    total = 0
+    for i in range(0, len(users), USERS_PER_BATCH):
+        batch = users[i:i + USERS_PER_BATCH]
+        rows = [dict(r) for r in (await session.execute(
+            src.select().where(cond, src.c.user_tg_id.in_(batch)).order_by(src.c.id)
+        )).mappings()]
+        total += await _compact_rows(session, month, rows)
+        await session.commit()
+    if total:
+        _LOG.info("Compacted %s txns of %s for %s users", total, month, len(users))
+    return total
+
+async def _compact_rows(session, month: str, rows: list[dict]) -> int:
+    # lock the users' archive rows: a /rehydrate that got there first wins
+    archives = {a.user_tg_id: a for a in (await session.execute(
+        select(TxnArchive).where(TxnArchive.month == month, TxnArchive.user_tg_id.in_({r["user_tg_id"] for r in rows}))
+        .with_for_update()
+    )).scalars()}
+    today = date.today()
+    rows = [r for r in rows if not (r["user_tg_id"] in archives and (archives[r["user_tg_id"]].held_until or date.min) >= today)]
+    if not rows:
+        return 0
+    by_user, sums = {}, {}
+    for r in rows:
+        by_user.setdefault(r["user_tg_id"], []).append(r)
+        k = (r["user_tg_id"], month, r["type"], r["category"], r["parent"] or "", r["currency"])
+        n, cents = sums.get(k, (0, 0))
+        sums[k] = (n + 1, cents + int(r["amount_cents"]))
+    for uid, urows in by_user.items():
+        a = archives.get(uid)
+        if a is None:
+            a = TxnArchive(user_tg_id=uid, month=month)
+            session.add(a)
+        # txns logged into the month after an earlier run join its archive
+        urows = (_unpack(a.data) if a.data else []) + urows
+        a.data, a.txn_count, a.held_until = _pack(urows), len(urows), None
+    ins = dialect_insert(session.bind)(TxnSummary)
+    await session.execute(
+        ins.on_conflict_do_update(index_elements=_SUMMARY_KEY, set_={
+            "txn_count": TxnSummary.txn_count + ins.excluded.txn_count,
+            "amount_cents": TxnSummary.amount_cents + ins.excluded.amount_cents,
+        }),
+        [dict(zip(_SUMMARY_KEY, k), txn_count=n, amount_cents=c) for k, (n, c) in sums.items()],
+    )
+    await ledger.archive_out(session, rows)
+    return len(rows)
+
+async def rehydrate(session, user_id: int, month: str) -> int | None:
+    """Put the user's compacted txns for `month` back (committing). None if it isn't compacted."""
+    a = (await session.execute(
+        select(TxnArchive).where(TxnArchive.user_tg_id == user_id, TxnArchive.month == month).with_for_update()
+    )).scalar_one_or_none()
+    if a is None or a.data is None:
+        return None
+    rows = _unpack(a.data)
+    await ledger.restore(session, rows)
+    await session.execute(delete(TxnSummary).where(TxnSummary.user_tg_id == user_id, TxnSummary.month == month))
+    a.data, a.txn_count, a.held_until = None, 0, date.today() + timedelta(days=HOLD_DAYS)
+    await session.commit()
+    return len(rows)
+
+async def retention_job(context):
+    async with SessionLocal() as s:
+        months, rows = await compact(s)
+    if rows:
+        _LOG.info("Retention: compacted %s txns from %s months before %s", rows, months, horizon())
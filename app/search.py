@@ -0,0 +1,156 @@
+"""
+Full-text search over txn notes (and category names).
+
+SQLite: `txns_fts` is an FTS5 table keyed by txn id, kept in step with
+`txns` (and `txns_archive`) by triggers. It also carries the few columns a
+result line and the totals need, so a search never touches the txn tables.
+An `owner` column holding "u<user id>" lets FTS intersect the user's doclist
+with the terms instead of filtering every match afterwards.
+
+Postgres: a GIN index on to_tsvector(note, category, parent); the search
+repeats the exact indexed expression so the planner can use it.
+"""
+import os, re
+from datetime import date
+
+from sqlalchemy import text
+
+from .partitions import txn_source, ENABLED as PARTITIONING
+from . import history
+
+PG_TS_CONFIG = os.getenv("SEARCH_TS_CONFIG", "simple")
+PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+
+_RANGE_RE = re.compile(r"^(\d{4}-\d{2}(?:-\d{2})?)\.\.(\d{4}-\d{2}(?:-\d{2})?)$")
+_WORD_RE = re.compile(r"[^\W_]+\*?", re.UNICODE)
+
+# ------------------------------------------------------------------------------
+# Schema (called from init_db)
+# ------------------------------------------------------------------------------
+_FTS_COLS = "owner, note, category, parent, occurred_at, type, amount_cents, currency"
+
+def _fts_values(ref: str) -> str:
+    return (
+        f"'u' || {ref}.user_tg_id, COALESCE({ref}.note, ''), {ref}.category, COALESCE({ref}.parent, ''), "
+        f"{ref}.occurred_at, {ref}.type, {ref}.amount_cents, {ref}.currency"
+    )
+
+def _sqlite_triggers(table: str, other: str | None) -> list[str]:
+    # a row moving between txns and txns_archive is inserted into one before it is
+    # deleted from the other: that delete must not drop it from the index
+    still_there = f" AND NOT EXISTS (SELECT 1 FROM {other} WHERE id = old.id)" if other else ""
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN "
+        f"REPLACE INTO txns_fts (rowid, {_FTS_COLS}) VALUES (new.id, {_fts_values('new')}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE ON {table} BEGIN "
+        f"REPLACE INTO txns_fts (rowid, {_FTS_COLS}) VALUES (new.id, {_fts_values('new')}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN "
+        f"DELETE FROM txns_fts WHERE rowid = old.id{still_there}; END",
+    ]
+
+def _pg_tsvector(src) -> str:
+    return (
+        f"to_tsvector('{PG_TS_CONFIG}', COALESCE({src}.note, '') || ' ' || {src}.category || ' ' || COALESCE({src}.parent, ''))"
+    )
+
+def setup(conn):
+    if conn.dialect.name == "sqlite":
+        fresh = not conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'txns_fts'").first()
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS txns_fts USING fts5("
+            "owner, note, category, parent, occurred_at UNINDEXED, type UNINDEXED, "
+            "amount_cents UNINDEXED, currency UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        archived = PARTITIONING and conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'txns_archive'").first()
+        stmts = _sqlite_triggers("txns", "txns_archive" if archived else None)
+        if archived:
+            stmts += _sqlite_triggers("txns_archive", "txns")
+        for stmt in stmts:
+            conn.exec_driver_sql(stmt)
+        if fresh:
+            src = "txns_all" if archived else "txns"
+            conn.exec_driver_sql(f"INSERT INTO txns_fts (rowid, {_FTS_COLS}) SELECT id, {_fts_values(src)} FROM {src}")
+    elif conn.dialect.name == "postgresql":
+        # on the partitioned parent this cascades to every partition, present and future
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_txns_note_fts ON txns USING GIN ({_pg_tsvector('txns')})"))
+
+# ------------------------------------------------------------------------------
+# Query
+# ------------------------------------------------------------------------------
+def parse_query(args: list[str]) -> tuple[list[str], dict]:
+    """Split /search args into terms and history-style filters (plus `from..to` ranges)."""
+    terms, f = [], {}
+    for a in args:
+        m = _RANGE_RE.match(a)
+        if m:
+            lo, hi = m.groups()
+            f["from"] = date.fromisoformat(lo if len(lo) == 10 else lo + "-01")
+            f["to"] = history.parse_filters([f"month={hi}"])["to"] if len(hi) == 7 else date.fromisoformat(hi)
+            continue
+        try:
+            f.update(history.parse_filters([a]))
+        except ValueError:
+            terms += _WORD_RE.findall(a)
+    return terms, f
+
+def _fts_match(user_id: int, terms: list[str]) -> str:
+    words = " ".join(f'"{w[:-1]}"*' if w.endswith("*") else f'"{w}"' for w in terms)
+    return f"owner:u{user_id} AND {{note category parent}}:({words})"
+
+def _pg_tsquery(terms: list[str]) -> str:
+    return " & ".join(f"{w[:-1]}:*" if w.endswith("*") else w for w in terms)
+
+def _filters_sql(f: dict, col, iso_dates: bool) -> tuple[list[str], dict]:
+    where, params = [], {}
+    if "category" in f:
+        where.append(f"{col('category')} = :cat")
+        params["cat"] = f["category"]
+        if f["parent"]:
+            where.append(f"{col('parent')} = :parent")
+            params["parent"] = f["parent"]
+    if "type" in f:
+        where.append(f"{col('type')} = :type")
+        params["type"] = f["type"]
+    if "from" in f:
+        where.append(f"{col('occurred_at')} >= :d_from")
+        params["d_from"] = f["from"].isoformat() if iso_dates else f["from"]
+    if "to" in f:
+        where.append(f"{col('occurred_at')} <= :d_to")
+        params["d_to"] = f["to"].isoformat() if iso_dates else f["to"]
+    return where, params
+
+async def search(session, user_id: int, terms: list[str], f: dict, page: int = 0, size: int = PAGE_SIZE):
+    """-> (rows best first, {type: (count, total)}, has_more)"""
+    if session.bind.dialect.name == "postgresql":
+        src = txn_source(f.get("from")).name
+        where, params = _filters_sql(f, lambda c: f"t.{c}", iso_dates=False)
+        vec = _pg_tsvector("t")
+        base = (
+            f"FROM {src} t WHERE t.user_tg_id = :uid AND {vec} @@ to_tsquery('{PG_TS_CONFIG}', :q)"
+            + "".join(f" AND {w}" for w in where)
+        )
+        params.update(uid=user_id, q=_pg_tsquery(terms))
+        rank = f"ts_rank({vec}, to_tsquery('{PG_TS_CONFIG}', :q))"
+        select_rows = (
+            f"SELECT t.id, t.occurred_at, t.type, t.amount_cents, t.currency, t.category, t.parent, t.note, {rank} AS rank "
+            f"{base} ORDER BY rank DESC, t.id DESC LIMIT :lim OFFSET :off"
+        )
+    else:
+        where, params = _filters_sql(f, lambda c: f"txns_fts.{c}", iso_dates=True)  # FTS columns are text
+        base = "FROM txns_fts WHERE txns_fts MATCH :q" + "".join(f" AND {w}" for w in where)
+        params.update(q=_fts_match(user_id, terms))
+        # owner matches carry no weight; note hits count most
+        select_rows = (
+            "SELECT rowid AS id, occurred_at, type, amount_cents, currency, category, NULLIF(parent, '') AS parent, "
+            f"NULLIF(note, '') AS note, bm25(txns_fts, 0.0, 10.0, 2.0, 1.0) AS rank {base} "
+            "ORDER BY rank, rowid DESC LIMIT :lim OFFSET :off"
+        )
+    rows = [dict(r) for r in (await session.execute(text(select_rows), {**params, "lim": size + 1, "off": page * size})).mappings().all()]
+    totals = {
+        t: (int(n), int(s or 0))
+        for t, n, s in (await session.execute(text(f"SELECT type, COUNT(*), SUM(amount_cents) {base} GROUP BY type"), params)).all()
+    }
+    for r in rows:
+        if isinstance(r["occurred_at"], str):
+            r["occurred_at"] = date.fromisoformat(r["occurred_at"])
+    return rows[:size], totals, len(rows) > size
@@ -0,0 +1,92 @@
+"""
+Pull sync from the Sheets config tabs (Budgets, WeeklyCaps, Freezes), so rows
+edited by hand in the sheet take effect in the bot within SHEETS_PULL_SECONDS.
+The tabs have no user column: they hold the sheet owner's envelopes (OWNER_ID).
+
+The job reads all three tabs with one batch_get and skips tabs whose content
+hash hasn't changed since the last pull. In a changed tab only rows that
+differ from the previous pull count as edits, and only those that also differ
+from the DB are written, all tabs in one transaction. Diffing against the
+previous pull rather than the DB keeps a sheet that lags behind a bot-side
+write (the DB is written first) from undoing it; the first pull after start
+has no previous pull and takes every row that differs from the DB. Rows
+deleted from the sheet are left in the DB: set the amount to 0 or Active to
+FALSE instead.
+
+Handlers never wait on Sheets; they read the DB copy.
+"""
+import os, asyncio, logging
+
+from sqlalchemy import select
+
+from .db import SessionLocal, Budget, WeeklyCap, Freeze, dialect_insert
+from .budget import forget_carry, load_freezes
+from .utils import current_month
+from . import ledger
+
+_LOG = logging.getLogger(__name__)
+
+PULL_SECONDS = int(os.getenv("SHEETS_PULL_SECONDS", "60"))
+
+# tab -> (model, key columns, value column)
+_TABS = {
+    "Budgets": (Budget, ("month", "category", "parent"), "limit_cents"),
+    "WeeklyCaps": (WeeklyCap, ("category", "parent"), "cap_cents"),
+    "Freezes": (Freeze, ("category", "parent"), "active"),
+}
+_DIGESTS: dict[str, str] = {}  # tab -> content hash of the last applied pull
+_LAST: dict[str, dict] = {}  # tab -> its rows at the last applied pull, {key: value}
+
+async def apply(session, user_id: int, tabs: dict[str, dict]) -> dict[str, list]:
+    """
+    Write the edited rows of each tab ({key: value}, see sheets_sync.parse_config)
+    as the user's, one upsert per tab, and commit. Returns {tab: keys written}.
+    """
+    written = {}
+    for tab, rows in tabs.items():
+        model, keys, col = _TABS[tab]
+        cols = [getattr(model, k) for k in keys]
+        q = select(*cols, getattr(model, col)).where(model.user_tg_id == user_id)
+        have = {tuple(r[:-1]): r[-1] for r in (await session.execute(q)).all()}
+        prev = _LAST.get(tab)
+        changed = {
+            key: val for key, val in rows.items()
+            if (prev is None or prev.get(key) != val) and have.get(key, False if tab == "Freezes" else None) != val
+        }
+        written[tab] = list(changed)
+        if not changed:
+            continue
+        ins = dialect_insert(session.bind)(model).values([
+            dict(zip(keys, key), user_tg_id=user_id, **{col: val}) for key, val in changed.items()
+        ])
+        await session.execute(ins.on_conflict_do_update(
+            index_elements=["user_tg_id", *keys], set_={col: getattr(ins.excluded, col)},
+        ))
+    await session.commit()
+    _LAST.update(tabs)
+    if written.get("Freezes"):
+        await load_freezes(session)
+    if any(written.values()):
+        ledger.bump_version(user_id)
+        if any(k[0] < current_month() for k in written.get("Budgets", [])):
+            forget_carry(user_id)
+    return written
+
+async def pull_job(context):
+    """Scheduled with the sheet owner's user id as job data."""
+    from . import sheets_sync  # gspread stays out of cold start
+    owner = context.job.data
+    try:
+        changed = await asyncio.to_thread(sheets_sync.pull_config, dict(_DIGESTS))
+    except Exception as e:
+        _LOG.warning("Sheets pull failed: %s", e)
+        return
+    if not changed:
+        return
+    tabs = {tab: sheets_sync.parse_config(tab, rows) for tab, (_digest, rows) in changed.items()}
+    async with SessionLocal() as s:
+        written = await apply(s, owner, tabs)
+    _DIGESTS.update({tab: digest for tab, (digest, _rows) in changed.items()})
+    for tab, keys in written.items():
+        if keys:
+            _LOG.info("Sheets pull: %s %s rows changed in the sheet", len(keys), tab)
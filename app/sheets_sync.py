@@ -1,9 +1,13 @@
-import os, json, logging
+import os, re, json, logging, hashlib, threading
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from typing import List, Dict, Optional
 import gspread
 from google.oauth2.service_account import Credentials
+from .utils import from_minor, to_minor
 _LOG = logging.getLogger(__name__)
 
+CURRENCY = os.getenv("CURRENCY", "USD")
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 
 def _service():
@@ -45,28 +49,257 @@ def init_headers(ws, headers: List[str]):
     except Exception:
         ws.resize(1); ws.update("A1:{}1".format(chr(64+len(headers))), [headers])
 
-def append_transactions(rows: List[Dict]):
+# ------------------------------------------------------------------------------
+# Transactions tab: one row per txn, keyed by the txn id in column A
+# ------------------------------------------------------------------------------
+TXN_HEADERS = ["Id","Date","Month","Type","Amount","Currency","Category","Sub-Category","Note"]
+_LAST_COL = chr(64 + len(TXN_HEADERS))
+RECONCILE_BLOCK = int(os.getenv("SHEETS_RECONCILE_BLOCK", "200"))  # rows per checksum
+COMPACT_GAP_RATIO = float(os.getenv("SHEETS_COMPACT_GAP_RATIO", "0.2"))  # blank rows (vs txns) before reconcile compacts
+
+_LOCK = threading.Lock()  # the pending queue
+_SYNC = threading.Lock()  # one flush/reconcile at a time (they share the row index)
+_PENDING_UPSERT: Dict[int, List[str]] = {}  # txn id -> row values
+_PENDING_DELETE: set = set()
+_ROW_OF: Optional[Dict[int, int]] = None  # txn id -> sheet row, built from column A on first use
+_NEXT_ROW = 2  # first row below the data
+_HEADER_OK: Optional[bool] = None
+
+def txn_values(r: Dict) -> List[str]:
+    """A txn row (DB column names) as the tab's cell values."""
+    cur = r.get("currency") or CURRENCY
+    d = r["occurred_at"]
+    return [
+        str(r["id"]), d.isoformat() if hasattr(d, "isoformat") else str(d), r["month"], r["type"],
+        str(from_minor(r["amount_cents"], cur)), cur, r["category"], r.get("parent") or "", r.get("note") or "",
+    ]
+
+def queue_upsert(rows: List[Dict]):
+    """Add or update these txns on the next flush()."""
+    with _LOCK:
+        for r in rows:
+            _PENDING_UPSERT[int(r["id"])] = txn_values(r)
+
+def queue_delete(ids):
+    with _LOCK:
+        for i in ids:
+            _PENDING_UPSERT.pop(int(i), None)
+            _PENDING_DELETE.add(int(i))
+
+def drop_pending():
+    """Forget queued changes (a reconcile from the DB is about to cover them)."""
+    with _LOCK:
+        _PENDING_UPSERT.clear()
+        _PENDING_DELETE.clear()
+
+def _txn_ws():
+    sh = get_client()
+    ensure_worksheets(sh)
+    return sh.worksheet("Transactions")
+
+def needs_reconcile() -> bool:
+    """True until the tab carries the Id column (older sheets); checked once per process."""
+    global _HEADER_OK
+    if _HEADER_OK is None:
+        _HEADER_OK = _txn_ws().row_values(1)[:len(TXN_HEADERS)] == TXN_HEADERS
+    return not _HEADER_OK
+
+def _row_index(ws) -> Dict[int, int]:
+    global _ROW_OF, _NEXT_ROW
+    if _ROW_OF is None:
+        col = ws.col_values(1)
+        _ROW_OF = {int(v): i for i, v in enumerate(col, start=1) if i > 1 and v.isdigit()}
+        _NEXT_ROW = len(col) + 1
+    return _ROW_OF
+
+def forget_index():
+    """Re-read the id->row index on next use (another process may have written the tab)."""
+    global _ROW_OF
+    with _SYNC:
+        _ROW_OF = None
+
+def flush() -> int:
+    """Send queued changes: one batch_update for edits and new rows, one batch_clear for deletes. Returns rows touched."""
+    with _SYNC:
+        return _flush()
+
+def _flush() -> int:
+    global _ROW_OF, _NEXT_ROW
+    with _LOCK:
+        ups, dels = dict(_PENDING_UPSERT), set(_PENDING_DELETE)
+        _PENDING_UPSERT.clear()
+        _PENDING_DELETE.clear()
+    if not ups and not dels:
+        return 0
     try:
-        sh = get_client()
-        ensure_worksheets(sh)
-        ws = sh.worksheet("Transactions")
-        hdr = ["Date","Month","Type","Amount","Currency","Category","Sub-Category","Note"]
-        init_headers(ws, hdr)
-        values = [[
-            r.get("Date",""),
-            r.get("Month",""),
-            r.get("Type",""),
-            float(r.get("Amount",0)),
-            r.get("Currency","USD"),
-            r.get("Category",""),
-            r.get("Sub-Category",""),
-            r.get("Note",""),
-        ] for r in rows]
-        ws.append_rows(values, value_input_option="USER_ENTERED")
+        ws = _txn_ws()
+        index = _row_index(ws)
+        # new rows go to explicit rows below the last one rather than through
+        # append_rows, whose table detection stops at the first cleared row
+        nxt = _NEXT_ROW
+        updates = []
+        for i, vals in ups.items():
+            if i not in index:
+                index[i], nxt = nxt, nxt + 1
+            updates.append({"range": f"A{index[i]}:{_LAST_COL}{index[i]}", "values": [vals]})
+        # deleted rows are cleared, not removed, so every other row keeps its index;
+        # reconcile() keeps the gaps too, until there are enough to compact
+        clears = [f"A{r}:{_LAST_COL}{r}" for r in (index.pop(i) for i in dels if i in index)]
+        if nxt - 1 > ws.row_count:
+            ws.add_rows(nxt - 1 - ws.row_count)
+        if updates:
+            ws.batch_update(updates, value_input_option="USER_ENTERED")
+        if clears:
+            ws.batch_clear(clears)
+        _NEXT_ROW = nxt
+        return len(updates) + len(clears)
     except Exception as e:
-        _LOG.exception("Sheets append failed: %s", e)
+        _LOG.exception("Sheets flush failed (%s changes requeued): %s", len(ups) + len(dels), e)
+        _ROW_OF = None
+        with _LOCK:
+            for i, vals in ups.items():
+                _PENDING_UPSERT.setdefault(i, vals)
+            _PENDING_DELETE.update(dels - set(_PENDING_UPSERT))
+        return 0
+
+def _norm(row: List[str]) -> List[str]:
+    # what Sheets shows for a USER_ENTERED cell can differ from what was sent ("12.00" -> "12")
+    out = [str(c).strip() for c in row[:len(TXN_HEADERS)]]
+    out += [""] * (len(TXN_HEADERS) - len(out))
+    try:
+        out[4] = str(Decimal(out[4].replace(",", "")).normalize())
+    except InvalidOperation:
+        pass
+    return out
+
+def _checksum(rows: List[List[str]]) -> str:
+    return hashlib.sha1("\x1e".join("\x1f".join(_norm(r)) for r in rows).encode()).hexdigest()
+
+def reconcile(rows: List[List[str]]) -> int:
+    """
+    Make the tab equal to these txn rows (txn_values, id order) by comparing
+    RECONCILE_BLOCK-row checksums and rewriting only the blocks that differ.
+    Rows stay where they are, so the gaps flush() leaves don't shift the blocks
+    after them: rows deleted from the DB are blanked, txns missing from the tab
+    go below the last row. The tab is compacted (id order, no gaps) only when it
+    lacks the Id column or more than COMPACT_GAP_RATIO of its rows are blank.
+    Returns the number of rows rewritten.
+    """
+    with _SYNC:
+        return _reconcile(rows)
+
+def _layout(have: List[List[str]], rows: List[List[str]]) -> Optional[List[List[str]]]:
+    """`rows` placed at their current rows of `have`, or None if the tab should be compacted."""
+    if have[:1] and have[0][:len(TXN_HEADERS)] != TXN_HEADERS:
+        return None
+    by_id = {r[0]: r for r in rows}
+    blank = [""] * len(TXN_HEADERS)
+    want, placed = [TXN_HEADERS], set()
+    for r in have[1:]:
+        i = r[0].strip() if r else ""
+        if i in by_id and i not in placed:
+            want.append(by_id[i])
+            placed.add(i)
+        else:
+            want.append(blank)
+    gaps = len(want) - 1 - len(placed)
+    if gaps > COMPACT_GAP_RATIO * max(len(rows), 1):
+        return None
+    want += [r for r in rows if r[0] not in placed]
+    return want
+
+def _reconcile(rows: List[List[str]]) -> int:
+    global _ROW_OF, _NEXT_ROW, _HEADER_OK
+    ws = _txn_ws()
+    have = ws.get_all_values()
+    want = _layout(have, rows)
+    if want is None:
+        _LOG.info("Compacting the Transactions tab.")
+        want = [TXN_HEADERS] + rows
+    updates = []
+    for start in range(0, len(want), RECONCILE_BLOCK):
+        block = want[start:start + RECONCILE_BLOCK]
+        if _checksum(block) != _checksum(have[start:start + len(block)]):
+            updates.append({"range": f"A{start + 1}:{_LAST_COL}{start + len(block)}", "values": block})
+    if updates:
+        if ws.row_count < len(want):
+            ws.add_rows(len(want) - ws.row_count)
+        ws.batch_update(updates, value_input_option="USER_ENTERED")
+    if len(have) > len(want):
+        ws.batch_clear([f"A{len(want) + 1}:{_LAST_COL}{len(have)}"])
+    _ROW_OF = {int(v[0]): i for i, v in enumerate(want, start=1) if i > 1 and v[0]}
+    _NEXT_ROW = len(want) + 1
+    _HEADER_OK = True
+    return sum(len(u["values"]) for u in updates)
+
+# ------------------------------------------------------------------------------
+# Config tabs (Budgets, WeeklyCaps, Freezes): edits made in the sheet are pulled back
+# ------------------------------------------------------------------------------
+CONFIG_TABS = {
+    "Budgets": ["Month","Group","Category","Sub-Category","LimitAmount"],
+    "WeeklyCaps": ["Category","Sub-Category","CapAmount"],
+    "Freezes": ["Category","Sub-Category","Active"],
+}
+_MONTH_FORMATS = ("%Y-%m", "%Y-%m-%d", "%m/%d/%Y", "%d.%m.%Y", "%b %Y", "%B %Y")
+
+def pull_config(seen: Dict[str, str]) -> Dict[str, tuple]:
+    """
+    Read the config tabs in one batch_get. Returns {tab: (digest, rows)} for the
+    tabs whose content hash differs from `seen` (tab -> digest of the last pull).
+    """
+    resp = get_client().values_batch_get([f"'{t}'!A2:{chr(64 + len(h))}" for t, h in CONFIG_TABS.items()])
+    out = {}
+    for (tab, hdr), vr in zip(CONFIG_TABS.items(), resp.get("valueRanges", [])):
+        rows = [[str(c).strip() for c in r[:len(hdr)]] + [""] * (len(hdr) - len(r)) for r in vr.get("values", [])]
+        digest = hashlib.sha1("\x1e".join("\x1f".join(r) for r in rows).encode()).hexdigest()
+        if seen.get(tab) != digest:
+            out[tab] = (digest, rows)
+    return out
+
+def _month(v: str) -> Optional[str]:
+    # USER_ENTERED turns "2025-03" into a date, shown in the sheet's locale
+    for fmt in _MONTH_FORMATS:
+        try:
+            return datetime.strptime(v, fmt).strftime("%Y-%m")
+        except ValueError:
+            pass
+    return None
+
+def _cents(v: str) -> Optional[int]:
+    try:
+        return to_minor(re.sub(r"[^0-9.\-]", "", v), CURRENCY)
+    except (InvalidOperation, ValueError):
+        return None
+
+def parse_config(tab: str, rows: List[List[str]]) -> Dict[tuple, object]:
+    """
+    A tab's rows as {key: value}: Budgets (month, category, parent) -> cents,
+    WeeklyCaps (category, parent) -> cents, Freezes (category, parent) -> active.
+    Rows that don't parse are skipped (and logged); the last of duplicate keys wins.
+    """
+    out, bad = {}, 0
+    for r in rows:
+        if not any(r):
+            continue
+        if tab == "Budgets":
+            month, cents = _month(r[0]), _cents(r[4])
+            key, val = (month, r[2], r[3]), cents
+            ok = month is not None and cents is not None
+        elif tab == "WeeklyCaps":
+            key, val = (r[0], r[1]), _cents(r[2])
+            ok = val is not None
+        else:
+            key, val = (r[0], r[1]), r[2].upper() in ("TRUE", "YES", "ON", "1", "Y")
+            ok = True
+        if ok and key[-2]:  # category
+            out[key] = val
+        else:
+            bad += 1
+    if bad:
+        _LOG.warning("Sheets %s tab: skipped %s rows that don't parse", tab, bad)
+    return out
 
-def upsert_budget(month: str, category: str, parent: Optional[str], limit: float, group_guess: Optional[str]=None):
+def upsert_budget(month: str, category: str, parent: Optional[str], limit_cents: int, group_guess: Optional[str]=None):
     try:
         sh = get_client()
         ensure_worksheets(sh)
@@ -79,7 +312,7 @@ def upsert_budget(month: str, category: str, parent: Optional[str], limit: float
             if len(row) < 5: continue
             if row[0]==month and row[2]==category and row[3]==(parent or ""):
                 target_idx = idx; break
-        new_row = [month, group_guess or "", category, parent or "", float(limit)]
+        new_row = [month, group_guess or "", category, parent or "", str(from_minor(limit_cents, CURRENCY))]
         if target_idx:
             ws.update(f"A{target_idx}:E{target_idx}", [new_row])
         else:
@@ -87,7 +320,7 @@ def upsert_budget(month: str, category: str, parent: Optional[str], limit: float
     except Exception as e:
         _LOG.exception("Sheets budget upsert failed: %s", e)
 
-def upsert_weeklycap(category: str, parent: Optional[str], cap: float):
+def upsert_weeklycap(category: str, parent: Optional[str], cap_cents: int):
     try:
         sh = get_client()
         ensure_worksheets(sh)
@@ -100,7 +333,7 @@ def upsert_weeklycap(category: str, parent: Optional[str], cap: float):
             if len(row) < 3: continue
             if row[0]==category and row[1]==(parent or ""):
                 target_idx = idx; break
-        new_row = [category, parent or "", float(cap)]
+        new_row = [category, parent or "", str(from_minor(cap_cents, CURRENCY))]
         if target_idx:
             ws.update(f"A{target_idx}:C{target_idx}", [new_row])
         else:
@@ -140,7 +373,7 @@ def bootstrap_sheet(title: Optional[str]=None) -> str:
         sh = gc.create(title or "BudgetBot Sheet")
     ensure_worksheets(sh)
     # headers for all tabs
-    init_headers(sh.worksheet("Transactions"), ["Date","Month","Type","Amount","Currency","Category","Sub-Category","Note"])
+    # Transactions headers (and rows) are written by reconcile(); resetting them here would wipe the tab
     init_headers(sh.worksheet("Budgets"), ["Month","Group","Category","Sub-Category","LimitAmount"])
     init_headers(sh.worksheet("WeeklyCaps"), ["Category","Sub-Category","CapAmount"])
     init_headers(sh.worksheet("Freezes"), ["Category","Sub-Category","Active"])
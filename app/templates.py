@@ -0,0 +1,43 @@
+"""
+Per-user message templates (`/template add lunch 12 #Food;sub=DiningOut` → `/lunch`).
+
+All templates are loaded into memory once at startup and kept in step by the
+add/remove helpers, so resolving a dynamic /<name> command never hits the DB.
+"""
+import re
+
+from sqlalchemy import select, delete
+
+from .db import Template, SessionLocal, dialect_insert
+
+NAME_RE = re.compile(r"^[a-z0-9_]{1,32}$")  # what Telegram accepts as a command
+
+_CACHE: dict[int, dict[str, str]] = {}  # user -> {name: text}
+
+async def load_all() -> int:
+    async with SessionLocal() as s:
+        rows = (await s.execute(select(Template.user_tg_id, Template.name, Template.text))).all()
+    _CACHE.clear()
+    for uid, name, text in rows:
+        _CACHE.setdefault(uid, {})[name] = text
+    return len(rows)
+
+def lookup(user_id: int, name: str) -> str | None:
+    return _CACHE.get(user_id, {}).get(name.lower())
+
+def for_user(user_id: int) -> dict[str, str]:
+    return dict(_CACHE.get(user_id, {}))
+
+async def add(session, user_id: int, name: str, text: str):
+    name = name.lower()
+    ins = dialect_insert(session.bind)(Template).values(user_tg_id=user_id, name=name, text=text)
+    await session.execute(ins.on_conflict_do_update(index_elements=["user_tg_id", "name"], set_={"text": text}))
+    await session.commit()
+    _CACHE.setdefault(user_id, {})[name] = text
+
+async def remove(session, user_id: int, name: str) -> bool:
+    name = name.lower()
+    res = await session.execute(delete(Template).where(Template.user_tg_id == user_id, Template.name == name))
+    await session.commit()
+    _CACHE.get(user_id, {}).pop(name, None)
+    return bool(res.rowcount)
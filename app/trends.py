@@ -0,0 +1,90 @@
+"""
+/trends: a user's spending and income per month, as a bar chart.
+
+The monthly series comes from one grouped query over the live txns plus the
+compacted month summaries (app.retention). Charts are drawn by app.charts in
+a small process pool, so rendering never blocks the event loop, and cached
+per (user, months, category, data version). The Telegram file_id of a sent
+chart is kept with it, so an unchanged chart is sent again without being
+uploaded again.
+"""
+import os, asyncio, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from sqlalchemy import select, func, union_all
+
+from .db import TxnSummary
+from .partitions import txn_source
+from .utils import fmt_minor, from_minor
+from . import charts, ledger
+
+DEFAULT_MONTHS = int(os.getenv("TRENDS_MONTHS", "6"))
+MAX_MONTHS = 24
+WORKERS = int(os.getenv("TRENDS_WORKERS", "1"))  # each worker is a full Python process
+
+_COLORS = {"Expense": (214, 96, 77), "Income": (77, 160, 110)}
+_CACHE: dict = {}  # (user, first month, last month, category, parent, data version) -> chart
+_POOL = None
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # forkserver: workers start from a clean process, not a copy of the bot and its threads
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        if ctx.get_start_method() == "forkserver":
+            ctx.set_forkserver_preload(["app.charts"])
+        _POOL = ProcessPoolExecutor(max_workers=WORKERS, mp_context=ctx)
+    return _POOL
+
+def months_back(today: date, n: int) -> list[str]:
+    """The last `n` months up to and including today's, oldest first."""
+    k = today.year * 12 + today.month - 1
+    return [f"{(k - i) // 12:04d}-{(k - i) % 12 + 1:02d}" for i in range(n - 1, -1, -1)]
+
+async def monthly_series(session, user_id: int, months: list[str], category=None, parent=None) -> dict:
+    """{(month, type): cents} over live and compacted txns."""
+    first, last = months[0], months[-1]
+    src = txn_source(first).c
+    s = TxnSummary
+    live = select(src.month, src.type, func.sum(src.amount_cents).label("cents")).where(
+        src.user_tg_id == user_id, src.month >= first, src.month <= last,
+    )
+    compacted = select(s.month, s.type, func.sum(s.amount_cents).label("cents")).where(
+        s.user_tg_id == user_id, s.month >= first, s.month <= last,
+    )
+    if category:
+        live = live.where(src.category == category)
+        compacted = compacted.where(s.category == category)
+        if parent:
+            live = live.where(src.parent == parent)
+            compacted = compacted.where(s.parent == parent)
+    both = union_all(live.group_by(src.month, src.type), compacted.group_by(s.month, s.type)).subquery()
+    q = select(both.c.month, both.c.type, func.sum(both.c.cents)).group_by(both.c.month, both.c.type)
+    return {(m, t): int(v or 0) for m, t, v in (await session.execute(q)).all()}
+
+async def chart(session, user_id: int, today: date, n: int = DEFAULT_MONTHS, category=None, parent=None, currency="USD") -> dict:
+    """{"png", "caption", "file_id"} for the user's last `n` months (file_id: None until sent)."""
+    months = months_back(today, n)
+    key = (user_id, months[0], months[-1], category, parent, ledger.data_version(user_id))
+    if key in _CACHE:
+        return _CACHE[key]
+    series = await monthly_series(session, user_id, months, category, parent)
+    shown = [t for t in ("Expense", "Income") if any(series.get((m, t)) for m in months)] or ["Expense"]
+    label = category + (f" › {parent}" if parent else "") if category else "All categories"
+    # Pillow's built-in font is Latin-only: keep the title plain
+    title = f"{label.replace(' › ', ' / ')}, {months[0]} to {months[-1]} ({currency})"
+    bars = [(t, _COLORS[t], [float(from_minor(series.get((m, t), 0), currency)) for m in months]) for t in shown]
+    png = await asyncio.get_running_loop().run_in_executor(
+        _pool(), charts.bar_chart, title, [m[2:].replace("-", "/") for m in months], bars,
+    )
+    lines = [f"{label}, last {n} months"]
+    for t in shown:
+        total = sum(series.get((m, t), 0) for m in months)
+        lines.append(f"{t}: {fmt_minor(total, currency)} total, {fmt_minor(total // n, currency)}/month on average")
+    entry = {"png": png, "caption": "\n".join(lines), "file_id": None}
+    if len(_CACHE) > 1000:
+        _CACHE.clear()
+    _CACHE[key] = entry
+    return entry
@@ -1,7 +1,15 @@
 import io
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
 from dateutil import tz
 
+# Money is stored as integer minor units ("cents"). The exponent is the number of
+# minor-unit digits per currency (ISO 4217); anything not listed has 2.
+CURRENCY_EXPONENTS = {
+    "JPY": 0, "KRW": 0, "VND": 0, "CLP": 0, "ISK": 0, "UGX": 0, "XAF": 0, "XOF": 0,
+    "BHD": 3, "JOD": 3, "KWD": 3, "OMR": 3, "TND": 3,
+}
+
 def now_local(tz_name: str):
     tzinfo = tz.gettz(tz_name)
     return datetime.now(tzinfo)
@@ -18,8 +26,27 @@ def parse_month(s: str|None):
         return s
     return current_month()
 
-def money(n: float, currency: str="USD"):
-    return f"{n:,.2f} {currency}"
+def minor_exponent(currency: str="USD") -> int:
+    return CURRENCY_EXPONENTS.get((currency or "USD").upper(), 2)
+
+def to_minor(amount, currency: str="USD") -> int:
+    """'12.5' / Decimal / int -> 1250 (for a 2-digit currency). Rounds half up."""
+    d = Decimal(str(amount).strip()).scaleb(minor_exponent(currency))
+    return int(d.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_minor(n: int, currency: str="USD") -> Decimal:
+    return Decimal(int(n or 0)).scaleb(-minor_exponent(currency))
+
+def split_minor(total: int, n: int) -> list[int]:
+    """Split into n integer parts that add up to total exactly (first parts get the remainder)."""
+    base, rem = divmod(total, n)
+    return [base + (1 if i < rem else 0) for i in range(n)]
+
+def fmt_minor(n: int, currency: str="USD") -> str:
+    return f"{from_minor(n, currency):,.{minor_exponent(currency)}f}"
+
+def money(n: int, currency: str="USD"):
+    return f"{fmt_minor(n, currency)} {currency}"
 
 def to_excel_bytes(rows):
     # rows: list of dicts with keys:
@@ -39,7 +66,7 @@ def to_excel_bytes(rows):
         ws.write(r_idx, 0, r.get("Date",""))
         ws.write(r_idx, 1, r.get("Month",""))
         ws.write(r_idx, 2, r.get("Type",""))
-        amt = float(r.get("Amount", 0.0) or 0.0)
+        amt = float(r.get("Amount", 0) or 0)
         ws.write_number(r_idx, 3, amt, money_fmt)
         ws.write(r_idx, 4, r.get("Currency","USD"))
         ws.write(r_idx, 5, r.get("Category",""))
@@ -0,0 +1,108 @@
+"""
+/whatif scenarios over an in-memory snapshot of the month.
+
+A snapshot holds every envelope's limit, month-to-date spend and projected
+month-end spend as parallel int64 arrays (minor units). Scenarios are applied
+to copies of those arrays, so nothing is written and follow-up what-ifs reuse
+the same snapshot until the user's data changes.
+
+Scenario syntax (clauses separated by commas):
+    Food -20%               cut the rest of the month's Food spending by 20%
+    Food;sub=DiningOut -15  spend 15 less for the rest of the month
+    Fun +40                 an extra 40 expense now
+    Food budget=350         set the budget (also budget+50, budget-10%)
+    * -10%                  every envelope
+"""
+import re
+from datetime import date
+
+import numpy as np
+
+from . import ledger
+from .forecast import forecast_month
+from .utils import to_minor, current_month
+
+_CLAUSE_RE = re.compile(
+    r"^(?P<target>\*|all|[^\s]+(?:\s*;sub=\s*[^\s]+)?)\s+"
+    r"(?P<budget>budget\s*)?(?P<op>[=+-])\s*(?P<num>\d+(?:\.\d+)?)\s*(?P<pct>%)?$",
+    re.IGNORECASE,
+)
+
+class Snapshot:
+    __slots__ = ("key", "month", "envelopes", "index", "limit", "spent", "projected")
+
+    def __init__(self, key, month: str, result: dict):
+        self.key = key
+        self.month = month
+        self.envelopes = sorted(result)
+        self.index = {e: i for i, e in enumerate(self.envelopes)}
+        self.limit = np.array([result[e][0] for e in self.envelopes], dtype=np.int64)
+        self.spent = np.array([result[e][1] for e in self.envelopes], dtype=np.int64)
+        self.projected = np.array([result[e][2] for e in self.envelopes], dtype=np.int64)
+
+def snapshot_key(user_id: int, today: date) -> tuple:
+    return (user_id, today, ledger.data_version(user_id))
+
+async def load_snapshot(session, user_id: int, today: date) -> Snapshot:
+    return Snapshot(snapshot_key(user_id, today), current_month(), await forecast_month(session, user_id, today))
+
+def _envelope(target: str) -> tuple:
+    for sep in (";sub=", "/", ":", ">"):
+        if sep in target:
+            cat, sub = target.split(sep, 1)
+            return (cat.strip(), sub.strip())
+    return (target.strip(), "")
+
+def parse_scenario(text: str, currency: str) -> list[dict]:
+    """Clauses -> [{target, field ('limit'|'spend'), op, value, pct}]; raises ValueError."""
+    changes = []
+    for clause in filter(None, (c.strip() for c in text.split(","))):
+        m = _CLAUSE_RE.match(clause)
+        if not m:
+            raise ValueError(f"Can't read `{clause}`")
+        field = "limit" if m.group("budget") else "spend"
+        op, pct = m.group("op"), bool(m.group("pct"))
+        if op == "=" and (field != "limit" or pct):
+            raise ValueError(f"`=` only sets a budget, e.g. `Food budget=300` (got `{clause}`)")
+        target = m.group("target")
+        changes.append(dict(
+            target=None if target.lower() in ("*", "all") else _envelope(target),
+            field=field, op=op, pct=pct,
+            value=float(m.group("num")) if pct else to_minor(m.group("num"), currency),
+        ))
+    if not changes:
+        raise ValueError("No scenario given")
+    return changes
+
+def _adjust(base: np.ndarray, op: str, value, pct: bool) -> np.ndarray:
+    if op == "=":
+        return np.full_like(base, value)
+    sign = 1 if op == "+" else -1
+    if pct:
+        return np.rint(base * (100 + sign * value) / 100).astype(np.int64)
+    return base + sign * value
+
+def apply(snap: Snapshot, changes: list[dict]):
+    """-> (envelopes, limit, spent, projected) after the scenario; the snapshot is left as is."""
+    envelopes = list(snap.envelopes)
+    index = dict(snap.index)
+    limit, spent, projected = snap.limit.copy(), snap.spent.copy(), snap.projected.copy()
+    for ch in changes:
+        if ch["target"] is not None and ch["target"] not in index:
+            if ch["field"] == "limit" or ch["op"] == "-" or ch["pct"]:
+                raise KeyError(ch["target"])
+            # an extra expense in an envelope with no budget yet
+            index[ch["target"]] = len(envelopes)
+            envelopes.append(ch["target"])
+            limit, spent, projected = (np.append(a, 0) for a in (limit, spent, projected))
+        mask = np.ones(len(envelopes), dtype=bool) if ch["target"] is None else (np.arange(len(envelopes)) == index[ch["target"]])
+        if ch["field"] == "limit":
+            limit[mask] = np.maximum(_adjust(limit[mask], ch["op"], ch["value"], ch["pct"]), 0)
+        elif ch["op"] == "+" and not ch["pct"]:
+            spent[mask] += ch["value"]
+            projected[mask] += ch["value"]
+        else:
+            # cuts (and % changes) apply to what is still to be spent this month
+            rest = projected[mask] - spent[mask]
+            projected[mask] = spent[mask] + np.maximum(_adjust(rest, ch["op"], ch["value"], ch["pct"]), 0)
+    return envelopes, limit, spent, projected
@@ -0,0 +1,111 @@
+"""
+Normal users' latency while one user floods the bot, with and without
+admission control (app.admission).
+
+    python -m bench.bench_admission              # SQLite temp file for held entries
+    BENCH_PG_URL=postgresql+psycopg://... python -m bench.bench_admission
+
+Runs updates through the same pipeline as polling mode: the
+idempotency.PerUserUpdates processor (MAX_CONCURRENT slots, each user's
+updates in order), then the admission gate, then a handler that sleeps
+HANDLE_MS to stand in for its DB round trips and reply. One user pastes FLOOD
+entries at once while USERS other users send one entry every INTERVAL_MS.
+Reports the normal users' p50/p99/max latency (arrival to reply) and how the
+flood was handled: entries handled one by one, entries logged in merged
+batches, and how many batches.
+"""
+import os, sys, asyncio, itertools, tempfile, time, types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+FLOOD = int(os.getenv("BENCH_FLOOD", "300"))
+USERS = int(os.getenv("BENCH_USERS", "50"))
+INTERVAL_MS = float(os.getenv("BENCH_INTERVAL_MS", "20"))
+HANDLE_MS = float(os.getenv("BENCH_HANDLE_MS", "20"))
+DURATION_S = float(os.getenv("BENCH_DURATION_S", "5"))
+ABUSER = 1
+
+_IDS = itertools.count(1)
+
+class _JobQueue:
+    def run_once(self, callback, when, data=None, name=None, user_id=None):
+        ctx = types.SimpleNamespace(job=types.SimpleNamespace(data=data))
+        asyncio.get_running_loop().call_later(when, lambda: asyncio.ensure_future(callback(ctx)))
+
+def _update(uid: int, text: str):
+    update_id = next(_IDS)
+    return types.SimpleNamespace(
+        update_id=update_id, effective_user=types.SimpleNamespace(id=uid), effective_chat=None, callback_query=None,
+        message=types.SimpleNamespace(text=text), to_dict=lambda: {"update_id": update_id, "text": text},
+    )
+
+async def run(gated: bool) -> dict:
+    from telegram.ext import ApplicationHandlerStop
+    from app import admission, idempotency
+
+    admission._BUCKETS.clear()
+    admission.COUNTS.clear()
+    stats = {"latency": [], "single": 0, "merged": 0, "batches": 0}
+
+    async def handle(update):
+        await asyncio.sleep(HANDLE_MS / 1000)
+        if update.effective_user.id == ABUSER:
+            stats["single"] += 1
+        else:
+            stats["latency"].append(time.perf_counter() - update.arrived)
+
+    async def log_batch(context, items):
+        await asyncio.sleep(HANDLE_MS / 1000)  # one transaction, one reply
+        stats["merged"] += len(items)
+        stats["batches"] += 1
+
+    gate = admission.Gate(log_batch)
+    context = types.SimpleNamespace(application=types.SimpleNamespace(job_queue=_JobQueue()))
+
+    async def process(update):
+        # what Application.process_update does: group -1 first, stop on ApplicationHandlerStop
+        if gated:
+            try:
+                await gate(update, context)
+            except ApplicationHandlerStop:
+                return
+        await handle(update)
+
+    processor = idempotency.PerUserUpdates()
+    tasks = []
+
+    def arrive(update):
+        update.arrived = time.perf_counter()
+        tasks.append(asyncio.ensure_future(processor.process_update(update, process(update))))
+
+    for i in range(FLOOD):
+        arrive(_update(ABUSER, f"{i + 1} snack #Food"))
+    t_end = time.perf_counter() + DURATION_S
+    uid = 0
+    while time.perf_counter() < t_end:
+        arrive(_update(100 + uid % USERS, "12 lunch #Food"))
+        uid += 1
+        await asyncio.sleep(INTERVAL_MS / 1000)
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(admission.wait_seconds(ABUSER) + 0.2)  # the last merged batch
+    return stats
+
+def _report(name: str, stats: dict):
+    lat = sorted(stats["latency"])
+    pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] * 1000
+    print(f"{name:>10}: normal users p50 {pct(0.5):7.1f} ms  p99 {pct(0.99):7.1f} ms  max {lat[-1] * 1000:7.1f} ms  (n={len(lat)})")
+    print(f"{'':>10}  flood of {FLOOD}: {stats['single']} handled one by one, "
+          f"{stats['merged']} merged into {stats['batches']} batches, {FLOOD - stats['single'] - stats['merged']} refused")
+
+async def main():
+    url = os.getenv("BENCH_PG_URL", "").strip() or f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='budgetbot-bench-')}/admission.db"
+    os.environ["DATABASE_URL"] = url
+    from app.db import init_db
+
+    await init_db()
+    print(f"flood {FLOOD} entries, {USERS} normal users every {INTERVAL_MS:g} ms, handler {HANDLE_MS:g} ms")
+    _report("no gate", await run(False))
+    _report("admission", await run(True))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""
+Multi-worker mode against a real Postgres: several worker processes drain
+one update_queue while workers join and die.
+
+    BENCH_PG_URL=postgresql+psycopg://... python -m bench.bench_cluster
+
+Queues UPDATES fake updates from USERS users and starts WORKERS worker
+processes (each a cluster.Worker whose handler only records what it ran and
+when). One more worker joins after a second (shards rebalance) and one is
+SIGKILLed (or, with BENCH_FAILURE=hang, SIGSTOPped) half-way through: its
+shards fail over. Then it checks that
+- every update was handled,
+- no user ever had updates running in two processes at once,
+- each user's updates ran in order.
+A batch the killed worker was in the middle of is handled again by the
+shard's next owner (the queue is at-least-once); those repeats are reported.
+"""
+import os, sys, asyncio, random, signal, subprocess, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+WORKERS = int(os.getenv("BENCH_WORKERS", "3"))
+USERS = int(os.getenv("BENCH_USERS", "200"))
+UPDATES = int(os.getenv("BENCH_UPDATES", "3000"))
+HANDLE_MS = float(os.getenv("BENCH_HANDLE_MS", "5"))
+TIMEOUT_S = float(os.getenv("BENCH_TIMEOUT_S", "180"))
+FAILURE = os.getenv("BENCH_FAILURE", "kill")  # kill (process dies) / hang (SIGSTOP: alive, holding its locks)
+
+LOG_DDL = (
+    "CREATE TABLE IF NOT EXISTS bench_cluster_log ("
+    "update_id BIGINT, user_id BIGINT, pid INT, started DOUBLE PRECISION, finished DOUBLE PRECISION)"
+)
+
+def _env(url: str) -> dict:
+    return {
+        **os.environ, "DATABASE_URL": url, "BOT_ROLE": "worker",
+        "CLUSTER_HEARTBEAT_SECONDS": "1", "CLUSTER_DEAD_AFTER_SECONDS": "4", "CLUSTER_POLL_SECONDS": "0.05",
+        "CLUSTER_BATCH": "50",
+    }
+
+async def worker():
+    from sqlalchemy import text
+    from app import cluster
+    from app.db import SessionLocal
+
+    async def handle(u):
+        started = time.time()
+        await asyncio.sleep(HANDLE_MS / 1000)
+        async with SessionLocal() as s:
+            await s.execute(text("INSERT INTO bench_cluster_log VALUES (:u, :uid, :pid, :a, :b)"), dict(
+                u=u["update_id"], uid=u["message"]["from"]["id"], pid=os.getpid(), a=started, b=time.time(),
+            ))
+            await s.commit()
+
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    await cluster.Worker(handle).run(stop)
+
+async def run(url: str):
+    from sqlalchemy import text, func, select
+    from app import cluster
+    from app.db import init_db, SessionLocal, UpdateQueue, ClusterWorker
+
+    await init_db()
+    async with SessionLocal() as s:
+        await s.execute(text("DROP TABLE IF EXISTS bench_cluster_log"))
+        await s.execute(text(LOG_DDL))
+        await s.execute(text("TRUNCATE update_queue, cluster_workers"))
+        await s.commit()
+    rng = random.Random(7)
+    updates = [{"update_id": i, "message": {"from": {"id": rng.randint(1, USERS)}, "text": "x"}} for i in range(1, UPDATES + 1)]
+    for i in range(0, len(updates), 1000):
+        await cluster.enqueue(updates[i:i + 1000])
+
+    spawn = lambda: subprocess.Popen([sys.executable, "-m", "bench.bench_cluster", "worker"], env=_env(url))
+    procs = [spawn() for _ in range(WORKERS)]
+    t0 = time.perf_counter()
+    joined = killed = None
+    while True:
+        await asyncio.sleep(0.25)
+        async with SessionLocal() as s:
+            left = (await s.execute(select(func.count()).select_from(UpdateQueue))).scalar()
+            live = (await s.execute(select(func.count()).select_from(ClusterWorker))).scalar()
+        elapsed = time.perf_counter() - t0
+        if joined is None and elapsed > 1:
+            procs.append(spawn())
+            joined = elapsed
+        if killed is None and left < UPDATES / 2:
+            procs[0].send_signal(signal.SIGKILL if FAILURE == "kill" else signal.SIGSTOP)
+            killed = (elapsed, procs[0].pid)
+        if not left or elapsed > TIMEOUT_S:
+            break
+    procs[0].kill()
+    for p in procs[1:]:
+        p.send_signal(signal.SIGTERM)
+    for p in procs:
+        p.wait(timeout=30)
+    print(f"drained {UPDATES - left}/{UPDATES} updates in {elapsed:.1f}s with {WORKERS}+1 workers "
+          f"({live} live at the end); worker joined at {joined:.1f}s, pid {killed[1]} {FAILURE} at {killed[0]:.1f}s")
+
+    async with SessionLocal() as s:
+        rows = (await s.execute(text("SELECT update_id, user_id, pid, started, finished FROM bench_cluster_log"))).all()
+    runs = {}
+    for r in rows:
+        runs[r.update_id] = runs.get(r.update_id, 0) + 1
+    missing = UPDATES - len(runs)
+    repeats = len(rows) - len(runs)
+    overlaps = disorder = 0
+    by_user = {}
+    for r in rows:
+        by_user.setdefault(r.user_id, []).append(r)
+    for rs in by_user.values():
+        rs.sort(key=lambda r: r.started)
+        for a, b in zip(rs, rs[1:]):
+            if b.started < a.finished and a.pid != b.pid:
+                overlaps += 1
+            if b.update_id < a.update_id and runs[b.update_id] == 1:
+                disorder += 1
+    print(f"missing: {missing}  concurrent across workers: {overlaps}  out of order: {disorder}  "
+          f"repeated after failover: {repeats}")
+    if missing or overlaps or disorder:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["worker"]:
+        asyncio.run(worker())
+    else:
+        url = os.getenv("BENCH_PG_URL")
+        if not url:
+            raise SystemExit("Set BENCH_PG_URL (multi-worker mode needs Postgres).")
+        os.environ["DATABASE_URL"] = url
+        asyncio.run(run(url))
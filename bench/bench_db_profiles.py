@@ -0,0 +1,82 @@
+"""
+Write/read throughput under concurrency for each storage profile.
+
+    python -m bench.bench_db_profiles                 # SQLite temp file
+    BENCH_PG_URL=postgresql+psycopg://... python -m bench.bench_db_profiles
+
+Each run spins up WRITERS tasks that insert + commit one txn at a time and
+READERS tasks that run the per-envelope SUM used by /left, for SECONDS.
+"""
+import os, sys, asyncio, random, tempfile, time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sqlalchemy import select, func, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from app.db import Base, Txn, make_engine
+
+WRITERS = int(os.getenv("BENCH_WRITERS", "8"))
+READERS = int(os.getenv("BENCH_READERS", "8"))
+SECONDS = float(os.getenv("BENCH_SECONDS", "5"))
+CATS = ["Food", "Transport", "Household", "Fun", "Health"]
+
+async def _writer(Session, stop, counter):
+    while time.perf_counter() < stop:
+        d = date.today()
+        async with Session() as s:
+            s.add(Txn(
+                user_tg_id=random.randint(1, 50), occurred_at=d, month=f"{d.year:04d}-{d.month:02d}",
+                type="Expense", amount_cents=random.randint(100, 5000), currency="USD",
+                category=random.choice(CATS), parent=None, note="bench",
+            ))
+            await s.commit()
+        counter[0] += 1
+
+async def _reader(Session, stop, counter):
+    d = date.today()
+    month = f"{d.year:04d}-{d.month:02d}"
+    while time.perf_counter() < stop:
+        async with Session() as s:
+            await s.execute(select(func.sum(Txn.amount_cents)).where(
+                Txn.user_tg_id == random.randint(1, 50), Txn.type == "Expense", Txn.month == month,
+                Txn.category == random.choice(CATS)))
+        counter[0] += 1
+
+async def run(url: str, profile: str):
+    eng = make_engine(url, profile)
+    Session = async_sessionmaker(eng, expire_on_commit=False, class_=AsyncSession)
+    async with eng.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    writes, reads = [0], [0]
+    errors = 0
+    stop = time.perf_counter() + SECONDS
+    tasks = [_writer(Session, stop, writes) for _ in range(WRITERS)]
+    tasks += [_reader(Session, stop, reads) for _ in range(READERS)]
+    for r in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(r, Exception):
+            errors += 1
+    if eng.dialect.name == "sqlite":
+        async with eng.connect() as conn:
+            mode = (await conn.execute(text("PRAGMA journal_mode"))).scalar()
+    else:
+        mode = eng.dialect.name
+    await eng.dispose()
+    print(f"{profile:8s} {mode:10s} writes/s {writes[0] / SECONDS:9.1f}   reads/s {reads[0] / SECONDS:9.1f}   failed tasks {errors}")
+
+async def main():
+    targets = []
+    tmp = tempfile.mkdtemp(prefix="budgetbot-bench-")
+    for profile in ("default", "tuned"):
+        targets.append((f"sqlite+aiosqlite:///{tmp}/{profile}.db", profile))
+    pg = os.getenv("BENCH_PG_URL", "").strip()
+    if pg:
+        targets += [(pg, "default"), (pg, "tuned")]
+    print(f"{WRITERS} writers + {READERS} readers, {SECONDS:.0f}s each")
+    for url, profile in targets:
+        await run(url, profile)
+
+if __name__ == "__main__":
+    asyncio.run(main())
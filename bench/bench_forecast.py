@@ -0,0 +1,39 @@
+"""
+Forecast core on synthetic data: 50 envelopes x 24 months of daily history.
+
+    python -m bench.bench_forecast
+"""
+import os, sys, time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+
+from app.forecast import seasonality, project
+
+ENVELOPES = int(os.getenv("BENCH_ENVELOPES", "50"))
+MONTHS = int(os.getenv("BENCH_MONTHS", "24"))
+RUNS = int(os.getenv("BENCH_RUNS", "50"))
+
+def main():
+    today = date(2026, 10, 18)
+    first = today.replace(day=1) - timedelta(days=int(MONTHS * 30.44))
+    days = (today.replace(day=1) - first).days
+    rng = np.random.default_rng(7)
+    dow_bias = rng.uniform(0.3, 2.0, size=(ENVELOPES, 7))
+    dows = (np.arange(days) + first.weekday()) % 7
+    history = rng.poisson(800, size=(ENVELOPES, days)) * dow_bias[:, dows] * (rng.random((ENVELOPES, days)) < 0.4)
+    spent = rng.integers(0, 40000, size=ENVELOPES).astype(np.float64)
+
+    timings = []
+    for _ in range(RUNS):
+        t0 = time.perf_counter()
+        profile, mean = seasonality(history, first)
+        project(spent, profile, mean, today)
+        timings.append((time.perf_counter() - t0) * 1000.0)
+    timings.sort()
+    print(f"{ENVELOPES} envelopes x {days} days: median {timings[len(timings) // 2]:.2f} ms, p95 {timings[int(len(timings) * 0.95)]:.2f} ms")
+
+if __name__ == "__main__":
+    main()
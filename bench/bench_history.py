@@ -0,0 +1,66 @@
+"""
+/history paging cost: first page vs. deep pages, keyset vs. OFFSET.
+
+    python -m bench.bench_history                       # SQLite temp file
+    BENCH_PG_URL=postgresql+psycopg://... python -m bench.bench_history
+
+Seeds one user with ROWS txns spread over MONTHS months (closed months are
+archived, as in production), then times history.fetch_page at several depths.
+"""
+import os, sys, asyncio, random, tempfile, time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+ROWS = int(os.getenv("BENCH_ROWS", "100000"))
+MONTHS = int(os.getenv("BENCH_MONTHS", "24"))
+RUNS = int(os.getenv("BENCH_RUNS", "20"))
+
+async def main():
+    url = os.getenv("BENCH_PG_URL", "").strip() or f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='budgetbot-bench-')}/history.db"
+    os.environ["DATABASE_URL"] = url
+    from sqlalchemy import insert, select
+    from app.db import init_db, SessionLocal, Txn
+    from app import history, partitions
+
+    await init_db()
+    rng = random.Random(7)
+    start = date.today().replace(day=1) - timedelta(days=30 * (MONTHS - 1))
+    step = (date.today() - start).days / ROWS
+    async with SessionLocal() as s:
+        batch = []
+        for i in range(ROWS):
+            d = start + timedelta(days=int(i * step))
+            batch.append(dict(user_tg_id=1, occurred_at=d, month=f"{d.year:04d}-{d.month:02d}", type="Expense",
+                              amount_cents=rng.randint(100, 5000), currency="USD", category=rng.choice(["Food", "Fun", "Rent"]),
+                              parent=None, note=None))
+            if len(batch) == 20000:
+                await s.execute(insert(Txn), batch)
+                batch = []
+        if batch:
+            await s.execute(insert(Txn), batch)
+        await s.commit()
+        await partitions.archive_closed_months(s)
+
+    async def timed(fn):
+        ts = []
+        for _ in range(RUNS):
+            t0 = time.perf_counter()
+            await fn()
+            ts.append((time.perf_counter() - t0) * 1000)
+        return sorted(ts)[len(ts) // 2]
+
+    async with SessionLocal() as s:
+        ids = [r[0] for r in (await s.execute(select(partitions.txn_source().c.id).order_by(partitions.txn_source().c.id.desc()))).all()]
+        print(f"{ROWS} txns, page size {history.PAGE_SIZE}, median of {RUNS}")
+        for frac in (0.0, 0.5, 0.99):
+            pos = int(frac * (len(ids) - history.PAGE_SIZE))
+            cursor = ("N", ids[pos - 1]) if pos else None
+            keyset = await timed(lambda: history.fetch_page(s, 1, {}, cursor))
+            src = partitions.txn_source()
+            q = src.select().where(src.c.user_tg_id == 1).order_by(src.c.id.desc()).offset(pos).limit(history.PAGE_SIZE)
+            offset = await timed(lambda: s.execute(q))
+            print(f"  row {pos:>7}: keyset {keyset:6.2f} ms   offset {offset:7.2f} ms")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+"""
+/search latency over a large note corpus.
+
+    python -m bench.bench_search                       # SQLite temp file
+    BENCH_PG_URL=postgresql+psycopg://... python -m bench.bench_search
+
+Seeds ROWS txns with short generated notes across USERS users (inserted
+through the table, so the FTS triggers / GIN index do the indexing), then
+times search.search for a common term, a rare term and a prefix.
+"""
+import os, sys, asyncio, random, tempfile, time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+ROWS = int(os.getenv("BENCH_ROWS", "1000000"))
+USERS = int(os.getenv("BENCH_USERS", "1000"))
+RUNS = int(os.getenv("BENCH_RUNS", "20"))
+
+WORDS = ["coffee", "lunch", "groceries", "uber", "rent", "gas", "costco", "pharmacy", "movie", "gym",
+         "book", "dinner", "taxi", "snacks", "gift", "parking", "internet", "phone", "shoes", "haircut"]
+
+async def main():
+    url = os.getenv("BENCH_PG_URL", "").strip() or f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='budgetbot-bench-')}/search.db"
+    os.environ["DATABASE_URL"] = url
+    os.environ["TXN_PARTITIONING"] = "0"  # measure the index, not the archive split
+    from sqlalchemy import insert
+    from app.db import init_db, SessionLocal, Txn
+    from app import search
+
+    await init_db()
+    rng = random.Random(7)
+    start = date.today() - timedelta(days=730)
+    t0 = time.perf_counter()
+    async with SessionLocal() as s:
+        batch = []
+        for i in range(ROWS):
+            d = start + timedelta(days=rng.randrange(730))
+            note = " ".join(rng.sample(WORDS, 2)) + (" zanzibar" if rng.random() < 0.0005 else "")
+            batch.append(dict(user_tg_id=rng.randint(1, USERS), occurred_at=d, month=f"{d.year:04d}-{d.month:02d}", type="Expense",
+                              amount_cents=rng.randint(100, 5000), currency="USD", category=rng.choice(["Food", "Fun", "Home"]),
+                              parent=None, note=note))
+            if len(batch) == 50000:
+                await s.execute(insert(Txn), batch)
+                batch = []
+        if batch:
+            await s.execute(insert(Txn), batch)
+        await s.commit()
+    print(f"seeded {ROWS} notes for {USERS} users in {time.perf_counter() - t0:.0f}s")
+
+    async with SessionLocal() as s:
+        for label, terms in (("common", ["coffee"]), ("two terms", ["coffee", "lunch"]), ("rare", ["zanzibar"]), ("prefix", ["groc*"])):
+            ts = []
+            for _ in range(RUNS):
+                t1 = time.perf_counter()
+                rows, totals, _more = await search.search(s, rng.randint(1, USERS), terms, {})
+                ts.append((time.perf_counter() - t1) * 1000)
+            ts.sort()
+            print(f"  {label:10s} median {ts[len(ts) // 2]:6.1f} ms  p95 {ts[int(len(ts) * 0.95)]:6.1f} ms")
+
+if __name__ == "__main__":
+    asyncio.run(main())
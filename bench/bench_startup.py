@@ -0,0 +1,73 @@
+"""
+Cold-start budget for `import app.bot` (what Render pays on every wake-up).
+
+    python -m bench.bench_startup            # exits 1 when over budget
+
+Runs `python -X importtime -c "import app.bot"` in a clean subprocess with the
+optional integrations unconfigured, reports the slowest imports, and checks:
+  - total import time  <= STARTUP_BUDGET_MS  (median of BENCH_RUNS runs)
+  - peak RSS           <= STARTUP_RSS_BUDGET_MB
+  - none of the optional heavy packages were imported at all
+"""
+import os, sys, re, subprocess, statistics
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "900"))
+STARTUP_RSS_BUDGET_MB = float(os.getenv("STARTUP_RSS_BUDGET_MB", "70"))
+RUNS = int(os.getenv("BENCH_RUNS", "5"))
+
+# Must only load when their feature is used/configured.
+LAZY_MODULES = ["gspread", "google.auth", "reportlab", "sendgrid", "sentry_sdk", "xlsxwriter", "numpy", "PIL"]
+
+_LINE_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+_OPTIONAL_ENV = ["SENTRY_DSN", "GOOGLE_SHEET_ID", "GOOGLE_SERVICE_ACCOUNT_JSON", "SENDGRID_API_KEY", "REPORT_EMAIL_TO"]
+
+def _env():
+    env = {k: v for k, v in os.environ.items() if k not in _OPTIONAL_ENV}
+    env["PYTHONPATH"] = ROOT
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+def importtime_run():
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.bot"],
+        cwd=ROOT, env=_env(), capture_output=True, text=True, check=True,
+    ).stderr
+    mods = {}
+    for m in _LINE_RE.finditer(out):
+        self_us, cum_us, indent, name = int(m.group(1)), int(m.group(2)), len(m.group(3)), m.group(4)
+        mods[name] = (self_us, cum_us, indent)
+    return mods
+
+def rss_mb() -> float:
+    code = "import resource, app.bot; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=_env(), capture_output=True, text=True, check=True).stdout
+    kb = int(out.strip())
+    return kb / (1024 * 1024) if sys.platform == "darwin" else kb / 1024  # bytes on macOS
+
+def main() -> int:
+    runs = [importtime_run() for _ in range(RUNS)]
+    total_ms = statistics.median(r["app.bot"][1] for r in runs) / 1000.0
+    last = runs[-1]
+    top = sorted(((cum, name) for name, (_s, cum, indent) in last.items() if indent <= 3 and name != "app.bot"), reverse=True)[:10]
+    print(f"import app.bot: {total_ms:,.0f} ms (median of {RUNS}, budget {STARTUP_BUDGET_MS:,.0f} ms)")
+    for cum, name in top:
+        print(f"  {cum / 1000.0:8.1f} ms  {name}")
+    rss = rss_mb()
+    print(f"peak RSS after import: {rss:,.1f} MB (budget {STARTUP_RSS_BUDGET_MB:,.0f} MB)")
+
+    failures = []
+    leaked = sorted({m for m in last for lazy in LAZY_MODULES if m == lazy or m.startswith(lazy + ".")})
+    if leaked:
+        failures.append("optional modules imported at startup: " + ", ".join(leaked[:10]))
+    if total_ms > STARTUP_BUDGET_MS:
+        failures.append(f"import time {total_ms:,.0f} ms > {STARTUP_BUDGET_MS:,.0f} ms")
+    if rss > STARTUP_RSS_BUDGET_MB:
+        failures.append(f"RSS {rss:,.1f} MB > {STARTUP_RSS_BUDGET_MB:,.0f} MB")
+    for f in failures:
+        print("OVER BUDGET:", f)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Month-end sweep over many users (one INSERT ... SELECT for all of them).
+
+    python -m bench.bench_sweep                       # SQLite temp file
+    BENCH_PG_URL=postgresql+psycopg://... python -m bench.bench_sweep
+
+Seeds USERS users with TXNS_PER_USER current-month expenses across ENVELOPES
+budgets and 1-3 goals each, then times goals.sweep_month.
+"""
+import os, sys, asyncio, random, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sqlalchemy import insert, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from app.db import Base, Txn, Budget, Goal, GoalContribution, make_engine
+from app.utils import current_month
+from app import goals
+
+USERS = int(os.getenv("BENCH_USERS", "10000"))
+TXNS_PER_USER = int(os.getenv("BENCH_TXNS_PER_USER", "30"))
+ENVELOPES = int(os.getenv("BENCH_ENVELOPES", "20"))
+
+async def run(url: str):
+    eng = make_engine(url)
+    Session = async_sessionmaker(eng, expire_on_commit=False, class_=AsyncSession)
+    async with eng.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    month = current_month()
+    day = int(month[:4]), int(month[5:]), 1
+    rng = random.Random(7)
+    envs = [(f"Cat{i}", None if i % 3 else "Sub") for i in range(ENVELOPES)]
+    async with Session() as s:
+        await s.execute(insert(Budget), [
+            dict(user_tg_id=u, month=month, category=c, parent=p or "", limit_cents=rng.randint(5000, 50000))
+            for u in range(1, USERS + 1) for c, p in envs
+        ])
+        await s.execute(insert(Goal), [
+            dict(user_tg_id=u, name=f"g{k}", target_cents=500000, monthly_cents=rng.randint(1000, 20000), balance_cents=0, active=True)
+            for u in range(1, USERS + 1) for k in range(rng.randint(1, 3))
+        ])
+        from datetime import date
+        d = date(*day)
+        batch = []
+        for u in range(1, USERS + 1):
+            for _ in range(TXNS_PER_USER):
+                c, p = rng.choice(envs)
+                batch.append(dict(user_tg_id=u, occurred_at=d, month=month, type="Expense", amount_cents=rng.randint(100, 3000),
+                                  currency="USD", category=c, parent=p, note=None))
+            if len(batch) >= 20000:
+                await s.execute(insert(Txn), batch)
+                batch = []
+        if batch:
+            await s.execute(insert(Txn), batch)
+        await s.commit()
+
+    async with Session() as s:
+        t0 = time.perf_counter()
+        queued = await goals.sweep_month(s, month)
+        elapsed = time.perf_counter() - t0
+        n_users = (await s.execute(select(func.count(func.distinct(GoalContribution.user_tg_id))))).scalar()
+    await eng.dispose()
+    print(f"{eng.dialect.name:10s} {USERS} users x {TXNS_PER_USER} txns: sweep {elapsed:.2f}s, {queued} contributions for {n_users} users")
+
+async def main():
+    tmp = tempfile.mkdtemp(prefix="budgetbot-bench-")
+    await run(f"sqlite+aiosqlite:///{tmp}/sweep.db")
+    pg = os.getenv("BENCH_PG_URL", "").strip()
+    if pg:
+        await run(pg)
+
+if __name__ == "__main__":
+    asyncio.run(main())